@@ -0,0 +1,87 @@
+"""تكلفة بناء لوحة الأزرار لكل رد: البناء من جديد في كل رد مقابل لوحات KeyboardManager المحفوظة.
+
+القائمة الثابتة (لوحة المدير) كانت تبنى من جديد في كل رد، ولوحة القنوات كانت تقرأ
+القنوات من التخزين ثم تبنى في كل مرة يضغط فيها المستخدم "📺 قنوات نسونجي".
+يعمل في مجلد مؤقت حتى لا يلمس بيانات البوت، ودائماً بمحرك json.
+
+التشغيل:
+    python benchmarks/keyboards.py
+    python benchmarks/keyboards.py --channels 5 50 --updates 20000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# استيراد bot ينشئ مجلد data وملف السجل في المجلد الحالي
+WORK_DIR = tempfile.TemporaryDirectory(prefix="keyboards-bench-")
+os.chdir(WORK_DIR.name)
+# نفس المحرك دائماً، حتى لا يغير STORAGE_ENGINE في البيئة الأرقام
+os.environ["STORAGE_ENGINE"] = "json"
+
+from telegram import ReplyKeyboardMarkup  # noqa: E402
+
+import bot  # noqa: E402
+
+def old_admin_keyboard():
+    # ما كان يفعله get_admin_keyboard سابقاً
+    return ReplyKeyboardMarkup([
+        ["👑 لوحة التحكم", "📊 الإحصائيات"],
+        ["👥 إدارة المستخدمين", "📢 الاشتراك الإجباري"],
+        ["📺 إدارة القنوات", "🎭 إدارة المحتوى"],
+        ["⚙️ الإعدادات العامة", "📤 البث للمستخدمين"],
+        ["💾 النسخ الاحتياطي"]
+    ], resize_keyboard=True)
+
+async def old_channels_keyboard():
+    # ما كان يفعله show_channels_to_user سابقاً: قراءة القنوات ثم بناء اللوحة
+    channels = await bot.db.get_channels()
+    return bot.KeyboardManager.build_channels_keyboard(channels)
+
+async def new_channels_keyboard():
+    return await bot.KeyboardManager.get_channels_keyboard()
+
+async def per_update_us(func, updates, is_async):
+    started = time.perf_counter()
+    for _ in range(updates):
+        if is_async:
+            await func()
+        else:
+            func()
+    return (time.perf_counter() - started) / updates * 1_000_000
+
+async def set_channels(count):
+    for channel in await bot.db.get_channels():
+        await bot.db.delete_channel(channel["id"])
+    for i in range(count):
+        await bot.db.add_channel(f"قناة {i}", f"https://t.me/channel_{i}")
+
+async def run(args):
+    await bot.db.run(bot.BotDatabase.init_default_data)
+    print(f"storage: {bot.BotDatabase.engine.name}, {args.updates} replies per row")
+    print(f"{'keyboard':<22} {'channels':>8} {'before us':>10} {'after us':>10} {'speedup':>8}")
+
+    before = await per_update_us(old_admin_keyboard, args.updates, False)
+    after = await per_update_us(bot.KeyboardManager.get_admin_keyboard, args.updates, False)
+    print(f"{'admin menu':<22} {'-':>8} {before:>10.2f} {after:>10.2f} {before / after:>7.0f}x")
+
+    for count in args.channels:
+        await set_channels(count)
+        before = await per_update_us(old_channels_keyboard, args.updates, True)
+        after = await per_update_us(new_channels_keyboard, args.updates, True)
+        print(f"{'channels':<22} {count:>8} {before:>10.2f} {after:>10.2f} {before / after:>7.0f}x")
+
+    await bot.db.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, nargs="+", default=[5, 20, 100])
+    parser.add_argument("--updates", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
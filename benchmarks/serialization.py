@@ -0,0 +1,76 @@
+"""مقارنة صيغ ملفات البيانات: زمن الحفظ والقراءة وحجم users.json لعدد كبير من المستخدمين.
+
+يعمل في مجلد مؤقت حتى لا يلمس بيانات البوت.
+
+التشغيل:
+    python benchmarks/serialization.py
+    python benchmarks/serialization.py --sizes 10000 100000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# استيراد bot ينشئ مجلد data وملف السجل في المجلد الحالي
+WORK_DIR = tempfile.TemporaryDirectory(prefix="serialization-bench-")
+os.chdir(WORK_DIR.name)
+
+import bot  # noqa: E402
+
+FORMATS = ["json-pretty", "json", "msgpack"]
+
+def synthetic_users(count):
+    return {
+        str(100000000 + i): {
+            "username": f"user_{i}",
+            "first_name": f"مستخدم {i}",
+            "join_date": "2024-01-01T12:00:00.000000",
+            "approved": i % 3 != 0
+        }
+        for i in range(count)
+    }
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def stdlib_indent_dump(users):
+    # ما كان يفعله write_json سابقاً
+    return json.dumps(users, ensure_ascii=False, indent=2).encode('utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if bot.orjson else 'no'}, msgpack: {'yes' if bot.msgpack else 'no'}")
+    print(f"{'users':>9}  {'format':<12} {'dump ms':>9} {'load ms':>9} {'size MB':>9}")
+
+    for size in args.sizes:
+        users = synthetic_users(size)
+
+        rows = [("old indent=2", lambda: stdlib_indent_dump(users), json.loads)]
+        for name in FORMATS:
+            try:
+                serializer = bot.get_serializer(name)
+            except ValueError:
+                continue
+            rows.append((name, lambda s=serializer: s.encode(users), bot.decode_document))
+
+        for label, dump, load in rows:
+            payload = dump()
+            dump_time = best_of(dump, args.repeat)
+            load_time = best_of(lambda: load(payload), args.repeat)
+            print(f"{size:>9}  {label:<12} {dump_time * 1000:>9.1f} {load_time * 1000:>9.1f} {len(payload) / 1e6:>9.2f}")
+
+if __name__ == "__main__":
+    main()
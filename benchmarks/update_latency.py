@@ -0,0 +1,122 @@
+"""زمن الرد على المستخدمين: معالجة التحديثات واحداً تلو الآخر مقابل PerUserUpdateProcessor.
+
+يحاكي طابور تحديثات المكتبة: كل مستخدم يرسل عدة رسائل في فترة قصيرة، ومعظم
+المعالجات سريعة (طلب واحد لتليجرام) وبعضها بطيء (رفع نسخة احتياطية مثلاً).
+زمن الرد هو الوقت من وصول التحديث إلى انتهاء معالجته.
+يعمل في مجلد مؤقت حتى لا يلمس بيانات البوت.
+
+التشغيل:
+    python benchmarks/update_latency.py
+    python benchmarks/update_latency.py --users 200 --messages 5 --slow-ratio 0.05
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# استيراد bot ينشئ مجلد data وملف السجل في المجلد الحالي
+WORK_DIR = tempfile.TemporaryDirectory(prefix="update-latency-bench-")
+os.chdir(WORK_DIR.name)
+
+from telegram import Update  # noqa: E402
+
+import bot  # noqa: E402
+
+def make_updates(users, messages, window, seed):
+    """(وقت الوصول، التحديث) مرتبة بوقت الوصول"""
+    rng = random.Random(seed)
+    arrivals = []
+    update_id = 0
+    for user_id in range(1, users + 1):
+        for at in sorted(rng.uniform(0, window) for _ in range(messages)):
+            update_id += 1
+            update = Update.de_json({
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": f"user {user_id}"},
+                    "text": "📺 قنوات نسونجي",
+                },
+            }, None)
+            arrivals.append((at, update))
+    arrivals.sort(key=lambda item: item[0])
+    return arrivals
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+async def run(arrivals, processor, fast_ms, slow_ms, slow_ratio, seed):
+    rng = random.Random(seed)
+    durations = {update.update_id: (slow_ms if rng.random() < slow_ratio else fast_ms) / 1000 for _, update in arrivals}
+    queue = asyncio.Queue()
+    latencies = []
+    # ترتيب انتهاء تحديثات كل مستخدم، للتحقق من أنها لم تتداخل
+    finished = {}
+    loop = asyncio.get_running_loop()
+
+    async def handle(update, arrived):
+        await asyncio.sleep(durations[update.update_id])
+        latencies.append(loop.time() - arrived)
+        finished.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    async def producer():
+        started = loop.time()
+        for at, update in arrivals:
+            delay = started + at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            queue.put_nowait((update, loop.time()))
+        queue.put_nowait(None)
+
+    # نفس منطق Application._update_fetcher
+    async def fetcher():
+        tasks = []
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            update, arrived = item
+            if processor is None:
+                await handle(update, arrived)
+            else:
+                tasks.append(asyncio.create_task(processor.process_update(update, handle(update, arrived))))
+        await asyncio.gather(*tasks)
+
+    await asyncio.gather(producer(), fetcher())
+    in_order = all(ids == sorted(ids) for ids in finished.values())
+    return latencies, in_order
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5, help="رسائل لكل مستخدم")
+    parser.add_argument("--window", type=float, default=5.0, help="الفترة التي تصل فيها كل الرسائل (ثوان)")
+    parser.add_argument("--fast-ms", type=float, default=20)
+    parser.add_argument("--slow-ms", type=float, default=1500)
+    parser.add_argument("--slow-ratio", type=float, default=0.02)
+    parser.add_argument("--concurrency", type=int, default=bot.UPDATE_CONCURRENCY)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    arrivals = make_updates(args.users, args.messages, args.window, args.seed)
+    print(f"{len(arrivals)} updates from {args.users} users over {args.window}s, "
+          f"{args.slow_ratio:.0%} slow ({args.slow_ms:.0f} ms), the rest {args.fast_ms:.0f} ms")
+    print(f"{'mode':<28} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}  per-user order")
+
+    modes = [
+        ("sequential (before)", None),
+        (f"per-user, concurrency={args.concurrency}", bot.PerUserUpdateProcessor(args.concurrency)),
+    ]
+    for name, processor in modes:
+        latencies, in_order = asyncio.run(run(arrivals, processor, args.fast_ms, args.slow_ms, args.slow_ratio, args.seed))
+        print(f"{name:<28} {percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} "
+              f"{max(latencies) * 1000:>9.1f}  {'ok' if in_order else 'VIOLATED'}")
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,46 @@ import json
 import logging
 import asyncio
 import random
+import sqlite3
+import tempfile
+import atexit
+import contextlib
+import copy
+import threading
+import sys
+import argparse
+import time
+import signal
+import secrets
+import re
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from collections import Counter, deque, OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram.error import TelegramError, RetryAfter, BadRequest, Forbidden, NetworkError
+from telegram.ext import Application, BasePersistence, PersistenceInput, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 from datetime import datetime
 
+# مكتبات اختيارية لتسريع أو تصغير ملفات البيانات
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# خادم HTTP لوضع webhook (يأتي مع python-telegram-bot[webhooks])
+try:
+    import tornado.web
+    import tornado.httpserver
+except ImportError:
+    tornado = None
+
 # إعدادات التسجيل
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,6 +59,8 @@ if ADMIN_IDS_ENV:
     ADMIN_IDS = [int(admin_id.strip()) for admin_id in ADMIN_IDS_ENV.split(',') if admin_id.strip().isdigit()]
 else:
     ADMIN_IDS = []
+# نسخة ثابتة من ADMIN_IDS لفحص is_admin، يعاد بناؤها بـ set_admin_ids عند تغير القائمة
+ADMIN_ID_SET = frozenset(ADMIN_IDS)
 
 # حالات المحادثة
 (
@@ -30,9 +68,9 @@ else:
     ADD_CONTENT_TITLE, ADD_CONTENT_TYPE, ADD_CONTENT_FILE, ADD_CONTENT_TEXT,
     DELETE_USER, DELETE_CHANNEL, DELETE_CONTENT,
     EDIT_RESPONSE, EDIT_SUBSCRIPTION_MESSAGE, ADD_SUBSCRIPTION_CHANNEL, DELETE_SUBSCRIPTION_CHANNEL,
-    BROADCAST_MESSAGE, SEND_TO_USER,
+    BROADCAST_MESSAGE, SEND_TO_USER, SEND_TO_USER_MESSAGE,
     BACKUP_RESTORE
-) = range(16)
+) = range(17)
 
 # ملفات البيانات
 DATA_DIR = "data"
@@ -45,71 +83,572 @@ SUBSCRIPTION_CHANNELS_FILE = os.path.join(DATA_DIR, "subscription_channels.json"
 SETTINGS_FILE = os.path.join(DATA_DIR, "settings.json")
 REQUESTS_FILE = os.path.join(DATA_DIR, "requests.json")
 
-class BotDatabase:
-    @staticmethod
-    def init_default_data():
-        default_data = {
-            USERS_FILE: {},
-            CONTENT_FILE: {
-                "content": []
-            },
-            CHANNELS_FILE: {
-                "channels": []  # قنوات البوت العادية
-            },
-            SUBSCRIPTION_CHANNELS_FILE: {
-                "channels": ["@ineswangy"]  # قنوات الاشتراك الإجباري فقط
+# أسماء ملفات البيانات كما تستخدم في المعاملات: الاسم -> المسار
+DATA_FILES = {
+    "users": USERS_FILE,
+    "content": CONTENT_FILE,
+    "channels": CHANNELS_FILE,
+    "subscription_channels": SUBSCRIPTION_CHANNELS_FILE,
+    "settings": SETTINGS_FILE,
+    "requests": REQUESTS_FILE,
+}
+DATA_FILE_NAMES = {file_path: name for name, file_path in DATA_FILES.items()}
+# ما يحجزه AsyncStorage لكل استدعاء: مجموعات البيانات وحالة المحادثات
+STORAGE_RESOURCES = (*DATA_FILES, "sessions")
+# طلبات الانضمام في محرك JSON: سجل يضاف إليه فقط (سطر JSON لكل طلب أو حذف)
+REQUESTS_LOG_FILE = os.path.join(DATA_DIR, "requests.jsonl")
+# ضغط السجل عندما تتجاوز الأسطر الميتة هذا الحد وعدد الطلبات الحية معاً
+REQUESTS_LOG_COMPACT_MIN = int(os.getenv('REQUESTS_LOG_COMPACT_MIN', '1000'))
+# حالة المحادثات و user_data (انظر StoragePersistence)، بنفس طريقة سجل الطلبات
+SESSIONS_LOG_FILE = os.path.join(DATA_DIR, "sessions.jsonl")
+# كل كم ثانية تحفظ المكتبة التغييرات في user_data وحالات المحادثات
+PERSISTENCE_INTERVAL = int(os.getenv('PERSISTENCE_INTERVAL', '10'))
+
+# محرك التخزين: json (الافتراضي) أو sqlite
+STORAGE_ENGINE = os.getenv('STORAGE_ENGINE', '').strip().lower()
+SQLITE_FILE = os.path.join(DATA_DIR, "bot.db")
+# المحرك الذي نقلت إليه البيانات آخر مرة (بالأمر /migrate أو python bot.py migrate)
+STORAGE_ENGINE_FILE = os.path.join(DATA_DIR, "storage_engine")
+STORAGE_ENGINES = ("json", "sqlite", "memory")
+# المحركات التي تبقى بياناتها بعد إعادة التشغيل
+PERSISTENT_STORAGE_ENGINES = ("json", "sqlite")
+MIGRATE_BATCH_SIZE = int(os.getenv('MIGRATE_BATCH_SIZE', '1000'))
+
+# عدد خيوط القراءة والكتابة على القرص (خارج حلقة الأحداث)
+STORAGE_IO_THREADS = int(os.getenv('STORAGE_IO_THREADS', '4'))
+# تسجيل تحذير عندما يتأخر تنفيذ حلقة الأحداث أكثر من هذا الحد
+LOOP_LAG_WARN_MS = int(os.getenv('LOOP_LAG_WARN_MS', '200'))
+
+# صيغة حفظ ملفات البيانات: json (مضغوط)، json-pretty (منسق للقراءة)، msgpack (ثنائي)
+DATA_FORMAT = os.getenv('DATA_FORMAT', 'json').strip().lower()
+
+# الكتابة المؤجلة لملفات JSON: تجميع التعديلات وحفظها كل N ميلي ثانية أو بعد M تعديل.
+# معطلة افتراضياً (0 = كل تعديل يحفظ فوراً). عند تفعيلها يحفظ الباقي عند الإيقاف العادي
+# (SIGTERM/SIGINT عبر post_stop)، لكن التوقف المفاجئ (SIGKILL، انهيار) يفقد حتى N ميلي ثانية من التعديلات
+WRITE_FLUSH_INTERVAL_MS = int(os.getenv('WRITE_FLUSH_INTERVAL_MS', '0'))
+WRITE_FLUSH_MAX_CHANGES = int(os.getenv('WRITE_FLUSH_MAX_CHANGES', '100'))
+# كل كم ثانية يفحص settings.json لالتقاط تعديله من خارج البوت (دون إعادة تشغيل)
+SETTINGS_CHECK_INTERVAL = float(os.getenv('SETTINGS_CHECK_INTERVAL', '2'))
+
+# حدود الإرسال: تليجرام يسمح بحوالي 30 رسالة في الثانية للبوت ورسالة في الثانية لكل محادثة
+SEND_RATE_PER_SECOND = float(os.getenv('SEND_RATE_PER_SECOND', '25'))
+SEND_PER_CHAT_INTERVAL_MS = int(os.getenv('SEND_PER_CHAT_INTERVAL_MS', '1000'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '3'))
+# البث له حدوده الخاصة حتى لا تنتظر ردود المستخدمين خلف آلاف رسائل البث
+BROADCAST_SEND_RATE_PER_SECOND = float(os.getenv('BROADCAST_SEND_RATE_PER_SECOND', '20'))
+# عدد الرسائل التي يرسلها البث في نفس الوقت، وكل كم ثانية تحدث رسالة التقدم
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '3'))
+# مدة صلاحية نتيجة التحقق من الاشتراك بالثواني: للمشترك، ولغير المشترك (أقصر حتى يظهر اشتراكه بسرعة)
+MEMBERSHIP_CACHE_TTL = int(os.getenv('MEMBERSHIP_CACHE_TTL', '600'))
+MEMBERSHIP_CACHE_NEGATIVE_TTL = int(os.getenv('MEMBERSHIP_CACHE_NEGATIVE_TTL', '30'))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', '50000'))
+
+# حد طول رسالة تليجرام، وعدد عناصر المحتوى الجاهزة للإرسال المحفوظة في الذاكرة
+TELEGRAM_MESSAGE_LIMIT = 4096
+CONTENT_CACHE_SIZE = int(os.getenv('CONTENT_CACHE_SIZE', '500'))
+# عضوية المستخدمين في قنوات الاشتراك كما وصلت من تحديثات chat_member: سجل تغييرات
+# (memberships.json القديم ينقل إليه مرة واحدة)، مع مدة صلاحية لكل نتيجة وحد أقصى للجدول
+MEMBERSHIPS_FILE = os.path.join(DATA_DIR, "memberships.jsonl")
+MEMBERSHIPS_LEGACY_FILE = os.path.join(DATA_DIR, "memberships.json")
+MEMBERSHIPS_SAVE_INTERVAL = int(os.getenv('MEMBERSHIPS_SAVE_INTERVAL', '60'))
+MEMBERSHIPS_TTL = int(os.getenv('MEMBERSHIPS_TTL', str(30 * 24 * 3600)))
+MEMBERSHIPS_MAX_SIZE = int(os.getenv('MEMBERSHIPS_MAX_SIZE', '200000'))
+
+# ملخص إجراءات المستخدمين للمديرين: يرسل كل FORWARD_DIGEST_INTERVAL ثانية أو عند تجمع FORWARD_DIGEST_MAX_EVENTS إجراء
+FORWARD_DIGEST_INTERVAL = int(os.getenv('FORWARD_DIGEST_INTERVAL', '60'))
+FORWARD_DIGEST_MAX_EVENTS = int(os.getenv('FORWARD_DIGEST_MAX_EVENTS', '50'))
+# الإجراءات التي تحول فوراً إذا لم تحدد في الإعدادات
+FORWARD_IMMEDIATE_ACTIONS = ["طلب انضمام جديد"]
+
+# وضع webhook: يفعل بتعيين WEBHOOK_URL (مثل https://app.herokuapp.com)، وإلا يعمل البوت بوضع polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').strip().rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+# يرسله تليجرام في ترويسة X-Telegram-Bot-Api-Secret-Token مع كل تحديث
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# عدد التحديثات التي تعالج في نفس الوقت (1 = واحد تلو الآخر كما في السابق)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+# كم تحديثاً يمكن أن ينتظر خلف تحديثات سابقة لنفس المستخدم، لكل تحديث قيد التنفيذ
+UPDATE_BACKLOG_FACTOR = 8
+
+# مهام البث المحفوظة، وكل كم نتيجة تحفظ (بالإضافة للحفظ مع كل تحديث للتقدم)
+BROADCASTS_DIR = os.path.join(DATA_DIR, "broadcasts")
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv('BROADCAST_CHECKPOINT_EVERY', '50'))
+# كم بثاً منتهياً يبقى ملخصه (ملف الحالة فقط)، والأقدم منه يحذف عند التشغيل
+BROADCAST_KEEP_FINISHED = int(os.getenv('BROADCAST_KEEP_FINISHED', '20'))
+
+# شكل كل ملف عندما يكون فارغاً أو غير موجود
+EMPTY_DOCUMENTS = {
+    "users": {},
+    "content": {"content": []},
+    "channels": {"channels": []},
+    "subscription_channels": {"channels": []},
+    "settings": {},
+    "requests": [],
+}
+
+def empty_document(file_path):
+    return copy.deepcopy(EMPTY_DOCUMENTS[DATA_FILE_NAMES[file_path]])
+
+def default_data():
+    """البيانات الافتراضية لكل ملف عند التشغيل الأول"""
+    return {
+        USERS_FILE: {},
+        CONTENT_FILE: {
+            "content": []
+        },
+        CHANNELS_FILE: {
+            "channels": []  # قنوات البوت العادية
+        },
+        SUBSCRIPTION_CHANNELS_FILE: {
+            "channels": ["@ineswangy"]  # قنوات الاشتراك الإجباري فقط
+        },
+        SETTINGS_FILE: {
+            "subscription": {
+                "enabled": False,
+                "message": "📢 يجب الاشتراك في القناة أولاً لتتمكن من استخدام البوت"
             },
-            SETTINGS_FILE: {
-                "subscription": {
-                    "enabled": False,
-                    "message": "📢 يجب الاشتراك في القناة أولاً لتتمكن من استخدام البوت"
-                },
-                "responses": {
-                    "welcome": "🎉 مرحباً! تم قبول طلبك بنجاح.\nيمكنك الآن استخدام البوت والاستفادة من محتوانا.",
-                    "rejected": "❌ تم رفض طلبك.\nللمساعدة تواصل مع مدير البوت : @iomarsamara",
-                    "help": "للأستفسار والتواصل /n/n @iomarsamara ℹ️",
-                    "subscribe_success": "✅ تم التحقق من اشتراكك بنجاح!",
-                    "subscribe_failed": "❌ لم يتم التحقق من اشتراكك بعد!"
-                },
-                "forwarding": {
-                    "enabled": True  # تفعيل التحويل افتراضياً
-                }
+            "responses": {
+                "welcome": "🎉 مرحباً! تم قبول طلبك بنجاح.\nيمكنك الآن استخدام البوت والاستفادة من محتوانا.",
+                "rejected": "❌ تم رفض طلبك.\nللمساعدة تواصل مع مدير البوت : @iomarsamara",
+                "help": "للأستفسار والتواصل /n/n @iomarsamara ℹ️",
+                "subscribe_success": "✅ تم التحقق من اشتراكك بنجاح!",
+                "subscribe_failed": "❌ لم يتم التحقق من اشتراكك بعد!"
             },
-            REQUESTS_FILE: []
-        }
-        
-        for file_path, default_content in default_data.items():
-            if not os.path.exists(file_path):
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    json.dump(default_content, f, ensure_ascii=False, indent=2)
+            "forwarding": {
+                "enabled": True,  # تفعيل التحويل افتراضياً
+                # "immediate": رسالة لكل إجراء (كما كان دائماً)، "digest": تجميعها في ملخص دوري
+                "mode": "immediate",
+                # إجراءات تحول فوراً حتى في وضع الملخص
+                "immediate_actions": list(FORWARD_IMMEDIATE_ACTIONS)
+            }
+        },
+        REQUESTS_FILE: []
+    }
+
+# القيم الافتراضية للإعدادات وأنواعها، تستخدم لأي إعداد مفقود أو بنوع خاطئ
+DEFAULT_SETTINGS = default_data()[SETTINGS_FILE]
+
+# نطاق أرقام المحتوى: من 6 إلى 8 أرقام
+CONTENT_ID_MIN = 100000
+CONTENT_ID_MAX = 99999999
+# خطوة أولية مع حجم النطاق (99900000 = 2^5 * 3^3 * 5^5 * 37) فتمر على كل الأرقام دون تكرار
+CONTENT_ID_STRIDE = 48271
+
+def allocate_content_id(taken):
+    """توليد رقم محتوى غير مستخدم.
+
+    taken أي حاوية تدعم `in` و len (مثل فهرس المحتوى). نجرب أرقاماً عشوائية أولاً،
+    وإذا ازدحم النطاق نمر عليه بترتيب مبعثر يبدأ من نقطة عشوائية، فالبحث ينتهي دائماً.
+    """
+    span = CONTENT_ID_MAX - CONTENT_ID_MIN + 1
+    if len(taken) >= span:
+        raise RuntimeError("content id space is exhausted")
+    
+    for _ in range(16):
+        new_id = random.randint(CONTENT_ID_MIN, CONTENT_ID_MAX)
+        if new_id not in taken:
+            return new_id
+    
+    start = random.randrange(span)
+    for i in range(span):
+        new_id = CONTENT_ID_MIN + (start + i * CONTENT_ID_STRIDE) % span
+        if new_id not in taken:
+            return new_id
+    raise RuntimeError("content id space is exhausted")
+
+# === صيغ ملفات البيانات ===
+# ملفات JSON تكتب كما هي بلا رأس حتى تبقى JSON صالحاً للتعديل اليدوي والأدوات الأخرى،
+# والصيغ الأخرى تبدأ بسطر رأس مثل "%TBDB msgpack" فتتعرف القراءة على الصيغة تلقائياً
+FORMAT_HEADER_PREFIX = b"%TBDB "
+
+def _json_dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _json_dumps_pretty(data):
+    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+def _json_loads(payload):
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+class Serializer:
+    """ترميز وفك ترميز مستند بيانات كامل"""
+
+    def __init__(self, format_name, dumps, loads):
+        # format_name هو ما يكتب في رأس الملف ويحدد طريقة القراءة
+        self.format_name = format_name
+        self.dumps = dumps
+        self.loads = loads
+
+    def encode(self, data):
+        if self.format_name == "json":
+            return self.dumps(data)
+        return FORMAT_HEADER_PREFIX + self.format_name.encode('ascii') + b"\n" + self.dumps(data)
+
+def get_serializer(name):
+    """إرجاع الصيغة المطلوبة، أو ValueError إذا كانت غير معروفة أو مكتبتها غير مثبتة"""
+    if name == "json":
+        return Serializer("json", _json_dumps, _json_loads)
+    if name == "json-pretty":
+        return Serializer("json", _json_dumps_pretty, _json_loads)
+    if name == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack format requires the msgpack package")
+        return Serializer(
+            "msgpack",
+            lambda data: msgpack.packb(data, use_bin_type=True),
+            lambda payload: msgpack.unpackb(payload, raw=False)
+        )
+    raise ValueError(f"Unknown data format '{name}'")
+
+def decode_document(raw):
+    """فك ترميز ملف بيانات حسب رأسه، والملفات بدون رأس (JSON) تقرأ كـ JSON"""
+    if raw.startswith(FORMAT_HEADER_PREFIX):
+        header, _, payload = raw.partition(b"\n")
+        format_name = header[len(FORMAT_HEADER_PREFIX):].decode('ascii').strip()
+        return get_serializer(format_name).loads(payload)
+    return _json_loads(raw)
+
+# === تحويل المستندات إلى صفوف (لنقل البيانات بين المحركات) ===
+def flatten_settings(settings, prefix=""):
+    """الإعدادات المتداخلة كمسارات نقطية: ("subscription.enabled", True)"""
+    for key, value in settings.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            yield from flatten_settings(value, path + ".")
+        else:
+            yield path, value
+
+def document_to_rows(name, document):
+    """صفوف مجموعة البيانات name كقواميس مستقلة، بنفس الشكل في كل المحركات"""
+    if name == "users":
+        for user_id, user in document.items():
+            yield {"user_id": str(user_id), **user}
+    elif name == "settings":
+        for key, value in flatten_settings(document):
+            yield {"key": key, "value": value}
+    elif name == "subscription_channels":
+        for channel in document.get("channels", []):
+            yield {"channel": channel}
+    elif name == "requests":
+        yield from document
+    else:
+        yield from document.get(name, [])
+
+def rows_to_document(name, rows):
+    """عكس document_to_rows: بناء المستند الكامل من صفوفه"""
+    if name == "users":
+        return {str(row["user_id"]): {key: value for key, value in row.items() if key != "user_id"} for row in rows}
+    if name == "settings":
+        settings = {}
+        for row in rows:
+            keys = row["key"].split('.')
+            current = settings
+            for key in keys[:-1]:
+                current = current.setdefault(key, {})
+            current[keys[-1]] = row["value"]
+        return settings
+    if name == "subscription_channels":
+        return {"channels": [row["channel"] for row in rows]}
+    if name == "requests":
+        return list(rows)
+    return {name: list(rows)}
+
+class StorageBackend(ABC):
+    """الواجهة التي يلتزم بها كل محرك تخزين، ويستدعيها BotDatabase دون معرفة المحرك الفعلي.
+
+    كل مجموعة بيانات لها اسم من DATA_FILES، ويمكن قراءتها وكتابتها كمستند كامل
+    (read_json / write_json) أو كصفوف (export_rows / import_rows) عند النقل بين المحركات.
+    المحرك الذي ينقصه أي دالة مجردة يفشل عند إنشائه، لا عند أول استدعاء.
+    """
+
+    name = None
+    # الفاصل بين مرات الحفظ المؤجل، و0 يعني أن كل تعديل يحفظ فوراً
+    flush_interval_ms = 0
+    # هل يمكن استدعاء المحرك من عدة خيوط معاً لمجموعات بيانات مختلفة (قفل لكل ملف)،
+    # أم يجب أن تنفذ كل استدعاءاته واحداً تلو الآخر
+    per_file_locking = False
+
+    @abstractmethod
+    def init_default_data(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_json(self, file_path):
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_json(self, file_path, data):
+        raise NotImplementedError
+
+    @abstractmethod
+    def flush(self, file_paths=None):
+        """حفظ التعديلات المؤجلة للملفات file_paths (أو كلها)"""
+        raise NotImplementedError
+
+    def document_signature(self, file_path):
+        """بصمة تتغير إذا عدل المستند من خارج البوت، أو None إن لم يمكن اكتشاف ذلك"""
+        return None
+
+    def close(self):
+        self.flush()
+
+    def export_rows(self, name):
+        """صفوف المجموعة name واحداً تلو الآخر"""
+        return document_to_rows(name, copy.deepcopy(self.read_json(DATA_FILES[name])))
+
+    def import_rows(self, name, rows, batch_size=MIGRATE_BATCH_SIZE):
+        """استبدال المجموعة name بالصفوف المعطاة"""
+        self.write_json(DATA_FILES[name], rows_to_document(name, rows))
+
+    def count_rows(self, name):
+        return sum(1 for _ in document_to_rows(name, self.read_json(DATA_FILES[name])))
+
+    # === حالة المحادثات و user_data ===
+    @abstractmethod
+    def load_sessions(self):
+        """كل البيانات المحفوظة: النوع -> {المفتاح: القيمة}"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_sessions(self, changes):
+        """حفظ التغييرات فقط: {(النوع، المفتاح): القيمة، أو None للحذف}"""
+        raise NotImplementedError
+
+    # === العمليات على الصفوف ===
+    @abstractmethod
+    def get_setting(self, key_path):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_setting(self, key_path, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_user(self, user_id, username, first_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_user(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_users(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def approve_user(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_user(self, user_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_pending_requests(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_approved_users(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def generate_content_id(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_content(self, title, content_type, text_content="", file_id="", content_id=None, rendered=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_content_by_id(self, content_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_all_content(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_content(self, content_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_channel(self, name, link):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_channels(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_channel(self, channel_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_subscription_channels(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_subscription_channel(self, channel):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_subscription_channel(self, channel_index):
+        raise NotImplementedError
+
+class JsonStorage(StorageBackend):
+    """تخزين البيانات في ملفات داخل DATA_DIR (JSON افتراضياً، أو أي صيغة من get_serializer)"""
+
+    name = "json"
+    # كل ملف مستقل بذاكرته المؤقتة، فيكفي قفل الملفات التي يلمسها كل استدعاء
+    per_file_locking = True
+
+    def __init__(self, flush_interval_ms=0, flush_max_changes=1, serializer=None):
+        self.serializer = serializer or get_serializer("json")
+        # نسخة من كل ملف بيانات في الذاكرة: المسار -> (بصمة الملف، البيانات)
+        self._cache = {}
+        # الملفات المعدلة في الذاكرة ولم تحفظ على القرص بعد
+        self._dirty = set()
+        self._pending_changes = 0
+        self.flush_interval_ms = flush_interval_ms
+        self.flush_max_changes = flush_max_changes
+        # فهرس المحتوى: الرقم -> العنصر، مبني من نسخة content.json الحالية في الذاكرة
+        self._content_index = {}
+        self._content_index_source = None
+        # طلبات الانضمام المعلقة كما أعيد بناؤها من السجل: user_id -> قائمة الطلبات
+        self._requests = None
+        self._requests_log_lines = 0
+        self._requests_live = 0
+        # sessions.jsonl كما أعيد بناؤه: (النوع، المفتاح) -> القيمة
+        self._sessions = None
+        self._sessions_log_lines = 0
+
+    def init_default_data(self):
+        for file_path, default_content in default_data().items():
+            if file_path == REQUESTS_FILE:
+                continue
+            if not self._document_exists(file_path):
+                self._atomic_write(file_path, default_content)
+        # بناء طلبات الانضمام من السجل مرة واحدة عند التشغيل
+        self._load_requests()
+
+    def _document_exists(self, file_path):
+        return os.path.exists(file_path)
+
+    def _load_document(self, file_path):
+        with open(file_path, 'rb') as f:
+            return decode_document(f.read())
+
+    def _atomic_write(self, file_path, data):
+        """كتابة الملف في ملف مؤقت ثم استبداله، فلا يبقى الملف الأصلي فارغاً إذا توقف البوت أثناء الكتابة"""
+        self._atomic_write_bytes(file_path, self.serializer.encode(data))
 
     @staticmethod
-    def read_json(file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            if "settings" in file_path:
-                return {}
-            elif "content" in file_path:
-                return {"content": []}
-            elif "channels" in file_path:
-                return {"channels": []}
-            elif "subscription_channels" in file_path:
-                return {"channels": []}
-            elif "requests" in file_path:
-                return []
-            else:
-                return {}
+    def _atomic_write_text(file_path, text):
+        JsonStorage._atomic_write_bytes(file_path, text.encode('utf-8'))
 
     @staticmethod
-    def write_json(file_path, data):
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    def _atomic_write_bytes(file_path, payload):
+        directory = os.path.dirname(file_path) or "."
+        fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def document_signature(self, file_path):
+        if file_path in self._dirty:
+            # النسخة في الذاكرة أحدث من القرص حتى يتم الحفظ
+            return None
+        return self._file_signature(file_path)
 
     @staticmethod
-    def get_setting(key_path):
-        settings = BotDatabase.read_json(SETTINGS_FILE)
+    def _file_signature(file_path):
+        """بصمة الملف (وقت التعديل والحجم) لاكتشاف التعديلات الخارجية"""
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def read_json(self, file_path):
+        """قراءة ملف بيانات مع الاحتفاظ بنسخة في الذاكرة.
+
+        الكائن المعاد مشترك مع الذاكرة المؤقتة، لذلك أي تعديل عليه يجب أن
+        يتبعه استدعاء write_json لنفس الملف.
+        """
+        if file_path == REQUESTS_FILE:
+            return self.get_requests()
+        
+        cached = self._cache.get(file_path)
+        if file_path in self._dirty:
+            # النسخة في الذاكرة أحدث من القرص حتى يتم الحفظ
+            return cached[1]
+        
+        signature = self._file_signature(file_path)
+        if cached is not None and signature is not None and cached[0] == signature:
+            return cached[1]
+        
+        try:
+            data = self._load_document(file_path)
+            self._cache[file_path] = (signature, data)
+            return data
+        except (FileNotFoundError, ValueError):
+            self._cache.pop(file_path, None)
+            return empty_document(file_path)
+
+    def write_json(self, file_path, data):
+        if file_path == REQUESTS_FILE:
+            self._rewrite_requests_log(data)
+            return
+        
+        if self.flush_interval_ms <= 0:
+            self._atomic_write(file_path, data)
+            # الكتابة تمر عبر الذاكرة المؤقتة حتى لا نعيد قراءة ما كتبناه للتو
+            self._cache[file_path] = (self._file_signature(file_path), data)
+            return
+        
+        # وضع الكتابة المؤجلة: نحدث الذاكرة فقط ونترك الحفظ لـ flush
+        self._cache[file_path] = (None, data)
+        self._dirty.add(file_path)
+        self._pending_changes += 1
+        if self._pending_changes >= self.flush_max_changes:
+            # هذا الملف فقط: الخيط لا يملك أقفال الملفات الأخرى، وهي تحفظ مع الحفظ الدوري
+            self.flush((file_path,))
+
+    def flush(self, file_paths=None):
+        """حفظ الملفات المعدلة (من file_paths، أو كلها) على القرص"""
+        for file_path in list(self._dirty):
+            if file_paths is not None and file_path not in file_paths:
+                continue
+            self._dirty.discard(file_path)
+            data = self._cache[file_path][1]
+            try:
+                self._atomic_write(file_path, data)
+            except Exception:
+                self._dirty.add(file_path)
+                raise
+            self._cache[file_path] = (self._file_signature(file_path), data)
+        self._pending_changes = 0
+
+    def get_setting(self, key_path):
+        settings = self.read_json(SETTINGS_FILE)
         keys = key_path.split('.')
         value = settings
         for key in keys:
@@ -119,62 +658,241 @@ class BotDatabase:
                 value = {}
         return value
 
-    @staticmethod
-    def set_setting(key_path, value):
-        settings = BotDatabase.read_json(SETTINGS_FILE)
+    def set_setting(self, key_path, value):
+        settings = self.read_json(SETTINGS_FILE)
         keys = key_path.split('.')
         current = settings
         for key in keys[:-1]:
             current = current.setdefault(key, {})
         current[keys[-1]] = value
-        BotDatabase.write_json(SETTINGS_FILE, settings)
+        self.write_json(SETTINGS_FILE, settings)
 
-    @staticmethod
-    def add_user(user_id, username, first_name):
-        users = BotDatabase.read_json(USERS_FILE)
+    def add_user(self, user_id, username, first_name):
+        users = self.read_json(USERS_FILE)
         users[str(user_id)] = {
             "username": username,
             "first_name": first_name,
             "join_date": datetime.now().isoformat(),
             "approved": False
         }
-        BotDatabase.write_json(USERS_FILE, users)
+        self.write_json(USERS_FILE, users)
         
-        requests = BotDatabase.read_json(REQUESTS_FILE)
-        requests.append({
+        self._append_request_records([{
+            "op": "add",
             "user_id": str(user_id),
             "username": username,
             "first_name": first_name,
             "date": datetime.now().isoformat()
-        })
-        BotDatabase.write_json(REQUESTS_FILE, requests)
+        }])
+
+    def get_user(self, user_id):
+        return self.read_json(USERS_FILE).get(str(user_id))
+
+    def get_users(self):
+        return self.read_json(USERS_FILE)
+
+    # === سجل طلبات الانضمام ===
+    def _load_requests(self):
+        """إعادة بناء الطلبات المعلقة من السجل (مرة واحدة فقط)"""
+        if self._requests is not None:
+            return self._requests
+        
+        self._requests = {}
+        self._requests_log_lines = 0
+        self._requests_live = 0
+        
+        if self._migrate_legacy_requests():
+            return self._requests
+        
+        for line in self._read_log_lines(REQUESTS_LOG_FILE):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # سطر ناقص من كتابة توقفت في منتصفها
+                logger.warning(f"Skipping corrupt line in {REQUESTS_LOG_FILE}")
+                continue
+            self._apply_request_record(record)
+        
+        self._maybe_compact_requests()
+        return self._requests
+
+    def _migrate_legacy_requests(self):
+        """تحويل ملف requests.json القديم إلى السجل إن وجد"""
+        if os.path.exists(REQUESTS_LOG_FILE) or not os.path.exists(REQUESTS_FILE):
+            return False
+        
+        try:
+            with open(REQUESTS_FILE, 'r', encoding='utf-8') as f:
+                legacy_requests = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            legacy_requests = []
+        self._rewrite_requests_log(legacy_requests)
+        os.replace(REQUESTS_FILE, REQUESTS_FILE + ".bak")
+        return True
+
+    def _read_log_lines(self, log_path):
+        try:
+            with open(log_path, 'r', encoding='utf-8') as f:
+                return f.readlines()
+        except FileNotFoundError:
+            return []
+
+    def _append_log_lines(self, log_path, lines):
+        with open(log_path, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    def _replace_log_lines(self, log_path, lines):
+        self._atomic_write_text(log_path, "".join(lines))
+
+    def _apply_request_record(self, record):
+        user_id = str(record.get("user_id"))
+        self._requests_log_lines += 1
+        if record.get("op") == "remove":
+            self._requests_live -= len(self._requests.pop(user_id, ()))
+        else:
+            self._requests.setdefault(user_id, []).append({
+                "user_id": user_id,
+                "username": record.get("username"),
+                "first_name": record.get("first_name"),
+                "date": record.get("date")
+            })
+            self._requests_live += 1
+
+    def _append_request_records(self, records):
+        self._load_requests()
+        self._append_log_lines(REQUESTS_LOG_FILE, [json.dumps(record, ensure_ascii=False) + "\n" for record in records])
+        for record in records:
+            self._apply_request_record(record)
+        self._maybe_compact_requests()
+
+    def _rewrite_requests_log(self, requests):
+        """استبدال السجل كاملاً بالطلبات المعطاة (تستخدم للضغط والاستعادة)"""
+        lines = [
+            json.dumps({"op": "add", **request}, ensure_ascii=False) + "\n"
+            for request in requests
+        ]
+        self._replace_log_lines(REQUESTS_LOG_FILE, lines)
+        self._requests = {}
+        self._requests_log_lines = 0
+        self._requests_live = 0
+        for request in requests:
+            self._apply_request_record(request)
+
+    def _maybe_compact_requests(self):
+        dead_lines = self._requests_log_lines - self._requests_live
+        if dead_lines > max(REQUESTS_LOG_COMPACT_MIN, self._requests_live):
+            self.compact_requests()
+
+    def compact_requests(self):
+        """إعادة كتابة السجل بالطلبات الحية فقط وحذف الأسطر الملغاة"""
+        self._rewrite_requests_log(self.get_requests())
+
+    def get_requests(self):
+        return [request for requests in self._load_requests().values() for request in requests]
+
+    def _remove_requests(self, user_id):
+        if user_id in self._load_requests():
+            self._append_request_records([{"op": "remove", "user_id": user_id}])
+
+    # === سجل حالة المحادثات و user_data ===
+    def _load_session_log(self):
+        if self._sessions is not None:
+            return self._sessions
+        
+        self._sessions = {}
+        self._sessions_log_lines = 0
+        for line in self._read_log_lines(SESSIONS_LOG_FILE):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping corrupt line in {SESSIONS_LOG_FILE}")
+                continue
+            self._apply_session_record(record)
+        return self._sessions
+
+    def _apply_session_record(self, record):
+        self._sessions_log_lines += 1
+        key = (record["kind"], record["key"])
+        if record.get("value") is None:
+            self._sessions.pop(key, None)
+        else:
+            self._sessions[key] = record["value"]
 
     @staticmethod
-    def get_pending_requests():
-        users = BotDatabase.read_json(USERS_FILE)
+    def _session_line(kind, key, value):
+        return json.dumps({"kind": kind, "key": key, "value": value}, ensure_ascii=False) + "\n"
+
+    def load_sessions(self):
+        sessions = {}
+        for (kind, key), value in self._load_session_log().items():
+            sessions.setdefault(kind, {})[key] = value
+        return sessions
+
+    def save_sessions(self, changes):
+        """إضافة التغييرات لآخر السجل، وإعادة كتابته عندما تكثر الأسطر القديمة"""
+        self._load_session_log()
+        lines = []
+        for (kind, key), value in changes.items():
+            record = {"kind": kind, "key": key, "value": value}
+            lines.append(self._session_line(kind, key, value))
+            self._apply_session_record(record)
+        self._append_log_lines(SESSIONS_LOG_FILE, lines)
+        
+        live = len(self._sessions)
+        if self._sessions_log_lines - live > max(REQUESTS_LOG_COMPACT_MIN, live):
+            self._replace_log_lines(SESSIONS_LOG_FILE, [
+                self._session_line(kind, key, value) for (kind, key), value in self._sessions.items()
+            ])
+            self._sessions_log_lines = live
+
+    def approve_user(self, user_id):
+        users = self.read_json(USERS_FILE)
+        user_id = str(user_id)
+        if user_id not in users:
+            return None
+        
+        users[user_id]["approved"] = True
+        self.write_json(USERS_FILE, users)
+        self._remove_requests(user_id)
+        return users[user_id]
+
+    def remove_user(self, user_id):
+        users = self.read_json(USERS_FILE)
+        user_id = str(user_id)
+        if user_id not in users:
+            return None
+        
+        user_data = users.pop(user_id)
+        self.write_json(USERS_FILE, users)
+        self._remove_requests(user_id)
+        return user_data
+
+    def get_pending_requests(self):
+        users = self.read_json(USERS_FILE)
         return [user_id for user_id, data in users.items() if not data.get('approved', False)]
 
-    @staticmethod
-    def get_approved_users():
-        users = BotDatabase.read_json(USERS_FILE)
+    def get_approved_users(self):
+        users = self.read_json(USERS_FILE)
         return [user_id for user_id, data in users.items() if data.get('approved', False)]
 
-    @staticmethod
-    def generate_content_id():
+    def _get_content_index(self):
+        """فهرس المحتوى، ويعاد بناؤه فقط إذا أعيدت قراءة content.json أو استبدل بالكامل"""
+        content_data = self.read_json(CONTENT_FILE)
+        if self._content_index_source is not content_data:
+            self._content_index = {item.get('id'): item for item in content_data.get("content", [])}
+            self._content_index_source = content_data
+        return self._content_index
+
+    def generate_content_id(self):
         """توليد رقم فريد مكون من 6-8 أرقام"""
-        content_data = BotDatabase.read_json(CONTENT_FILE)
-        existing_ids = [item.get('id', 0) for item in content_data.get('content', [])]
-        
-        while True:
-            # توليد رقم بين 100000 و 99999999 (6-8 أرقام)
-            new_id = random.randint(100000, 99999999)
-            if new_id not in existing_ids:
-                return new_id
+        return allocate_content_id(self._get_content_index())
 
     # === دوال قنوات البوت العادية ===
-    @staticmethod
-    def add_channel(name, link):
-        channels_data = BotDatabase.read_json(CHANNELS_FILE)
+    def add_channel(self, name, link):
+        channels_data = self.read_json(CHANNELS_FILE)
         new_id = max([ch.get('id', 0) for ch in channels_data.get("channels", [])] or [0]) + 1
         
         new_channel = {
@@ -185,17 +903,15 @@ class BotDatabase:
         }
         
         channels_data["channels"].append(new_channel)
-        BotDatabase.write_json(CHANNELS_FILE, channels_data)
+        self.write_json(CHANNELS_FILE, channels_data)
         return new_id
 
-    @staticmethod
-    def get_channels():
-        channels_data = BotDatabase.read_json(CHANNELS_FILE)
+    def get_channels(self):
+        channels_data = self.read_json(CHANNELS_FILE)
         return channels_data.get("channels", [])
 
-    @staticmethod
-    def delete_channel(channel_id):
-        channels_data = BotDatabase.read_json(CHANNELS_FILE)
+    def delete_channel(self, channel_id):
+        channels_data = self.read_json(CHANNELS_FILE)
         channels = channels_data.get("channels", [])
         
         channel_to_delete = None
@@ -206,50 +922,46 @@ class BotDatabase:
         
         if channel_to_delete:
             channels_data["channels"] = [ch for ch in channels if ch['id'] != channel_id]
-            BotDatabase.write_json(CHANNELS_FILE, channels_data)
+            self.write_json(CHANNELS_FILE, channels_data)
             return channel_to_delete
         
         return None
 
     # === دوال قنوات الاشتراك الإجباري ===
-    @staticmethod
-    def get_subscription_channels():
+    def get_subscription_channels(self):
         """الحصول على قنوات الاشتراك الإجباري"""
-        subscription_data = BotDatabase.read_json(SUBSCRIPTION_CHANNELS_FILE)
+        subscription_data = self.read_json(SUBSCRIPTION_CHANNELS_FILE)
         return subscription_data.get("channels", [])
 
-    @staticmethod
-    def add_subscription_channel(channel):
+    def add_subscription_channel(self, channel):
         """إضافة قناة للاشتراك الإجباري"""
-        subscription_data = BotDatabase.read_json(SUBSCRIPTION_CHANNELS_FILE)
+        subscription_data = self.read_json(SUBSCRIPTION_CHANNELS_FILE)
         channels = subscription_data.get("channels", [])
         
         if channel not in channels:
             channels.append(channel)
             subscription_data["channels"] = channels
-            BotDatabase.write_json(SUBSCRIPTION_CHANNELS_FILE, subscription_data)
+            self.write_json(SUBSCRIPTION_CHANNELS_FILE, subscription_data)
             return True
         return False
 
-    @staticmethod
-    def delete_subscription_channel(channel_index):
+    def delete_subscription_channel(self, channel_index):
         """حذف قناة من الاشتراك الإجباري"""
-        subscription_data = BotDatabase.read_json(SUBSCRIPTION_CHANNELS_FILE)
+        subscription_data = self.read_json(SUBSCRIPTION_CHANNELS_FILE)
         channels = subscription_data.get("channels", [])
         
         if 0 <= channel_index < len(channels):
             deleted_channel = channels.pop(channel_index)
             subscription_data["channels"] = channels
-            BotDatabase.write_json(SUBSCRIPTION_CHANNELS_FILE, subscription_data)
+            self.write_json(SUBSCRIPTION_CHANNELS_FILE, subscription_data)
             return deleted_channel
         return None
 
-    @staticmethod
-    def add_content(title, content_type, text_content="", file_id="", content_id=None):
-        content_data = BotDatabase.read_json(CONTENT_FILE)
+    def add_content(self, title, content_type, text_content="", file_id="", content_id=None, rendered=None):
+        content_data = self.read_json(CONTENT_FILE)
         
         if content_id is None:
-            content_id = BotDatabase.generate_content_id()
+            content_id = self.generate_content_id()
         
         new_content = {
             "id": content_id,
@@ -257,75 +969,2444 @@ class BotDatabase:
             "content_type": content_type,
             "text_content": text_content,
             "file_id": file_id,
-            "created_date": datetime.now().isoformat()
+            "created_date": datetime.now().isoformat(),
+            "rendered": rendered
         }
         
-        content_data["content"].append(new_content)
-        BotDatabase.write_json(CONTENT_FILE, content_data)
+        content_data.setdefault("content", []).append(new_content)
+        self._get_content_index()[content_id] = new_content
+        self.write_json(CONTENT_FILE, content_data)
         return new_content
 
-    @staticmethod
-    def get_content_by_id(content_id):
-        content_data = BotDatabase.read_json(CONTENT_FILE)
-        for item in content_data.get("content", []):
-            if item['id'] == content_id:
-                return item
-        return None
+    def get_content_by_id(self, content_id):
+        return self._get_content_index().get(content_id)
+
+    def get_all_content(self):
+        content_data = self.read_json(CONTENT_FILE)
+        return content_data.get("content", [])
+
+    def delete_content(self, content_id):
+        content_index = self._get_content_index()
+        content_to_delete = content_index.pop(content_id, None)
+        
+        if content_to_delete:
+            content_data = self._content_index_source
+            content_data["content"] = [item for item in content_data.get("content", []) if item is not content_to_delete]
+            self.write_json(CONTENT_FILE, content_data)
+            return content_to_delete
+        
+        return None
+
+class MemoryStorage(JsonStorage):
+    """تخزين كل البيانات في الذاكرة فقط، ولا يبقى منها شيء بعد إعادة التشغيل.
+
+    يفيد في التجربة والتحقق من النقل (python bot.py migrate json memory)، ويعيد
+    استخدام منطق JsonStorage كاملاً مع استبدال الملفات بقواميس وقوائم.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._documents = {}
+        self._document_versions = {}
+        # مسار السجل -> أسطره
+        self._log_lines = {}
+
+    def _document_exists(self, file_path):
+        return file_path in self._documents
+
+    def _load_document(self, file_path):
+        try:
+            return self._documents[file_path]
+        except KeyError:
+            raise FileNotFoundError(file_path) from None
+
+    def _atomic_write(self, file_path, data):
+        self._documents[file_path] = data
+        self._document_versions[file_path] = self._document_versions.get(file_path, 0) + 1
+
+    def _file_signature(self, file_path):
+        return self._document_versions.get(file_path)
+
+    def _migrate_legacy_requests(self):
+        return False
+
+    def _read_log_lines(self, log_path):
+        return list(self._log_lines.get(log_path, []))
+
+    def _append_log_lines(self, log_path, lines):
+        self._log_lines.setdefault(log_path, []).extend(lines)
+
+    def _replace_log_lines(self, log_path, lines):
+        self._log_lines[log_path] = list(lines)
+
+class SQLiteStorage(StorageBackend):
+    """تخزين البيانات في قاعدة SQLite (وضع WAL) بجداول حقيقية بدلاً من ملفات JSON"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            join_date TEXT,
+            approved INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_approved ON users (approved);
+
+        CREATE TABLE IF NOT EXISTS requests (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            date TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_requests_user_id ON requests (user_id);
+
+        -- العمود id هو مفتاح الصف نفسه في SQLite، فالبحث به لا يحتاج فهرساً إضافياً
+        CREATE TABLE IF NOT EXISTS content (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            content_type TEXT,
+            text_content TEXT,
+            file_id TEXT,
+            created_date TEXT,
+            rendered TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            link TEXT,
+            created_date TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS subscription_channels (
+            position INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL UNIQUE
+        );
+
+        -- الإعدادات مخزنة كمسارات نقطية (subscription.enabled) وقيم JSON
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+
+        -- حالة المحادثات و user_data، صف لكل (نوع، مفتاح) وقيمة JSON
+        CREATE TABLE IF NOT EXISTS sessions (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID;
+    """
+
+    name = "sqlite"
+    # لا توجد كتابة مؤجلة في SQLite
+    flush_interval_ms = 0
+
+    CONTENT_COLUMNS = ("id", "title", "content_type", "text_content", "file_id", "created_date", "rendered")
+    CHANNEL_COLUMNS = ("id", "name", "link", "created_date")
+    # أعمدة كل جدول بالترتيب المستخدم في الإدخال، وترتيب قراءة صفوفه
+    TABLE_COLUMNS = {
+        "users": ("user_id", "username", "first_name", "join_date", "approved"),
+        "content": CONTENT_COLUMNS,
+        "channels": CHANNEL_COLUMNS,
+        "subscription_channels": ("channel",),
+        "settings": ("key", "value"),
+        "requests": ("user_id", "username", "first_name", "date"),
+    }
+    TABLE_ORDER = {
+        "users": "rowid",
+        "content": "rowid",
+        "channels": "id",
+        "subscription_channels": "position",
+        "settings": "key",
+        "requests": "seq",
+    }
+
+    # أكبر عدد صحيح تقبله SQLite؛ ربط رقم أكبر منه يرفع OverflowError بدلاً من "غير موجود"
+    MAX_INTEGER = 2 ** 63 - 1
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = None
+
+    @staticmethod
+    def _valid_id(value):
+        return -SQLiteStorage.MAX_INTEGER - 1 <= value <= SQLiteStorage.MAX_INTEGER
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+            self._upgrade_schema()
+        return self._conn
+
+    def _upgrade_schema(self):
+        """إضافة الأعمدة الجديدة لقواعد أنشئت قبلها (CREATE TABLE IF NOT EXISTS لا يعدل جدولاً موجوداً)"""
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(content)")}
+        if "rendered" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE content ADD COLUMN rendered TEXT")
+
+    def init_default_data(self):
+        # user_version = 0 يعني قاعدة جديدة لم تملأ بالبيانات الافتراضية بعد
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            defaults = default_data()
+            with self.conn:
+                for file_path in (SUBSCRIPTION_CHANNELS_FILE, SETTINGS_FILE):
+                    self._replace_document(file_path, defaults[file_path])
+                self.conn.execute("PRAGMA user_version = 1")
+
+    # === تحويل الإعدادات من المسارات النقطية إلى الشكل المتداخل ===
+    @staticmethod
+    def _unflatten_settings(rows):
+        settings = {}
+        for key_path, value in rows:
+            keys = key_path.split('.')
+            current = settings
+            for key in keys[:-1]:
+                current = current.setdefault(key, {})
+            current[keys[-1]] = json.loads(value)
+        return settings
+
+    @staticmethod
+    def _user_from_row(row):
+        return {
+            "username": row["username"],
+            "first_name": row["first_name"],
+            "join_date": row["join_date"],
+            "approved": bool(row["approved"])
+        }
+
+    # === قراءة وكتابة ملف كامل (للنسخ الاحتياطي والاستعادة) ===
+    def read_json(self, file_path):
+        if file_path == USERS_FILE:
+            return self.get_users()
+        if file_path == CONTENT_FILE:
+            return {"content": self.get_all_content()}
+        if file_path == CHANNELS_FILE:
+            return {"channels": self.get_channels()}
+        if file_path == SUBSCRIPTION_CHANNELS_FILE:
+            return {"channels": self.get_subscription_channels()}
+        if file_path == SETTINGS_FILE:
+            rows = self.conn.execute("SELECT key, value FROM settings").fetchall()
+            return self._unflatten_settings((row["key"], row["value"]) for row in rows)
+        if file_path == REQUESTS_FILE:
+            rows = self.conn.execute(
+                "SELECT user_id, username, first_name, date FROM requests ORDER BY seq"
+            ).fetchall()
+            return [dict(row) for row in rows]
+        return {}
+
+    def write_json(self, file_path, data):
+        with self.conn:
+            self._replace_document(file_path, data)
+
+    def flush(self, file_paths=None):
+        # كل تعديل في SQLite يحفظ مباشرة عند انتهاء المعاملة
+        pass
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _replace_document(self, file_path, data):
+        name = DATA_FILE_NAMES[file_path]
+        self._replace_rows(name, document_to_rows(name, data))
+
+    # === النقل بين المحركات صفاً صفاً ===
+    @staticmethod
+    def _row_values(name, row):
+        if name == "users":
+            return (str(row["user_id"]), row.get("username"), row.get("first_name"), row.get("join_date"),
+                    int(bool(row.get("approved", False))))
+        if name == "settings":
+            return (row["key"], json.dumps(row["value"], ensure_ascii=False))
+        if name == "content":
+            row = {**row, "rendered": SQLiteStorage._rendered_to_db(row.get("rendered"))}
+        return tuple(row.get(column) for column in SQLiteStorage.TABLE_COLUMNS[name])
+
+    @staticmethod
+    def _row_from_db(name, row):
+        if name == "users":
+            return {"user_id": row["user_id"], **SQLiteStorage._user_from_row(row)}
+        if name == "settings":
+            return {"key": row["key"], "value": json.loads(row["value"])}
+        if name == "content":
+            return SQLiteStorage._content_from_row(row)
+        return dict(row)
+
+    def _replace_rows(self, name, rows, batch_size=MIGRATE_BATCH_SIZE):
+        """حذف صفوف الجدول وإدخال الصفوف الجديدة على دفعات، داخل معاملة المستدعي"""
+        columns = self.TABLE_COLUMNS[name]
+        # قناة الاشتراك المكررة تتجاهل كما في add_subscription_channel
+        verb = "INSERT OR IGNORE" if name == "subscription_channels" else "INSERT"
+        sql = f"{verb} INTO {name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        
+        self.conn.execute(f"DELETE FROM {name}")
+        batch = []
+        for row in rows:
+            batch.append(self._row_values(name, row))
+            if len(batch) >= batch_size:
+                self.conn.executemany(sql, batch)
+                batch = []
+        if batch:
+            self.conn.executemany(sql, batch)
+
+    def export_rows(self, name, batch_size=MIGRATE_BATCH_SIZE):
+        columns = ", ".join(self.TABLE_COLUMNS[name])
+        cursor = self.conn.execute(f"SELECT {columns} FROM {name} ORDER BY {self.TABLE_ORDER[name]}")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield self._row_from_db(name, row)
+
+    def import_rows(self, name, rows, batch_size=MIGRATE_BATCH_SIZE):
+        with self.conn:
+            self._replace_rows(name, rows, batch_size)
+
+    def count_rows(self, name):
+        return self.conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+
+    # === حالة المحادثات و user_data ===
+    def load_sessions(self):
+        sessions = {}
+        for row in self.conn.execute("SELECT kind, key, value FROM sessions"):
+            sessions.setdefault(row["kind"], {})[row["key"]] = json.loads(row["value"])
+        return sessions
+
+    def save_sessions(self, changes):
+        deleted = [(kind, key) for (kind, key), value in changes.items() if value is None]
+        updated = [
+            (kind, key, json.dumps(value, ensure_ascii=False))
+            for (kind, key), value in changes.items() if value is not None
+        ]
+        with self.conn:
+            self.conn.executemany("DELETE FROM sessions WHERE kind = ? AND key = ?", deleted)
+            self.conn.executemany("INSERT OR REPLACE INTO sessions (kind, key, value) VALUES (?, ?, ?)", updated)
+
+    # === الإعدادات ===
+    def get_setting(self, key_path):
+        row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key_path,)).fetchone()
+        if row is not None:
+            return json.loads(row["value"])
+        
+        # مسار لقسم كامل مثل "responses"
+        prefix = key_path + "."
+        rows = self.conn.execute(
+            "SELECT key, value FROM settings WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+        ).fetchall()
+        return self._unflatten_settings((row["key"][len(prefix):], row["value"]) for row in rows)
+
+    def set_setting(self, key_path, value):
+        prefix = key_path + "."
+        keys = key_path.split('.')
+        ancestors = ['.'.join(keys[:i]) for i in range(1, len(keys))]
+        
+        if isinstance(value, dict) and value:
+            rows = [(prefix + key, item) for key, item in flatten_settings(value)]
+        else:
+            rows = [(key_path, value)]
+        
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM settings WHERE key = ? OR substr(key, 1, ?) = ?", (key_path, len(prefix), prefix)
+            )
+            self.conn.executemany("DELETE FROM settings WHERE key = ?", [(key,) for key in ancestors])
+            self.conn.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?)",
+                [(key, json.dumps(item, ensure_ascii=False)) for key, item in rows]
+            )
+
+    # === المستخدمين وطلبات الانضمام ===
+    def add_user(self, user_id, username, first_name):
+        now = datetime.now().isoformat()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, username, first_name, join_date, approved) VALUES (?, ?, ?, ?, 0)",
+                (str(user_id), username, first_name, now)
+            )
+            self.conn.execute(
+                "INSERT INTO requests (user_id, username, first_name, date) VALUES (?, ?, ?, ?)",
+                (str(user_id), username, first_name, now)
+            )
+
+    def get_user(self, user_id):
+        row = self.conn.execute("SELECT * FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return self._user_from_row(row) if row is not None else None
+
+    def get_users(self):
+        rows = self.conn.execute("SELECT * FROM users ORDER BY rowid").fetchall()
+        return {row["user_id"]: self._user_from_row(row) for row in rows}
+
+    def approve_user(self, user_id):
+        with self.conn:
+            cursor = self.conn.execute("UPDATE users SET approved = 1 WHERE user_id = ?", (str(user_id),))
+            if cursor.rowcount == 0:
+                return None
+            self.conn.execute("DELETE FROM requests WHERE user_id = ?", (str(user_id),))
+        return self.get_user(user_id)
+
+    def remove_user(self, user_id):
+        user_data = self.get_user(user_id)
+        if user_data is None:
+            return None
+        
+        with self.conn:
+            self.conn.execute("DELETE FROM users WHERE user_id = ?", (str(user_id),))
+            self.conn.execute("DELETE FROM requests WHERE user_id = ?", (str(user_id),))
+        return user_data
+
+    def get_pending_requests(self):
+        rows = self.conn.execute("SELECT user_id FROM users WHERE approved = 0 ORDER BY rowid").fetchall()
+        return [row["user_id"] for row in rows]
+
+    def get_approved_users(self):
+        rows = self.conn.execute("SELECT user_id FROM users WHERE approved = 1 ORDER BY rowid").fetchall()
+        return [row["user_id"] for row in rows]
+
+    # === المحتوى ===
+    class _ContentIds:
+        """أرقام المحتوى المستخدمة كما تراها allocate_content_id، والبحث يتم عبر مفتاح الجدول"""
+
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __contains__(self, content_id):
+            return self.conn.execute("SELECT 1 FROM content WHERE id = ?", (content_id,)).fetchone() is not None
+
+        def __len__(self):
+            return self.conn.execute("SELECT COUNT(*) FROM content").fetchone()[0]
+
+    def generate_content_id(self):
+        """توليد رقم فريد مكون من 6-8 أرقام"""
+        return allocate_content_id(self._ContentIds(self.conn))
+
+    @staticmethod
+    def _rendered_to_db(rendered):
+        return json.dumps(rendered, ensure_ascii=False) if rendered is not None else None
+
+    @staticmethod
+    def _content_from_row(row):
+        content_item = dict(row)
+        if content_item.get("rendered") is not None:
+            content_item["rendered"] = json.loads(content_item["rendered"])
+        return content_item
+
+    def add_content(self, title, content_type, text_content="", file_id="", content_id=None, rendered=None):
+        if content_id is None:
+            content_id = self.generate_content_id()
+        
+        new_content = {
+            "id": content_id,
+            "title": title,
+            "content_type": content_type,
+            "text_content": text_content,
+            "file_id": file_id,
+            "created_date": datetime.now().isoformat(),
+            "rendered": rendered
+        }
+        
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO content (id, title, content_type, text_content, file_id, created_date, rendered) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._row_values("content", new_content)
+            )
+        return new_content
+
+    def get_content_by_id(self, content_id):
+        if not self._valid_id(content_id):
+            return None
+        row = self.conn.execute("SELECT * FROM content WHERE id = ?", (content_id,)).fetchone()
+        return self._content_from_row(row) if row is not None else None
+
+    def get_all_content(self):
+        return [self._content_from_row(row) for row in self.conn.execute("SELECT * FROM content ORDER BY rowid").fetchall()]
+
+    def delete_content(self, content_id):
+        content_item = self.get_content_by_id(content_id)
+        if content_item is None:
+            return None
+        
+        with self.conn:
+            self.conn.execute("DELETE FROM content WHERE id = ?", (content_id,))
+        return content_item
+
+    # === قنوات البوت العادية ===
+    def add_channel(self, name, link):
+        with self.conn:
+            new_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM channels").fetchone()[0]
+            self.conn.execute(
+                "INSERT INTO channels (id, name, link, created_date) VALUES (?, ?, ?, ?)",
+                (new_id, name, link, datetime.now().isoformat())
+            )
+        return new_id
+
+    def get_channels(self):
+        return [dict(row) for row in self.conn.execute("SELECT * FROM channels ORDER BY id").fetchall()]
+
+    def delete_channel(self, channel_id):
+        if not self._valid_id(channel_id):
+            return None
+        row = self.conn.execute("SELECT * FROM channels WHERE id = ?", (channel_id,)).fetchone()
+        if row is None:
+            return None
+        
+        with self.conn:
+            self.conn.execute("DELETE FROM channels WHERE id = ?", (channel_id,))
+        return dict(row)
+
+    # === قنوات الاشتراك الإجباري ===
+    def get_subscription_channels(self):
+        rows = self.conn.execute("SELECT channel FROM subscription_channels ORDER BY position").fetchall()
+        return [row["channel"] for row in rows]
+
+    def add_subscription_channel(self, channel):
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO subscription_channels (channel) VALUES (?)", (channel,)
+            )
+        return cursor.rowcount == 1
+
+    def delete_subscription_channel(self, channel_index):
+        if channel_index < 0 or not self._valid_id(channel_index):
+            return None
+        
+        row = self.conn.execute(
+            "SELECT position, channel FROM subscription_channels ORDER BY position LIMIT 1 OFFSET ?",
+            (channel_index,)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        with self.conn:
+            self.conn.execute("DELETE FROM subscription_channels WHERE position = ?", (row["position"],))
+        return row["channel"]
+
+def configured_storage_engine():
+    """اسم المحرك: متغير البيئة STORAGE_ENGINE أولاً، ثم آخر محرك نقلت إليه البيانات، ثم json"""
+    try:
+        with open(STORAGE_ENGINE_FILE, 'r', encoding='utf-8') as f:
+            migrated_engine = f.read().strip()
+    except OSError:
+        migrated_engine = ""
+    
+    if STORAGE_ENGINE:
+        if migrated_engine and migrated_engine != STORAGE_ENGINE:
+            logger.warning(
+                f"STORAGE_ENGINE is '{STORAGE_ENGINE}' but data was last migrated to '{migrated_engine}'"
+            )
+        return STORAGE_ENGINE
+    return migrated_engine or "json"
+
+def save_storage_engine(name):
+    """تسجيل المحرك الذي نقلت إليه البيانات ليستخدم عند التشغيل التالي"""
+    JsonStorage._atomic_write_text(STORAGE_ENGINE_FILE, name + "\n")
+
+def create_storage_engine(name=None):
+    if name is None:
+        name = configured_storage_engine()
+    if name == "sqlite":
+        return SQLiteStorage(SQLITE_FILE)
+    if name == "memory":
+        return MemoryStorage()
+    if name != "json":
+        logger.warning(f"Unknown STORAGE_ENGINE '{name}', falling back to json")
+    
+    try:
+        serializer = get_serializer(DATA_FORMAT)
+    except ValueError as e:
+        logger.warning(f"{e}, falling back to json")
+        serializer = get_serializer("json")
+    return JsonStorage(WRITE_FLUSH_INTERVAL_MS, WRITE_FLUSH_MAX_CHANGES, serializer)
+
+def migrate_storage(source, target, batch_size=MIGRATE_BATCH_SIZE):
+    """نسخ كل مجموعات البيانات من محرك إلى آخر والتحقق من عدد الصفوف في كل منها.
+
+    يعيد قاموس الاسم -> عدد الصفوف، ويرفع RuntimeError عند أي اختلاف.
+    """
+    counts = {}
+    for name in DATA_FILES:
+        target.import_rows(name, source.export_rows(name), batch_size)
+        expected = source.count_rows(name)
+        actual = target.count_rows(name)
+        if expected != actual:
+            raise RuntimeError(f"Row count mismatch for {name}: {expected} in source, {actual} in target")
+        counts[name] = actual
+    
+    sessions = source.load_sessions()
+    # ما في الهدف من قبل ولا يوجد في المصدر يحذف
+    changes = {(kind, key): None for kind, entries in target.load_sessions().items() for key in entries}
+    changes.update({
+        (kind, key): value for kind, entries in sessions.items() for key, value in entries.items()
+    })
+    target.save_sessions(changes)
+    expected = sum(len(entries) for entries in sessions.values())
+    actual = sum(len(entries) for entries in target.load_sessions().values())
+    if expected != actual:
+        raise RuntimeError(f"Row count mismatch for sessions: {expected} in source, {actual} in target")
+    counts["sessions"] = actual
+    
+    target.flush()
+    return counts
+
+def to_user_id(user_id):
+    """رقم المستخدم كـ int (المعرفات تخزن كنصوص)، أو None إذا لم يكن رقماً"""
+    if isinstance(user_id, int):
+        return user_id
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+# === تجهيز المحتوى النصي للإرسال ===
+# رموز Markdown (الصيغة القديمة في تليجرام) التي تبدأ كياناً
+MARKDOWN_SPECIAL = "*_`["
+
+def markdown_bold(text):
+    """text بخط عريض. الرموز الخاصة تكتب خارج الكيان مع \\ لأن الهروب داخل الكيان غير مسموح"""
+    parts = []
+    for part in re.split(r"([*_`\[])", text):
+        if not part:
+            continue
+        parts.append("\\" + part if part in MARKDOWN_SPECIAL else f"*{part}*")
+    return "".join(parts)
+
+def markdown_entities(text):
+    """مواضع الكيانات في text كـ [(البداية، النهاية)] مرتبة، أو None إذا كان فيها كيان لا يغلق.
+
+    الرمز المهرب (\\ مع الحرف بعده) يعد كياناً من حرفين حتى لا يفصل بينهما عند التقسيم.
+    """
+    spans = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\" and i + 1 < len(text) and text[i + 1] in MARKDOWN_SPECIAL:
+            spans.append((i, i + 2))
+            i += 2
+            continue
+        if text.startswith("```", i):
+            end = text.find("```", i + 3)
+            if end < 0:
+                return None
+            end += 3
+        elif char in "*_`":
+            end = text.find(char, i + 1)
+            if end < 0:
+                return None
+            end += 1
+        elif char == "[":
+            label_end = text.find("](", i + 1)
+            end = text.find(")", label_end + 2) if label_end >= 0 else -1
+            if end < 0:
+                return None
+            end += 1
+        else:
+            i += 1
+            continue
+        spans.append((i, end))
+        i = end
+    return spans
+
+def split_message(text, spans, limit=TELEGRAM_MESSAGE_LIMIT):
+    """تقسيم text لأجزاء لا تتجاوز limit دون قطع أي كيان أو رمز مهرب من spans.
+
+    يفضل القطع بين الفقرات ثم الأسطر ثم الكلمات. يعيد None إذا كان كيان واحد أطول من limit.
+    """
+    starts = [start for start, _ in spans]
+
+    def entity_at(position):
+        index = bisect_right(starts, position) - 1
+        if index >= 0 and spans[index][0] < position < spans[index][1]:
+            return spans[index]
+        return None
+
+    chunks = []
+    start = 0
+    while len(text) - start > limit:
+        end = start + limit
+        cut = None
+        # الفاصل في النصف الأول من الجزء يعطي أجزاء قصيرة، فيجرب بعده فقط إذا لم يوجد غيره.
+        # وإذا لم يوجد فاصل إلا في أول ثُمن الجزء يقطع عند الحد مباشرة بدل جزء شبه فارغ
+        for lowest in (start + limit // 2, start + limit // 8):
+            for separator in ("\n\n", "\n", " "):
+                position = text.rfind(separator, lowest, end)
+                while position >= lowest and entity_at(position) is not None:
+                    position = text.rfind(separator, lowest, entity_at(position)[0])
+                if position >= lowest:
+                    cut, next_start = position, position + len(separator)
+                    break
+            if cut is not None:
+                break
+        if cut is None:
+            entity = entity_at(end)
+            if entity is not None and entity[0] <= start:
+                return None
+            cut = next_start = entity[0] if entity is not None else end
+        chunks.append(text[start:cut])
+        start = next_start
+    chunks.append(text[start:])
+    return [chunk for chunk in chunks if chunk.strip()]
+
+def render_text_content(title, text_content):
+    """رسالة عنصر نصي مقسمة وجاهزة للإرسال: {"parse_mode", "chunks"}.
+
+    النص الذي فيه رمز Markdown بلا إغلاق (مثل _ في اسم) أو كيان أطول من حد الرسالة
+    يجهز كنص عادي، بدلاً من أن يرفضه تليجرام عند كل عرض ثم يعاد إرساله.
+    """
+    message = f"{markdown_bold(title)}\n\n{text_content}"
+    spans = markdown_entities(message)
+    if spans is not None:
+        chunks = split_message(message, spans)
+        if chunks is not None:
+            return {"parse_mode": "Markdown", "chunks": chunks}
+    return {"parse_mode": None, "chunks": split_message(f"📖 {title}\n\n{text_content}", [])}
+
+class BotStats:
+    """عدادات لوحة التحكم والإحصائيات، تحدث مع كل تعديل بدلاً من إعادة العد"""
+
+    def __init__(self):
+        self.total_users = 0
+        self.approved_users = 0
+        self.content_by_type = {}
+        self.channels = 0
+        self.subscription_channels = 0
+
+    @property
+    def pending_users(self):
+        return self.total_users - self.approved_users
+
+    @property
+    def content_count(self):
+        return sum(self.content_by_type.values())
+
+    def add_content(self, content_type, delta):
+        count = self.content_by_type.get(content_type, 0) + delta
+        if count > 0:
+            self.content_by_type[content_type] = count
+        else:
+            self.content_by_type.pop(content_type, None)
+
+class SettingsSnapshot:
+    """لقطة ثابتة من الإعدادات تقرأ كخصائص: settings.subscription.enabled.
+
+    لا تعدل أبداً؛ set_setting والاستعادة تبني لقطة جديدة وتستبدل المرجع دفعة واحدة،
+    فكل معالج يرى إما اللقطة القديمة كاملة أو الجديدة كاملة. كل مسار يحل مرة واحدة
+    ثم يحفظ، والقيمة المفقودة أو التي نوعها يخالف نوع القيمة الافتراضية تستبدل بها.
+    """
+
+    __slots__ = ("_data", "_defaults", "_prefix", "_paths")
+
+    def __init__(self, data, defaults, prefix=""):
+        object.__setattr__(self, "_data", data)
+        object.__setattr__(self, "_defaults", defaults)
+        object.__setattr__(self, "_prefix", prefix)
+        object.__setattr__(self, "_paths", {})
+
+    @staticmethod
+    def _lookup(data, keys):
+        for key in keys:
+            if not isinstance(data, dict) or key not in data:
+                return None
+            data = data[key]
+        return data
+
+    def _resolve(self, key_path):
+        keys = key_path.split('.')
+        value = self._lookup(self._data, keys)
+        default = self._lookup(self._defaults, keys)
+        if default is not None and not isinstance(value, type(default)):
+            if value is not None:
+                logger.warning(f"Setting {self._prefix}{key_path} has type {type(value).__name__}, using the default")
+            value = default
+        if isinstance(value, dict):
+            return SettingsSnapshot(value, default if isinstance(default, dict) else {}, f"{self._prefix}{key_path}.")
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+
+    def get(self, key_path):
+        """قيمة المسار المنقط (قسم كامل يعاد كلقطة)، أو None إذا لم يكن موجوداً"""
+        try:
+            return self._paths[key_path]
+        except KeyError:
+            value = self._paths[key_path] = self._resolve(key_path)
+            return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self.get(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SettingsSnapshot is read-only")
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def replace(self, key_path, value):
+        """لقطة جديدة فيها key_path = value"""
+        data = copy.deepcopy(self._data)
+        keys = key_path.split('.')
+        current = data
+        for key in keys[:-1]:
+            if not isinstance(current.get(key), dict):
+                current[key] = {}
+            current = current[key]
+        current[keys[-1]] = copy.deepcopy(value)
+        return SettingsSnapshot(data, self._defaults)
+
+class BotDatabase:
+    """واجهة البيانات التي تستخدمها المعالجات، وتمرر كل استدعاء لمحرك التخزين المختار"""
+    engine = create_storage_engine()
+    # تحسب مرة واحدة عند أول طلب ثم تحدث مع كل تعديل
+    _stats = None
+    # أرقام المستخدمين المقبولين (int) لفحص كل تحديث دون قراءة users.json، وتحدث مع كل تعديل
+    _approved_ids = None
+    # يزيد مع كل تغيير في قنوات البوت، لإعادة بناء ما يعتمد عليها (لوحات الأزرار)
+    channels_version = 0
+    # لقطة الإعدادات الحالية (SettingsSnapshot)، تقرأ مرة واحدة وتستبدل مع كل تعديل،
+    # وبصمة ملف الإعدادات التي بنيت منها لاكتشاف تعديله من خارج البوت
+    _settings = None
+    _settings_signature = None
+    # يزيد مع كل حذف أو استبدال للمحتوى، لإلغاء نسخ المحتوى المحفوظة في الذاكرة
+    content_version = 0
+
+    @staticmethod
+    def get_stats():
+        stats = BotDatabase._stats
+        if stats is None:
+            stats = BotDatabase.recount_stats()
+        return stats
+
+    @staticmethod
+    def recount_stats():
+        """إعادة حساب العدادات من البيانات الفعلية (لإصلاح أي انحراف)"""
+        stats = BotStats()
+        users = BotDatabase.engine.get_users()
+        stats.total_users = len(users)
+        stats.approved_users = sum(1 for data in users.values() if data.get('approved', False))
+        for item in BotDatabase.engine.get_all_content():
+            stats.add_content(item.get('content_type'), 1)
+        stats.channels = len(BotDatabase.engine.get_channels())
+        stats.subscription_channels = len(BotDatabase.engine.get_subscription_channels())
+        BotDatabase._stats = stats
+        return stats
+
+    @staticmethod
+    def build_approved_ids(engine):
+        approved_ids = set()
+        for user_id in engine.get_approved_users():
+            user_id = to_user_id(user_id)
+            if user_id is not None:
+                approved_ids.add(user_id)
+        return approved_ids
+
+    @staticmethod
+    def load_approved_ids():
+        # مجموعة جديدة تستبدل القديمة دفعة واحدة، فلا يرى القارئ في حلقة الأحداث None أبداً
+        BotDatabase._approved_ids = BotDatabase.build_approved_ids(BotDatabase.engine)
+        return BotDatabase._approved_ids
+
+    @staticmethod
+    def _set_approved(user_id, approved):
+        approved_ids = BotDatabase._approved_ids
+        if approved_ids is None:
+            return
+        user_id = to_user_id(user_id)
+        if user_id is None:
+            return
+        if approved:
+            approved_ids.add(user_id)
+        else:
+            approved_ids.discard(user_id)
+
+    @staticmethod
+    def init_default_data():
+        BotDatabase.engine.init_default_data()
+        BotDatabase.load_settings()
+
+    @staticmethod
+    def switch_engine(name, batch_size=MIGRATE_BATCH_SIZE):
+        """نقل كل البيانات إلى المحرك name ثم استخدامه بدلاً من المحرك الحالي"""
+        source = BotDatabase.engine
+        target = create_storage_engine(name)
+        target.init_default_data()
+        source.flush()
+        counts = migrate_storage(source, target, batch_size)
+        # اللقطة تبنى من المحرك الجديد قبل استخدامه حتى لا تقرأ الإعدادات القديمة بعده
+        settings_signature = target.document_signature(SETTINGS_FILE)
+        settings = BotDatabase.build_settings(target)
+        approved_ids = BotDatabase.build_approved_ids(target)
+        
+        BotDatabase.engine = target
+        BotDatabase._stats = None
+        BotDatabase._approved_ids = approved_ids
+        BotDatabase._settings = settings
+        BotDatabase._settings_signature = settings_signature
+        BotDatabase.content_version += 1
+        BotDatabase.channels_version += 1
+        source.close()
+        if name in PERSISTENT_STORAGE_ENGINES:
+            save_storage_engine(name)
+        return counts
+
+    @staticmethod
+    def read_json(file_path):
+        return BotDatabase.engine.read_json(file_path)
+
+    @staticmethod
+    def write_json(file_path, data):
+        BotDatabase.engine.write_json(file_path, data)
+        # استبدال ملف كامل (مثل الاستعادة) يلغي العدادات الحالية
+        if file_path not in (SETTINGS_FILE, REQUESTS_FILE):
+            BotDatabase._stats = None
+        if file_path == CHANNELS_FILE:
+            BotDatabase.channels_version += 1
+        if file_path == CONTENT_FILE:
+            BotDatabase.content_version += 1
+        if file_path == USERS_FILE:
+            BotDatabase.load_approved_ids()
+        if file_path == SETTINGS_FILE:
+            BotDatabase._settings_signature = BotDatabase.engine.document_signature(SETTINGS_FILE)
+            BotDatabase._settings = SettingsSnapshot(copy.deepcopy(data), DEFAULT_SETTINGS)
+
+    @staticmethod
+    def flush(file_paths=None):
+        """حفظ التعديلات المؤجلة على القرص فوراً (للملفات file_paths، أو كلها)"""
+        BotDatabase.engine.flush(file_paths)
+
+    @staticmethod
+    def load_sessions():
+        return BotDatabase.engine.load_sessions()
+
+    @staticmethod
+    def save_sessions(changes):
+        BotDatabase.engine.save_sessions(changes)
+
+    @staticmethod
+    def build_settings(engine):
+        settings = copy.deepcopy(engine.read_json(SETTINGS_FILE))
+        return SettingsSnapshot(settings, DEFAULT_SETTINGS)
+
+    @staticmethod
+    def load_settings():
+        # البصمة قبل القراءة: تعديل يحدث بينهما يلتقط في الفحص التالي
+        BotDatabase._settings_signature = BotDatabase.engine.document_signature(SETTINGS_FILE)
+        BotDatabase._settings = BotDatabase.build_settings(BotDatabase.engine)
+        return BotDatabase._settings
+
+    @staticmethod
+    def reload_settings_if_changed():
+        """إعادة بناء اللقطة إذا تغير ملف الإعدادات منذ بنائها (تعديل يدوي مثلاً)"""
+        signature = BotDatabase.engine.document_signature(SETTINGS_FILE)
+        if signature is None or signature == BotDatabase._settings_signature:
+            return False
+        logger.info("Settings changed outside the bot, reloading")
+        BotDatabase.load_settings()
+        return True
+
+    @staticmethod
+    def settings():
+        """اللقطة الحالية دون أي قراءة من التخزين (بعد أول تحميل)"""
+        if BotDatabase._settings is None:
+            return BotDatabase.load_settings()
+        return BotDatabase._settings
+
+    @staticmethod
+    def get_setting(key_path):
+        value = BotDatabase.settings().get(key_path)
+        if isinstance(value, SettingsSnapshot):
+            return value.to_dict()
+        if isinstance(value, tuple):
+            return list(value)
+        return {} if value is None else value
+
+    @staticmethod
+    def set_setting(key_path, value):
+        snapshot = BotDatabase.settings()
+        BotDatabase.engine.set_setting(key_path, value)
+        BotDatabase._settings_signature = BotDatabase.engine.document_signature(SETTINGS_FILE)
+        BotDatabase._settings = snapshot.replace(key_path, value)
+
+    @staticmethod
+    def add_user(user_id, username, first_name):
+        existing = BotDatabase.engine.get_user(user_id)
+        was_approved = bool(existing and existing.get('approved', False))
+        BotDatabase.engine.add_user(user_id, username, first_name)
+        # إعادة التسجيل تعيد المستخدم لقائمة الانتظار
+        BotDatabase._set_approved(user_id, False)
+        
+        stats = BotDatabase._stats
+        if stats is not None:
+            if existing is None:
+                stats.total_users += 1
+            elif was_approved:
+                stats.approved_users -= 1
+
+    @staticmethod
+    def get_user(user_id):
+        return BotDatabase.engine.get_user(user_id)
+
+    @staticmethod
+    def get_users():
+        return BotDatabase.engine.get_users()
+
+    @staticmethod
+    def approve_user(user_id):
+        """قبول المستخدم وحذف طلبه، ويعيد بياناته أو None إن لم يكن موجوداً"""
+        existing = BotDatabase.engine.get_user(user_id)
+        was_approved = bool(existing and existing.get('approved', False))
+        user_data = BotDatabase.engine.approve_user(user_id)
+        if user_data is not None:
+            BotDatabase._set_approved(user_id, True)
+        
+        stats = BotDatabase._stats
+        if user_data is not None and not was_approved and stats is not None:
+            stats.approved_users += 1
+        return user_data
+
+    @staticmethod
+    def remove_user(user_id):
+        """حذف المستخدم وطلباته، ويعيد بياناته أو None إن لم يكن موجوداً"""
+        user_data = BotDatabase.engine.remove_user(user_id)
+        BotDatabase._set_approved(user_id, False)
+        
+        stats = BotDatabase._stats
+        if user_data is not None and stats is not None:
+            stats.total_users -= 1
+            if user_data.get('approved', False):
+                stats.approved_users -= 1
+        return user_data
+
+    @staticmethod
+    def get_pending_requests():
+        return BotDatabase.engine.get_pending_requests()
+
+    @staticmethod
+    def get_approved_users():
+        return BotDatabase.engine.get_approved_users()
+
+    @staticmethod
+    def generate_content_id():
+        """توليد رقم فريد مكون من 6-8 أرقام"""
+        return BotDatabase.engine.generate_content_id()
+
+    # === دوال قنوات البوت العادية ===
+    @staticmethod
+    def add_channel(name, link):
+        channel_id = BotDatabase.engine.add_channel(name, link)
+        BotDatabase.channels_version += 1
+        stats = BotDatabase._stats
+        if stats is not None:
+            stats.channels += 1
+        return channel_id
+
+    @staticmethod
+    def get_channels():
+        return BotDatabase.engine.get_channels()
+
+    @staticmethod
+    def delete_channel(channel_id):
+        deleted_channel = BotDatabase.engine.delete_channel(channel_id)
+        if deleted_channel:
+            BotDatabase.channels_version += 1
+            stats = BotDatabase._stats
+            if stats is not None:
+                stats.channels -= 1
+        return deleted_channel
+
+    # === دوال قنوات الاشتراك الإجباري ===
+    @staticmethod
+    def get_subscription_channels():
+        """الحصول على قنوات الاشتراك الإجباري"""
+        return BotDatabase.engine.get_subscription_channels()
+
+    @staticmethod
+    def add_subscription_channel(channel):
+        """إضافة قناة للاشتراك الإجباري"""
+        added = BotDatabase.engine.add_subscription_channel(channel)
+        stats = BotDatabase._stats
+        if added and stats is not None:
+            stats.subscription_channels += 1
+        return added
+
+    @staticmethod
+    def delete_subscription_channel(channel_index):
+        """حذف قناة من الاشتراك الإجباري"""
+        deleted_channel = BotDatabase.engine.delete_subscription_channel(channel_index)
+        stats = BotDatabase._stats
+        if deleted_channel and stats is not None:
+            stats.subscription_channels -= 1
+        return deleted_channel
+
+    @staticmethod
+    def add_content(title, content_type, text_content="", file_id="", content_id=None):
+        # النص يجهز للإرسال مرة واحدة هنا بدلاً من كل عرض
+        rendered = render_text_content(title, text_content) if content_type == 'text' else None
+        new_content = BotDatabase.engine.add_content(title, content_type, text_content, file_id, content_id, rendered)
+        stats = BotDatabase._stats
+        if stats is not None:
+            stats.add_content(content_type, 1)
+        return new_content
+
+    @staticmethod
+    def get_content_by_id(content_id):
+        return BotDatabase.engine.get_content_by_id(content_id)
+
+    @staticmethod
+    def get_all_content():
+        return BotDatabase.engine.get_all_content()
+
+    @staticmethod
+    def delete_content(content_id):
+        deleted_content = BotDatabase.engine.delete_content(content_id)
+        if deleted_content:
+            BotDatabase.content_version += 1
+            stats = BotDatabase._stats
+            if stats is not None:
+                stats.add_content(deleted_content.get('content_type'), -1)
+        return deleted_content
+
+class AsyncStorage:
+    """واجهة غير متزامنة لـ BotDatabase تستخدمها المعالجات.
+
+    كل قراءة وكتابة على القرص (ومعها التحويل من وإلى JSON) تنفذ في مجموعة خيوط
+    محدودة، فلا تتوقف حلقة الأحداث أثناء حفظ ملف كبير. كل استدعاء يحجز أقفال
+    مجموعات البيانات التي يلمسها فقط، فحفظ users.json الكبير لا يوقف قراءة المحتوى.
+    """
+
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+        # قفل خيوط لكل مجموعة بيانات (ولحالة المحادثات)؛ المحرك الذي لا يدعم ذلك يحجزها كلها
+        self._locks = {name: threading.RLock() for name in STORAGE_RESOURCES}
+        # قفل كتابة لكل ملف: الكتّاب على نفس الملف ينتظرون بعضهم، والقراء لا ينتظرون أحداً
+        self._write_locks = {name: asyncio.Lock() for name in DATA_FILES}
+        # رقم إصدار لكل ملف يزداد مع كل كتابة، ولقطات القراءة المشتركة المرتبطة به
+        self._versions = {name: 0 for name in DATA_FILES}
+        self._snapshots = {}
+        # آخر فحص لملف الإعدادات، والفحص الجاري في خيوط التخزين إن وجد
+        self._settings_checked = 0.0
+        self._settings_check = None
+
+    def _call(self, names, func, args, kwargs):
+        while True:
+            # المحرك قد يتغير أثناء الانتظار (/migrate)، فيعاد الفحص بعد حجز الأقفال
+            exclusive = names is None or not BotDatabase.engine.per_file_locking
+            with contextlib.ExitStack() as stack:
+                for name in sorted(STORAGE_RESOURCES if exclusive else set(names)):
+                    stack.enter_context(self._locks[name])
+                if exclusive or BotDatabase.engine.per_file_locking:
+                    return func(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """تنفيذ func في خيوط التخزين وحدها، دون أي استدعاء آخر للمحرك في نفس الوقت"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, None, func, args, kwargs)
+
+    async def run_on(self, names, func, *args, **kwargs):
+        """تنفيذ func في خيوط التخزين مع حجز مجموعات البيانات names فقط.
+
+        () لما لا يلمس المحرك أصلاً (ملفات البث والعضويات والنسخ الاحتياطية).
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._call, tuple(names), func, args, kwargs)
+
+    async def run_flusher(self):
+        """مهمة خلفية تحفظ التعديلات المؤجلة كل flush_interval_ms"""
+        while True:
+            # المحرك قد يتغير أثناء التشغيل (/migrate)، لذلك يقرأ الفاصل في كل دورة
+            interval_ms = BotDatabase.engine.flush_interval_ms
+            if interval_ms <= 0:
+                await asyncio.sleep(1)
+                continue
+            await asyncio.sleep(interval_ms / 1000)
+            # ملف تلو الآخر، فحفظ ملف كبير لا يوقف إلا من يستخدم نفس الملف
+            for name, file_path in DATA_FILES.items():
+                try:
+                    await self.run_on([name], BotDatabase.flush, (file_path,))
+                except Exception as e:
+                    logger.error(f"Error flushing {file_path}: {e}")
+
+    @contextlib.asynccontextmanager
+    async def _writing(self, names):
+        """حجز أقفال الكتابة للملفات المعطاة بترتيب ثابت لتجنب التعطل المتبادل"""
+        async with contextlib.AsyncExitStack() as stack:
+            for name in sorted(set(names)):
+                await stack.enter_async_context(self._write_locks[name])
+            yield
+            for name in names:
+                self._versions[name] += 1
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, name):
+        """معاملة قراءة-تعديل-كتابة على ملف بيانات كامل:
+
+            async with db.transaction('settings') as settings:
+                settings['forwarding']['enabled'] = False
+
+        الكتّاب على نفس الملف ينفذون واحداً تلو الآخر، والتعديل يتم على نسخة خاصة
+        تحفظ فقط إذا انتهت الكتلة دون استثناء. لا تستدع دوال db التي تكتب نفس الملف
+        من داخل المعاملة لأن القفل غير قابل لإعادة الدخول.
+        """
+        file_path = DATA_FILES[name]
+        async with self._writing([name]):
+            data = await self.run_on([name], lambda: copy.deepcopy(BotDatabase.read_json(file_path)))
+            yield data
+            await self.run_on([name], BotDatabase.write_json, file_path, data)
+
+    @property
+    def settings(self):
+        """لقطة الإعدادات الحالية (SettingsSnapshot) من الذاكرة، دون المرور بخيوط التخزين"""
+        # init_default_data وswitch_engine يبنيان اللقطة في خيوط التخزين، فلا قراءة هنا أبداً
+        self._schedule_settings_check()
+        snapshot = BotDatabase._settings
+        if snapshot is None:
+            # قبل تهيئة البيانات فقط: القيم الافتراضية بدل القراءة من حلقة الأحداث
+            return SettingsSnapshot({}, DEFAULT_SETTINGS)
+        return snapshot
+
+    def _schedule_settings_check(self):
+        """فحص ملف الإعدادات في الخلفية كل SETTINGS_CHECK_INTERVAL ثانية على الأكثر"""
+        now = time.monotonic()
+        if now - self._settings_checked < SETTINGS_CHECK_INTERVAL:
+            return
+        if self._settings_check is not None and not self._settings_check.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._settings_checked = now
+        self._settings_check = loop.create_task(self._check_settings())
+
+    async def _check_settings(self):
+        try:
+            await self.run_on(["settings"], BotDatabase.reload_settings_if_changed)
+        except Exception as e:
+            logger.error(f"Error checking settings file: {e}")
+
+    async def snapshot(self, name):
+        """لقطة للقراءة فقط من ملف بيانات كامل، يتشاركها كل القراء حتى الكتابة التالية"""
+        file_path = DATA_FILES[name]
+        version = self._versions[name]
+
+        def take_snapshot():
+            source = BotDatabase.read_json(file_path)
+            cached = self._snapshots.get(name)
+            if cached is not None and cached[0] is source and cached[1] == version:
+                return cached[2]
+            data = copy.deepcopy(source)
+            self._snapshots[name] = (source, version, data)
+            return data
+
+        return await self.run_on([name], take_snapshot)
+
+    async def read_json(self, file_path):
+        return await self.run_on([DATA_FILE_NAMES[file_path]], BotDatabase.read_json, file_path)
+
+    async def write_json(self, file_path, data):
+        name = DATA_FILE_NAMES[file_path]
+        async with self._writing([name]):
+            await self.run_on([name], BotDatabase.write_json, file_path, data)
+
+def _async_database_method(name, writes, reads):
+    method = getattr(BotDatabase, name)
+    # None: الدالة تلمس كل البيانات (أو المحرك نفسه) فتنفذ وحدها
+    resources = None if reads is None else tuple(writes) + tuple(reads)
+
+    async def wrapper(self, *args, **kwargs):
+        call = self.run if resources is None else partial(self.run_on, resources)
+        if not writes:
+            return await call(method, *args, **kwargs)
+        async with self._writing(writes):
+            return await call(method, *args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__qualname__ = f"AsyncStorage.{name}"
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+# نسخة غير متزامنة من كل دالة في BotDatabase، مع الملفات التي تكتبها كل دالة والتي تقرؤها فقط
+_STATS_FILES = ("users", "content", "channels", "subscription_channels")
+for _name, _writes, _reads in (
+    ("init_default_data", (), None), ("flush", (), None),
+    ("switch_engine", tuple(DATA_FILES), None),
+    ("load_sessions", (), ("sessions",)), ("save_sessions", (), ("sessions",)),
+    ("get_stats", (), _STATS_FILES), ("recount_stats", (), _STATS_FILES),
+    ("get_setting", (), ("settings",)), ("set_setting", ("settings",), ()),
+    ("add_user", ("users", "requests"), ()), ("get_user", (), ("users",)), ("get_users", (), ("users",)),
+    ("approve_user", ("users", "requests"), ()), ("remove_user", ("users", "requests"), ()),
+    ("get_pending_requests", (), ("users", "requests")), ("get_approved_users", (), ("users",)),
+    ("generate_content_id", (), ("content",)), ("add_content", ("content",), ()),
+    ("get_content_by_id", (), ("content",)), ("get_all_content", (), ("content",)),
+    ("delete_content", ("content",), ()),
+    ("add_channel", ("channels",), ()), ("get_channels", (), ("channels",)),
+    ("delete_channel", ("channels",), ()),
+    ("get_subscription_channels", (), ("subscription_channels",)),
+    ("add_subscription_channel", ("subscription_channels",), ()),
+    ("delete_subscription_channel", ("subscription_channels",), ()),
+):
+    setattr(AsyncStorage, _name, _async_database_method(_name, _writes, _reads))
+
+db = AsyncStorage(STORAGE_IO_THREADS)
+
+class LoopLagMonitor:
+    """قياس تأخر حلقة الأحداث: الفرق بين موعد الاستيقاظ المطلوب والموعد الفعلي"""
+
+    def __init__(self, interval=0.5, window=120):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag * 1000 > LOOP_LAG_WARN_MS:
+                logger.warning(f"Event loop lag: {lag * 1000:.0f} ms")
+
+    @property
+    def last_ms(self):
+        return self.samples[-1] * 1000 if self.samples else 0.0
+
+    @property
+    def p99_ms(self):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000
+
+    @property
+    def max_ms(self):
+        return self.max_lag * 1000
+
+loop_lag = LoopLagMonitor()
+
+class MembershipCache:
+    """نتائج get_chat_member لكل (مستخدم، قناة) لفترة محدودة، مع حذف الأقدم استخداماً عند الامتلاء"""
+
+    def __init__(self, positive_ttl, negative_ttl, max_size):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # (user_id, channel) -> (مشترك أم لا، وقت انتهاء الصلاحية)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, channel):
+        """نتيجة محفوظة وصالحة (True/False) أو None"""
+        key = (user_id, channel)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id, channel, is_member):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        key = (user_id, channel)
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+membership_cache = MembershipCache(MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_NEGATIVE_TTL, MEMBERSHIP_CACHE_SIZE)
+
+class ContentCache:
+    """عناصر المحتوى الجاهزة للإرسال (content_payload) لأكثر العناصر طلباً، مع حذف الأقدم استخداماً.
+
+    تفرغ بالكامل عندما تتغير BotDatabase.content_version (حذف أو استعادة)، لأن رقم
+    العنصر المحذوف قد يستخدم لعنصر جديد.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._version = BotDatabase.content_version
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content_id):
+        if self._version != BotDatabase.content_version:
+            self._entries.clear()
+            self._version = BotDatabase.content_version
+        payload = self._entries.get(content_id)
+        if payload is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(content_id)
+        self.hits += 1
+        return payload
+
+    def set(self, content_id, payload, version):
+        """version هي content_version قبل قراءة العنصر، فلا يحفظ عنصر قرئ قبل حذفه"""
+        if version != BotDatabase.content_version:
+            return
+        self._entries[content_id] = payload
+        self._entries.move_to_end(content_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+content_cache = ContentCache(CONTENT_CACHE_SIZE)
+
+def is_member_status(status):
+    return status not in ['left', 'kicked', 'restricted']
+
+class MembershipTable:
+    """جدول محلي لعضوية المستخدمين في قنوات الاشتراك التي يشرف عليها البوت.
+
+    تليجرام يرسل تحديثات chat_member فقط للقنوات التي يكون البوت مشرفاً فيها، لذلك
+    هذه القنوات وحدها "مراقبة": كل دخول وخروج يصل كتحديث، ونتيجة المستخدم تبقى
+    صحيحة حتى MEMBERSHIPS_TTL (ثم يسأل تليجرام عنه من جديد). القنوات الأخرى تبقى
+    على MembershipCache. الجدول محدود بـ MEMBERSHIPS_MAX_SIZE مع حذف الأقدم استخداماً،
+    ويحفظ كسجل تضاف إليه التغييرات فقط (مثل سجل الطلبات) ويضغط عند كثرة الأسطر الميتة.
+    """
+
+    def __init__(self, log_path, ttl, max_size):
+        self.log_path = log_path
+        self.ttl = ttl
+        self.max_size = max_size
+        # (chat_id, user_id) -> (مشترك أم لا، وقت انتهاء الصلاحية time.time)، الأقدم استخداماً أولاً
+        self.members = OrderedDict()
+        # قناة الاشتراك كما هي في الإعدادات (@name) -> chat_id للقنوات المراقبة فقط
+        self.chat_ids = {}
+        # أسطر السجل التي لم تحفظ بعد، وعدد أسطر السجل على القرص
+        self._pending = []
+        self._log_lines = 0
+        self._compact = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _record(chat_id, user_id, is_member, expires_at=None):
+        record = {"c": chat_id, "u": user_id, "m": is_member}
+        if expires_at is not None:
+            record["e"] = int(expires_at)
+        return json.dumps(record) + "\n"
+
+    def load(self):
+        """بناء الجدول من السجل (أو من memberships.json القديم مرة واحدة)، ويعمل في خيوط التخزين"""
+        now = time.time()
+        if os.path.exists(MEMBERSHIPS_LEGACY_FILE):
+            self._load_legacy(now)
+            return
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+                key = (int(record["c"]), int(record["u"]))
+            except (ValueError, KeyError, TypeError):
+                # سطر ناقص من كتابة توقفت في منتصفها
+                continue
+            self.members.pop(key, None)
+            if record.get("m") is not None and record.get("e", 0) > now:
+                self.members[key] = (bool(record["m"]), record["e"])
+        self._log_lines = len(lines)
+        self._evict(log=False)
+        self._compact = self._log_lines > max(REQUESTS_LOG_COMPACT_MIN, 2 * len(self.members))
+
+    def _load_legacy(self, now):
+        try:
+            with open(MEMBERSHIPS_LEGACY_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            data = {}
+        for chat_id, users in data.items():
+            for user_id, is_member in users.items():
+                self.members[(int(chat_id), int(user_id))] = (is_member, now + self.ttl)
+        self._evict(log=False)
+        self._write_log(list(self.members.items()))
+        os.replace(MEMBERSHIPS_LEGACY_FILE, MEMBERSHIPS_LEGACY_FILE + ".bak")
+
+    def _write_log(self, entries):
+        JsonStorage._atomic_write_text(self.log_path, "".join(
+            self._record(chat_id, user_id, is_member, expires_at)
+            for (chat_id, user_id), (is_member, expires_at) in entries
+        ))
+        self._log_lines = len(entries)
+
+    def _append_log(self, lines):
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+        self._log_lines += len(lines)
+
+    async def save(self):
+        """حفظ التغييرات منذ آخر حفظ فقط، أو ضغط السجل كاملاً عند الحاجة"""
+        # الأسطر والنسخة تؤخذ هنا في حلقة الأحداث، حيث يعدل الجدول، والكتابة في خيوط التخزين
+        if self._compact or self._log_lines + len(self._pending) > max(REQUESTS_LOG_COMPACT_MIN, 2 * len(self.members)):
+            self._pending = []
+            self._compact = False
+            await db.run_on((), self._write_log, list(self.members.items()))
+        elif self._pending:
+            lines, self._pending = self._pending, []
+            await db.run_on((), self._append_log, lines)
+
+    async def run_saver(self):
+        while True:
+            await asyncio.sleep(MEMBERSHIPS_SAVE_INTERVAL)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Error saving memberships: {e}")
+
+    async def refresh(self, bot, channels):
+        """تحديد القنوات المراقبة من قائمة قنوات الاشتراك الحالية"""
+        chat_ids = {}
+        complete = True
+        for channel in channels:
+            try:
+                chat = await bot.get_chat(channel)
+                bot_member = await bot.get_chat_member(chat.id, bot.id)
+            except TelegramError as e:
+                logger.warning(f"Cannot track members of {channel}: {e}")
+                complete = False
+                continue
+            if bot_member.status in ('administrator', 'creator'):
+                chat_ids[channel] = chat.id
+            else:
+                logger.warning(f"Bot is not an admin in {channel}, falling back to membership lookups")
+        
+        self.chat_ids = chat_ids
+        if not complete:
+            # خطأ مؤقت في قناة لا يمسح ما نعرفه عنها
+            return
+        tracked = set(chat_ids.values())
+        untracked = [key for key in self.members if key[0] not in tracked]
+        for key in untracked:
+            del self.members[key]
+        if untracked:
+            # حذف قناة كاملة يكتب كضغط للسجل بدلاً من سطر لكل مستخدم
+            self._compact = True
+
+    def is_tracked(self, chat_id):
+        return chat_id in self.chat_ids.values()
+
+    def get(self, chat_id, user_id):
+        """True/False للمستخدم الذي سبق رؤيته ولم تنته صلاحية نتيجته، أو None"""
+        key = (chat_id, user_id)
+        entry = self.members.get(key)
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                del self.members[key]
+                self._pending.append(self._record(chat_id, user_id, None))
+            self.misses += 1
+            return None
+        self.members.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, chat_id, user_id, is_member):
+        key = (chat_id, user_id)
+        previous = self.members.get(key)
+        expires_at = time.time() + self.ttl
+        self.members[key] = (is_member, expires_at)
+        self.members.move_to_end(key)
+        # تجديد الصلاحية وحده لا يكتب: بعد إعادة التشغيل تنتهي أبكر قليلاً ويسأل تليجرام
+        if previous is None or previous[0] != is_member:
+            self._pending.append(self._record(chat_id, user_id, is_member, expires_at))
+        self._evict()
+
+    def _evict(self, log=True):
+        while len(self.members) > self.max_size:
+            (chat_id, user_id), _ = self.members.popitem(last=False)
+            if log:
+                self._pending.append(self._record(chat_id, user_id, None))
+
+    def __len__(self):
+        return len(self.members)
+
+membership_table = MembershipTable(MEMBERSHIPS_FILE, MEMBERSHIPS_TTL, MEMBERSHIPS_MAX_SIZE)
+
+class RateLimiter:
+    """حدود إرسال مشتركة لنوع من الرسائل الصادرة: دلو رموز عام وفاصل أدنى لكل محادثة"""
+
+    def __init__(self, rate, per_chat_interval):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.per_chat_interval = per_chat_interval
+        self.tokens = self.capacity
+        self.updated = None
+        # لا يرسل أحد قبل هذا الوقت (بعد RetryAfter من تليجرام)
+        self.paused_until = 0.0
+        # chat_id -> أقرب وقت مسموح فيه بالرسالة التالية لهذه المحادثة
+        self._next_chat_send = {}
+
+    def pause(self, seconds):
+        loop = asyncio.get_running_loop()
+        self.paused_until = max(self.paused_until, loop.time() + seconds)
+
+    async def _wait_for_chat(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        next_send = self._next_chat_send.get(chat_id, now)
+        self._next_chat_send[chat_id] = max(now, next_send) + self.per_chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+        
+        if len(self._next_chat_send) > 10000:
+            now = loop.time()
+            self._next_chat_send = {chat: at for chat, at in self._next_chat_send.items() if at > now}
+
+    def _reserve(self, now):
+        """حجز رمز، ويعيد كم ثانية يجب انتظارها قبل استخدامه"""
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # الرصيد قد يصبح سالباً: كل منتظر يحجز دوره ثم ينام وحده دون أن يوقف غيره
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    async def wait(self, chat_id):
+        """الانتظار حتى يسمح بإرسال رسالة واحدة إلى chat_id"""
+        await self._wait_for_chat(chat_id)
+        
+        loop = asyncio.get_running_loop()
+        # الحجز بلا await، فلا يتداخل مع غيره في حلقة الأحداث ولا يحتاج قفلاً
+        now = loop.time()
+        delay = max(self._reserve(now), self.paused_until - now)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # RetryAfter أثناء الانتظار يؤخر هذا الإرسال أيضاً
+            delay = self.paused_until - loop.time()
+
+# الردود والإشعارات، والبث منفصل عنها
+rate_limiter = RateLimiter(SEND_RATE_PER_SECOND, SEND_PER_CHAT_INTERVAL_MS / 1000)
+broadcast_rate_limiter = RateLimiter(BROADCAST_SEND_RATE_PER_SECOND, SEND_PER_CHAT_INTERVAL_MS / 1000)
+
+async def send_with_retry(chat_id, send, limiter=rate_limiter):
+    """إرسال رسالة واحدة عبر send(chat_id) مع احترام حدود limiter وإعادة المحاولة.
+
+    RetryAfter يوقف كل الإرسال عبر limiter للمدة التي يطلبها تليجرام ثم تعاد المحاولة،
+    وأخطاء الشبكة المؤقتة تعاد حتى SEND_MAX_RETRIES مرة. يعيد True عند النجاح.
+    """
+    attempt = 0
+    while True:
+        await limiter.wait(chat_id)
+        try:
+            await send(chat_id)
+            return True
+        except RetryAfter as e:
+            logger.warning(f"Flood limit hit, pausing sends for {e.retry_after}s")
+            limiter.pause(e.retry_after)
+        except (BadRequest, Forbidden) as e:
+            # المستخدم حظر البوت أو المحادثة غير موجودة: لا فائدة من إعادة المحاولة
+            logger.info(f"Cannot send to {chat_id}: {e}")
+            return False
+        except NetworkError as e:
+            attempt += 1
+            if attempt > SEND_MAX_RETRIES:
+                logger.warning(f"Giving up sending to {chat_id}: {e}")
+                return False
+            await asyncio.sleep(min(30, 2 ** attempt))
+        except TelegramError as e:
+            logger.warning(f"Error sending to {chat_id}: {e}")
+            return False
+
+class BroadcastJob:
+    """بث رسالة لقائمة مستخدمين في الخلفية، محفوظ في BROADCASTS_DIR ليكمل بعد إعادة التشغيل.
+
+    لكل بث ثلاثة ملفات: <id>.json (الرسالة والحالة والمؤشر)، <id>.targets (قائمة
+    المستلمين، تكتب مرة واحدة) و <id>.log (نتيجة كل مستلم، تضاف على دفعات).
+    """
+
+    def __init__(self, job_id, payload, user_ids, status_chat_id=None, status_message_id=None):
+        self.id = job_id
+        self.payload = payload
+        self.user_ids = [str(user_id) for user_id in user_ids]
+        self.status_chat_id = status_chat_id
+        self.status_message_id = status_message_id
+        self.state = "running"
+        self.created_date = datetime.now().isoformat()
+        # كل المستلمين قبل المؤشر لهم نتيجة محفوظة
+        self.cursor = 0
+        # user_id -> True/False لكل من انتهت محاولة الإرسال إليه
+        self.outcomes = {}
+        self._unsaved = []
+        self.sent = 0
+        self.failed = 0
+        self.started_at = None
+        # العمال ينتظرون هذا الحدث، ويلغى عند الإيقاف المؤقت
+        self._running = asyncio.Event()
+        # نقاط الحفظ واحدة تلو الأخرى، حتى لا يسبق المؤشر المحفوظ سطور السجل
+        self._checkpoint_lock = asyncio.Lock()
+
+    @classmethod
+    def create(cls, payload, user_ids, status_message=None):
+        job_id = datetime.now().strftime("%Y%m%d%H%M%S") + f"{random.randint(0, 999):03d}"
+        job = cls(job_id, payload, user_ids)
+        os.makedirs(BROADCASTS_DIR, exist_ok=True)
+        if status_message is not None:
+            job.status_chat_id = status_message.chat_id
+            job.status_message_id = status_message.message_id
+        JsonStorage._atomic_write_text(job._path("targets"), "\n".join(job.user_ids))
+        job._save_state()
+        return job
+
+    @staticmethod
+    def read_state(job_id):
+        """ملف الحالة الصغير فقط، دون قائمة المستلمين والسجل"""
+        with open(os.path.join(BROADCASTS_DIR, f"{job_id}.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def remove_files(job_id, extensions=("json", "targets", "log")):
+        for extension in extensions:
+            try:
+                os.remove(os.path.join(BROADCASTS_DIR, f"{job_id}.{extension}"))
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def load(cls, job_id, state=None):
+        if state is None:
+            state = cls.read_state(job_id)
+        with open(os.path.join(BROADCASTS_DIR, f"{job_id}.targets"), 'r', encoding='utf-8') as f:
+            user_ids = f.read().split()
+        
+        job = cls(job_id, state["payload"], user_ids, state.get("status_chat_id"), state.get("status_message_id"))
+        job.state = state.get("state", "running")
+        job.created_date = state.get("created_date")
+        job.cursor = state.get("cursor", 0)
+        try:
+            with open(job._path("log"), 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # سطر ناقص من كتابة توقفت في منتصفها، وصاحبه سيعاد الإرسال إليه
+                        continue
+                    job.outcomes[record["user_id"]] = record["ok"]
+        except FileNotFoundError:
+            pass
+        job.sent = sum(1 for ok in job.outcomes.values() if ok)
+        job.failed = len(job.outcomes) - job.sent
+        return job
+
+    def _path(self, extension):
+        return os.path.join(BROADCASTS_DIR, f"{self.id}.{extension}")
+
+    def _save_state(self):
+        JsonStorage._atomic_write_text(self._path("json"), json.dumps({
+            "id": self.id,
+            "payload": self.payload,
+            "state": self.state,
+            "cursor": self.cursor,
+            "sent": self.sent,
+            "failed": self.failed,
+            "status_chat_id": self.status_chat_id,
+            "status_message_id": self.status_message_id,
+            "created_date": self.created_date,
+        }, ensure_ascii=False))
+
+    def _write_checkpoint(self, lines):
+        # السجل أولاً ثم الحالة: المؤشر المحفوظ لا يتجاوز أبداً النتائج المكتوبة
+        if lines:
+            with open(self._path("log"), 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+        self._save_state()
+
+    async def checkpoint(self):
+        """حفظ النتائج الجديدة وتقديم المؤشر"""
+        async with self._checkpoint_lock:
+            # العامل يضيف النتيجة وسطرها معاً، فكل من قبل المؤشر سطره في lines أو كتب قبلها
+            while self.cursor < self.total and self.user_ids[self.cursor] in self.outcomes:
+                self.cursor += 1
+            lines, self._unsaved = self._unsaved, []
+            await db.run_on((), self._write_checkpoint, lines)
+
+    @property
+    def total(self):
+        return len(self.user_ids)
+
+    @property
+    def remaining(self):
+        return self.total - self.sent - self.failed
+
+    @property
+    def finished(self):
+        return self.state in ("done", "cancelled")
+
+    def eta_seconds(self):
+        done = self.sent + self.failed
+        if not done or self.started_at is None:
+            return None
+        elapsed = asyncio.get_running_loop().time() - self.started_at
+        return elapsed / done * self.remaining
+
+    def progress_text(self):
+        header = {
+            "running": "📤 جاري البث...",
+            "paused": "⏸️ البث متوقف مؤقتاً",
+            "cancelled": "⛔ تم إلغاء البث:",
+            "done": "✅ تم إرسال الرسالة:",
+        }[self.state]
+        text = (
+            f"{header}\n"
+            f"• ✅ الناجح: {self.sent}\n"
+            f"• ❌ الفاشل: {self.failed}\n"
+            f"• ⏳ المتبقي: {self.remaining}"
+        )
+        eta = self.eta_seconds()
+        if self.state == "running" and eta is not None:
+            text += f"\n• ⏱️ الوقت المتوقع: {int(eta // 60)}:{int(eta % 60):02d}"
+        return text
+
+    async def _send(self, bot, chat_id):
+        if "text" in self.payload:
+            # بث نصي محفوظ قبل دعم نسخ الرسائل
+            return await bot.send_message(chat_id, self.payload["text"])
+        return await bot.copy_message(chat_id, self.payload["from_chat_id"], self.payload["message_id"])
+
+    async def _report_progress(self, bot):
+        if self.status_message_id is None:
+            return
+        try:
+            await bot.edit_message_text(self.progress_text(), chat_id=self.status_chat_id, message_id=self.status_message_id)
+        except TelegramError as e:
+            # مثلاً "message is not modified" إذا لم يتغير شيء منذ آخر تحديث
+            logger.debug(f"Could not update broadcast status: {e}")
+
+    async def _progress_loop(self, bot):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self.checkpoint()
+            await self._report_progress(bot)
+
+    async def _worker(self, bot, targets):
+        for user_id in targets:
+            await self._running.wait()
+            if self.state == "cancelled":
+                return
+            ok = await send_with_retry(int(user_id), lambda chat_id: self._send(bot, chat_id), broadcast_rate_limiter)
+            self.outcomes[user_id] = ok
+            self._unsaved.append(json.dumps({"user_id": user_id, "ok": ok}) + "\n")
+            if ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+            if len(self._unsaved) >= BROADCAST_CHECKPOINT_EVERY:
+                await self.checkpoint()
+
+    async def run(self, bot):
+        self.started_at = asyncio.get_running_loop().time()
+        if self.state == "running":
+            self._running.set()
+        # كل العمال يسحبون من نفس المكرر، فلا يرسل لمستخدم مرتين، ومن سبق الإرسال إليه يتخطى
+        targets = (user_id for user_id in self.user_ids[self.cursor:] if user_id not in self.outcomes)
+        progress = asyncio.create_task(self._progress_loop(bot))
+        try:
+            await asyncio.gather(*(self._worker(bot, targets) for _ in range(max(1, BROADCAST_CONCURRENCY))))
+            if self.state != "cancelled":
+                self.state = "done"
+        finally:
+            progress.cancel()
+            await asyncio.gather(progress, return_exceptions=True)
+            # يحفظ أيضاً عند إيقاف البوت في منتصف البث، ليكمل من هنا عند التشغيل التالي
+            await self.checkpoint()
+        if self.finished:
+            # لا حاجة للمستلمين والسجل بعد الانتهاء، ويبقى الملخص في ملف الحالة
+            await db.run_on((), BroadcastJob.remove_files, self.id, ("targets", "log"))
+        await self._report_progress(bot)
+        logger.info(f"Broadcast {self.id} {self.state}: {self.sent} sent, {self.failed} failed")
+
+    def pause(self):
+        if self.finished:
+            return
+        self.state = "paused"
+        self._running.clear()
+
+    def resume(self):
+        if self.finished:
+            return
+        self.state = "running"
+        self._running.set()
+
+    def cancel(self):
+        if self.state != "done":
+            self.state = "cancelled"
+        # إيقاظ العمال المنتظرين ليخرجوا
+        self._running.set()
+
+class BroadcastManager:
+    """تشغيل البث كمهام خلفية لا توقف محادثة المدير، وإكمال غير المنتهي منها بعد إعادة التشغيل"""
+
+    def __init__(self):
+        # البث غير المنتهي (قيد التشغيل أو متوقف مؤقتاً): id -> BroadcastJob
+        self.jobs = {}
+        self.tasks = set()
+
+    def start(self, job, bot):
+        self.jobs[job.id] = job
+        task = asyncio.create_task(job.run(bot))
+        self.tasks.add(task)
+        task.add_done_callback(lambda task: self._job_done(job, task))
+        return task
+
+    def _job_done(self, job, task):
+        self.tasks.discard(task)
+        if job.finished:
+            self.jobs.pop(job.id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Broadcast {job.id} failed: {task.exception()}")
+
+    @staticmethod
+    def load_unfinished():
+        """تحميل البث غير المنتهي فقط، وحذف ملفات المنتهي (يعمل في خيوط التخزين)"""
+        os.makedirs(BROADCASTS_DIR, exist_ok=True)
+        jobs = []
+        finished = []
+        for file_name in sorted(os.listdir(BROADCASTS_DIR)):
+            if not file_name.endswith(".json"):
+                continue
+            job_id = file_name[:-len(".json")]
+            try:
+                state = BroadcastJob.read_state(job_id)
+                if state.get("state", "running") in ("done", "cancelled"):
+                    finished.append(job_id)
+                    continue
+                jobs.append(BroadcastJob.load(job_id, state))
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Could not load broadcast {file_name}: {e}")
+        
+        # المعرفات تبدأ بالتاريخ، فالأقدم أولاً
+        keep = len(finished) - max(0, BROADCAST_KEEP_FINISHED)
+        for index, job_id in enumerate(finished):
+            if index < keep:
+                BroadcastJob.remove_files(job_id)
+            else:
+                BroadcastJob.remove_files(job_id, ("targets", "log"))
+        if keep > 0:
+            logger.info(f"Removed {keep} finished broadcasts")
+        return jobs
+
+    async def resume_unfinished(self, bot):
+        """تشغيل كل بث لم ينته قبل إعادة التشغيل من آخر نقطة حفظ"""
+        for job in await db.run_on((), self.load_unfinished):
+            logger.info(f"Resuming broadcast {job.id} ({job.state}) at {job.cursor}/{job.total}")
+            self.start(job, bot)
+
+    async def set_state(self, job_id, action):
+        """إيقاف مؤقت أو استئناف أو إلغاء بث، ويعيده أو None إن لم يكن موجوداً"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        getattr(job, action)()
+        await job.checkpoint()
+        return job
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+
+broadcasts = BroadcastManager()
+
+async def send_to_admins(bot, text, reply_markup=None):
+    """إرسال رسالة لكل المديرين في نفس الوقت عبر حدود الإرسال المشتركة"""
+    await asyncio.gather(*(
+        send_with_retry(admin_id, lambda chat_id: bot.send_message(chat_id, text, reply_markup=reply_markup))
+        for admin_id in ADMIN_IDS
+    ))
+
+class AdminNotifier:
+    """طابور رسائل المديرين ترسلها مهمة خلفية واحدة.
+
+    معالج تحديث المستخدم يضيف الرسالة ويكمل فوراً، ولا ينتظر حد الإرسال لكل محادثة
+    مدير (ثانية لكل رسالة) وهو يحجز قفل المستخدم ومكاناً من UPDATE_CONCURRENCY.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        # الرسالة التي تُرسل الآن، لتعاد في drain إذا ألغيت المهمة أثناء إرسالها
+        self.current = None
+
+    def notify(self, text, reply_markup=None):
+        self.queue.put_nowait((text, reply_markup))
+
+    async def _send(self, bot, item):
+        try:
+            await send_to_admins(bot, *item)
+        except Exception as e:
+            logger.error(f"Error notifying admins: {e}")
+
+    async def run(self, bot):
+        while True:
+            self.current = await self.queue.get()
+            await self._send(bot, self.current)
+            self.current = None
+
+    async def drain(self, bot):
+        """إرسال ما تبقى في الطابور (عند الإيقاف، بعد إلغاء run)"""
+        if self.current is not None:
+            await self._send(bot, self.current)
+            self.current = None
+        while not self.queue.empty():
+            await self._send(bot, self.queue.get_nowait())
+
+admin_notifier = AdminNotifier()
+
+class ActionDigest:
+    """تجميع إجراءات المستخدمين في الذاكرة وإرسالها للمديرين كملخص واحد.
+
+    الإجراءات المتكررة من نفس المستخدم تدمج في سطر واحد مع عدد مراتها وآخر تفاصيلها.
+    """
+
+    MAX_MESSAGE_LENGTH = TELEGRAM_MESSAGE_LIMIT
+
+    def __init__(self, max_events):
+        self.max_events = max_events
+        # user_id -> {"name", "username", "actions": {الإجراء: [العدد، آخر تفاصيل، آخر وقت]}}
+        self.users = OrderedDict()
+        self.events = 0
+        self.started = None
+        # يضبط عند امتلاء الملخص فترسله run فوراً دون انتظار FORWARD_DIGEST_INTERVAL
+        self.full = asyncio.Event()
+
+    def add(self, user_id, name, username, action_type, details):
+        """إضافة إجراء، ويعيد True إذا امتلأ الملخص"""
+        if not self.users:
+            self.started = datetime.now()
+        entry = self.users.setdefault(user_id, {"name": name, "username": username, "actions": OrderedDict()})
+        action = entry["actions"].setdefault(action_type, [0, "", None])
+        action[0] += 1
+        action[1] = details
+        action[2] = datetime.now()
+        self.events += 1
+        if self.events >= self.max_events:
+            self.full.set()
+            return True
+        return False
+
+    def render(self):
+        """نص الملخص مقسماً لرسائل لا تتجاوز حد تليجرام، ثم تفريغ الملخص"""
+        header = (
+            f"📋 ملخص إجراءات المستخدمين\n"
+            f"⏰ {self.started.strftime('%H:%M:%S')} - {datetime.now().strftime('%H:%M:%S')}\n"
+            f"👥 {len(self.users)} مستخدم، {self.events} إجراء\n"
+        )
+        blocks = []
+        for user_id, entry in self.users.items():
+            block = f"\n👤 {entry['name']} ({entry['username']}) - {user_id}\n"
+            for action_type, (count, details, last_time) in entry["actions"].items():
+                repeat = f" ×{count}" if count > 1 else ""
+                block += f"• {action_type}{repeat} [{last_time.strftime('%H:%M:%S')}]: {details}\n"
+            blocks.append(block[:self.MAX_MESSAGE_LENGTH - len(header)])
+        
+        self.users = OrderedDict()
+        self.events = 0
+        
+        messages = [header]
+        for block in blocks:
+            if len(messages[-1]) + len(block) > self.MAX_MESSAGE_LENGTH:
+                messages.append("")
+            messages[-1] += block
+        return messages
+
+    def flush(self):
+        """نقل الملخص إلى طابور رسائل المديرين"""
+        if not self.users:
+            return
+        for text in self.render():
+            admin_notifier.notify(text)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), FORWARD_DIGEST_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error sending action digest: {e}")
+
+action_digest = ActionDigest(FORWARD_DIGEST_MAX_EVENTS)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """معالجة تحديثات المستخدمين المختلفين بالتوازي، وتحديثات نفس المستخدم واحداً تلو الآخر.
+
+    ConversationHandler و context.user_data يفترضان أن تحديثات المستخدم الواحد لا
+    تتداخل، بينما لا يجب أن ينتظر باقي المستخدمين طلباً بطيئاً (رفع نسخة احتياطية
+    مثلاً) من مستخدم آخر.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        # حد المكتبة يشمل التحديثات المنتظرة خلف تحديث سابق لنفس المستخدم، فيكون أكبر من حد
+        # التنفيذ الفعلي حتى لا يحجز مستخدم يرسل بسرعة كل الأماكن وهو ينتظر نفسه
+        super().__init__(max_concurrent_updates * UPDATE_BACKLOG_FACTOR)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # المستخدم -> [القفل، عدد تحديثاته الحالية]، ويحذف عندما لا يبقى له تحديث
+        self._user_locks = {}
+
+    @staticmethod
+    def _update_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+class StoragePersistence(BasePersistence):
+    """حفظ حالات المحادثات و user_data و chat_data في محرك التخزين نفسه (BotDatabase).
+
+    المكتبة تستدعي update_* كل PERSISTENCE_INTERVAL ثانية لكل مستخدم تغيرت بياناته،
+    فتجمع التغييرات هنا وتحفظ معاً في كتابة واحدة، وما لم يتغير فعلاً منذ آخر حفظ
+    لا يكتب. القيم يجب أن تكون قابلة للتحويل إلى JSON.
+    """
+
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._sessions = None
+        # آخر قيمة محفوظة لكل (نوع، مفتاح) كنص JSON، لتجاهل ما لم يتغير
+        self._saved = {}
+        self._pending = {}
+        self._write_task = None
+        # كتابة واحدة في كل مرة، حتى لا تسبق دفعة قديمة دفعة أحدث منها
+        self._write_lock = asyncio.Lock()
+
+    async def _load(self):
+        if self._sessions is None:
+            self._sessions = await db.load_sessions()
+            for kind, entries in self._sessions.items():
+                for key, value in entries.items():
+                    self._saved[(kind, key)] = json.dumps(value, sort_keys=True)
+        return self._sessions
+
+    def _record(self, kind, key, value):
+        if value is None:
+            if (kind, key) not in self._saved and (kind, key) not in self._pending:
+                return
+            encoded = None
+        else:
+            try:
+                encoded = json.dumps(value, sort_keys=True)
+            except TypeError as e:
+                logger.warning(f"Cannot persist {kind} {key}: {e}")
+                return
+        if self._saved.get((kind, key)) == encoded and (kind, key) not in self._pending:
+            return
+        
+        # نسخة مستقلة من القيمة وقت التسجيل، فلا تؤثر التعديلات اللاحقة على ما سيحفظ
+        self._pending[(kind, key)] = None if encoded is None else json.loads(encoded)
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self):
+        # المكتبة تستدعي update_* لكل المستخدمين دفعة واحدة، فننتظر قليلاً لنكتبها معاً
+        await asyncio.sleep(0.1)
+        self._write_task = None
+        try:
+            await self._write_pending()
+        except Exception as e:
+            logger.error(f"Error saving conversation state: {e}")
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            if not self._pending:
+                return
+            changes, self._pending = self._pending, {}
+            try:
+                await db.save_sessions(changes)
+            except BaseException:
+                # تعاد المحاولة مع الدفعة التالية
+                for key, value in changes.items():
+                    self._pending.setdefault(key, value)
+                raise
+            for key, value in changes.items():
+                if value is None:
+                    self._saved.pop(key, None)
+                else:
+                    self._saved[key] = json.dumps(value, sort_keys=True)
+
+    async def get_user_data(self):
+        return {int(user_id): data for user_id, data in (await self._load()).get("user_data", {}).items()}
+
+    async def get_chat_data(self):
+        return {int(chat_id): data for chat_id, data in (await self._load()).get("chat_data", {}).items()}
+
+    async def get_bot_data(self):
+        return (await self._load()).get("bot_data", {}).get("", {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        entries = (await self._load()).get(f"conversation:{name}", {})
+        return {tuple(json.loads(key)): state for key, state in entries.items()}
+
+    async def update_user_data(self, user_id, data):
+        self._record("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._record("chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        self._record("bot_data", "", data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        self._record(f"conversation:{name}", json.dumps(list(key)), new_state)
 
-    @staticmethod
-    def get_all_content():
-        content_data = BotDatabase.read_json(CONTENT_FILE)
-        return content_data.get("content", [])
+    async def drop_user_data(self, user_id):
+        self._record("user_data", str(user_id), None)
+
+    async def drop_chat_data(self, chat_id):
+        self._record("chat_data", str(chat_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        await self._write_pending()
+
+class MessageRouter:
+    """توجيه أزرار القوائم إلى دوالها بجدول (نص الزر -> الدالة) بدل مقارنة النص بكل زر.
+
+    أزرار القنوات تتغير مع إضافة القنوات وحذفها، لذلك تسجل في جدول منفصل يعاد
+    بناؤه عندما تتغير BotDatabase.channels_version. كل استدعاء يحسب في calls لمعرفة
+    أكثر الأزرار استخداماً.
+    """
+
+    # اسم العداد للنصوص التي لا تطابق أي زر
+    FALLBACK = "(نص آخر)"
+
+    def __init__(self):
+        self.admin_routes = {}
+        self.user_routes = {}
+        # نص زر القناة -> القناة، ونسخة القنوات التي بني منها
+        self.channel_routes = {}
+        self.channels_version = None
+        self.calls = Counter()
+
+    def set_routes(self, admin_routes, user_routes):
+        self.admin_routes = dict(admin_routes)
+        self.user_routes = dict(user_routes)
 
     @staticmethod
-    def delete_content(content_id):
-        content_data = BotDatabase.read_json(CONTENT_FILE)
-        content_items = content_data.get("content", [])
-        
-        content_to_delete = None
-        for item in content_items:
-            if item['id'] == content_id:
-                content_to_delete = item
-                break
-        
-        if content_to_delete:
-            content_data["content"] = [item for item in content_items if item['id'] != content_id]
-            BotDatabase.write_json(CONTENT_FILE, content_data)
-            return content_to_delete
-        
+    def channel_label(name):
+        return f"📺 {name}"
+
+    def set_channels(self, channels):
+        routes = {}
+        for channel in channels:
+            label = self.channel_label(channel['name'])
+            if label in routes:
+                # القنوات المكررة من بيانات قديمة: الزر يفتح أول قناة كما كان سابقاً
+                logger.warning(f"Duplicate channel name {channel['name']!r} (id {channel['id']}), button opens id {routes[label]['id']}")
+                continue
+            routes[label] = channel
+        self.channel_routes = routes
+
+    async def refresh_channels(self):
+        """إعادة تسجيل أزرار القنوات إذا تغيرت القنوات منذ آخر بناء"""
+        version = BotDatabase.channels_version
+        if self.channels_version == version:
+            return
+        self.set_channels(await db.get_channels())
+        self.channels_version = version
+
+    async def channel_name_taken(self, name):
+        """هل يوجد زر (قناة أو قائمة) بنفس نص زر قناة بهذا الاسم"""
+        await self.refresh_channels()
+        label = self.channel_label(name)
+        return label in self.channel_routes or label in self.admin_routes or label in self.user_routes
+
+    def resolve(self, text, admin):
+        """الدالة المسجلة للنص (مع القناة إن كان زر قناة)، أو None"""
+        handler = (self.admin_routes if admin else self.user_routes).get(text)
+        if handler is not None:
+            return handler
+        channel = self.channel_routes.get(text)
+        if channel is not None:
+            return partial(show_channel, channel=channel)
         return None
 
+    async def dispatch(self, update, context, text, admin):
+        await self.refresh_channels()
+        handler = self.resolve(text, admin)
+        if handler is None:
+            self.calls[self.FALLBACK] += 1
+            await handle_free_text(update, context, text)
+            return
+        self.calls[text] += 1
+        await handler(update, context)
+
+    def top(self, count):
+        return self.calls.most_common(count)
+
+router = MessageRouter()
+
 class KeyboardManager:
+    """لوحات الأزرار، تبنى مرة واحدة وتستخدم نفس الكائن في كل رد.
+
+    القوائم الثابتة تبنى عند التشغيل، ولوحات القنوات تبنى مرة لكل نسخة من القنوات
+    (BotDatabase.channels_version) ولا تقرأ القنوات من التخزين إلا بعد تغيرها.
+    """
+
+    USER_KEYBOARD = ReplyKeyboardMarkup([
+        ["📺 قنوات نسونجي"],
+        ["🔍 ID"],
+        ["ℹ️ المساعدة"]
+    ], resize_keyboard=True)
+    ADMIN_KEYBOARD = ReplyKeyboardMarkup([
+        ["👑 لوحة التحكم", "📊 الإحصائيات"],
+        ["👥 إدارة المستخدمين", "📢 الاشتراك الإجباري"],
+        ["📺 إدارة القنوات", "🎭 إدارة المحتوى"],
+        ["⚙️ الإعدادات العامة", "📤 البث للمستخدمين"],
+        ["💾 النسخ الاحتياطي"]
+    ], resize_keyboard=True)
+    WAITING_KEYBOARD = ReplyKeyboardMarkup([["⏳ انتظر الموافقة"]], resize_keyboard=True)
+    BACK_KEYBOARD = ReplyKeyboardMarkup([["🏠 الرئيسية"]], resize_keyboard=True)
+    USER_MANAGEMENT_KEYBOARD = ReplyKeyboardMarkup([
+        ["📋 طلبات الانتظار", "👀 المستخدمين النشطين"],
+        ["🗑️ حذف مستخدم", "🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    CHANNELS_MANAGEMENT_KEYBOARD = ReplyKeyboardMarkup([
+        ["➕ إضافة قناة", "🗑️ حذف قناة"],
+        ["📋 عرض القنوات", "🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    CONTENT_MANAGEMENT_KEYBOARD = ReplyKeyboardMarkup([
+        ["➕ إضافة محتوى", "🗑️ حذف محتوى"],
+        ["📋 عرض المحتوى", "🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    SUBSCRIPTION_MANAGEMENT_KEYBOARD = ReplyKeyboardMarkup([
+        ["🔔 تفعيل/إلغاء", "✏️ تعديل الرسالة"],
+        ["📝 إضافة قناة اشتراك", "🗑️ حذف قناة اشتراك"],
+        ["📋 عرض قنوات الاشتراك", "🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    SETTINGS_KEYBOARD = ReplyKeyboardMarkup([
+        ["✏️ تعديل رسالة الترحيب", "✏️ تعديل رسالة الرفض"],
+        ["✏️ تعديل رسالة المساعدة", "🔔 تفعيل/إلغاء التحويل"],
+        ["📨 وضع التحويل: فوري/ملخص", "🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    BROADCAST_KEYBOARD = ReplyKeyboardMarkup([
+        ["📢 بث لجميع المستخدمين", "👤 بث لمستخدم محدد"],
+        ["⏯️ مهام البث", "📋 عرض المستخدمين"],
+        ["🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    BACKUP_KEYBOARD = ReplyKeyboardMarkup([
+        ["💾 تنزيل نسخة", "🔄 رفع نسخة"],
+        ["📋 عرض النسخ", "🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    TEXT_INPUT_KEYBOARD = ReplyKeyboardMarkup([
+        ["✅ إنهاء وحفظ", "❌ إلغاء الإضافة"],
+        ["🏠 الرئيسية"]
+    ], resize_keyboard=True)
+    SUBSCRIBE_CHECK_KEYBOARD = ReplyKeyboardMarkup([["✅ تحقق من الاشتراك"]], resize_keyboard=True)
+    CONTENT_TYPE_KEYBOARD = ReplyKeyboardMarkup([
+        ["📝 نص", "🖼️ صورة"],
+        ["🎬 فيديو", "📄 ملف"],
+        ["🏠 الرئيسية"]
+    ], resize_keyboard=True)
+
+    # نسخة القنوات التي بنيت منها لوحات القنوات المحفوظة (None قبل أول بناء)
+    _channels_version = None
+    _channels_keyboard = None
+    _channels_inline_keyboard = None
+
     @staticmethod
     def get_user_keyboard():
-        return ReplyKeyboardMarkup([
-            ["📺 قنوات نسونجي"],
-            ["🔍 ID"],
-            ["ℹ️ المساعدة"]
-        ], resize_keyboard=True)
+        return KeyboardManager.USER_KEYBOARD
 
     @staticmethod
     def get_admin_keyboard():
-        return ReplyKeyboardMarkup([
-            ["👑 لوحة التحكم", "📊 الإحصائيات"],
-            ["👥 إدارة المستخدمين", "📢 الاشتراك الإجباري"],
-            ["📺 إدارة القنوات", "🎭 إدارة المحتوى"],
-            ["⚙️ الإعدادات العامة", "📤 البث للمستخدمين"],
-            ["💾 النسخ الاحتياطي"]
-        ], resize_keyboard=True)
+        return KeyboardManager.ADMIN_KEYBOARD
 
     @staticmethod
     def get_waiting_keyboard():
-        return ReplyKeyboardMarkup([["⏳ انتظر الموافقة"]], resize_keyboard=True)
+        return KeyboardManager.WAITING_KEYBOARD
 
     @staticmethod
     def get_back_keyboard():
-        return ReplyKeyboardMarkup([["🏠 الرئيسية"]], resize_keyboard=True)
+        return KeyboardManager.BACK_KEYBOARD
 
     @staticmethod
-    def get_channels_keyboard():
-        channels = BotDatabase.get_channels()
-        
+    def build_channels_keyboard(channels):
         keyboard = []
         for channel in channels:
             keyboard.append([f"📺 {channel['name']}"])
@@ -334,9 +3415,7 @@ class KeyboardManager:
         return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
     @staticmethod
-    def get_channels_inline_keyboard():
-        channels = BotDatabase.get_channels()
-        
+    def build_channels_inline_keyboard(channels):
         keyboard = []
         for channel in channels:
             keyboard.append([InlineKeyboardButton(f"📺 {channel['name']}", url=channel['link'])])
@@ -344,101 +3423,163 @@ class KeyboardManager:
         keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="back_to_main")])
         return InlineKeyboardMarkup(keyboard)
 
+    @staticmethod
+    async def _refresh_channel_keyboards():
+        version = BotDatabase.channels_version
+        if KeyboardManager._channels_version == version:
+            return
+        channels = await db.get_channels()
+        if channels:
+            KeyboardManager._channels_keyboard = KeyboardManager.build_channels_keyboard(channels)
+            KeyboardManager._channels_inline_keyboard = KeyboardManager.build_channels_inline_keyboard(channels)
+        else:
+            KeyboardManager._channels_keyboard = None
+            KeyboardManager._channels_inline_keyboard = None
+        # النسخة تقرأ قبل القنوات، فإذا تغيرت أثناء القراءة يعاد البناء في الطلب التالي
+        KeyboardManager._channels_version = version
+
+    @staticmethod
+    async def get_channels_keyboard():
+        """لوحة أزرار قنوات البوت، أو None إذا لم توجد قنوات"""
+        await KeyboardManager._refresh_channel_keyboards()
+        return KeyboardManager._channels_keyboard
+
+    @staticmethod
+    async def get_channels_inline_keyboard():
+        """أزرار روابط قنوات البوت، أو None إذا لم توجد قنوات"""
+        await KeyboardManager._refresh_channel_keyboards()
+        return KeyboardManager._channels_inline_keyboard
+
     @staticmethod
     def get_user_management_keyboard():
-        return ReplyKeyboardMarkup([
-            ["📋 طلبات الانتظار", "👀 المستخدمين النشطين"],
-            ["🗑️ حذف مستخدم", "🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.USER_MANAGEMENT_KEYBOARD
 
     @staticmethod
     def get_channels_management_keyboard():
-        return ReplyKeyboardMarkup([
-            ["➕ إضافة قناة", "🗑️ حذف قناة"],
-            ["📋 عرض القنوات", "🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.CHANNELS_MANAGEMENT_KEYBOARD
 
     @staticmethod
     def get_content_management_keyboard():
-        return ReplyKeyboardMarkup([
-            ["➕ إضافة محتوى", "🗑️ حذف محتوى"],
-            ["📋 عرض المحتوى", "🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.CONTENT_MANAGEMENT_KEYBOARD
 
     @staticmethod
     def get_subscription_management_keyboard():
-        return ReplyKeyboardMarkup([
-            ["🔔 تفعيل/إلغاء", "✏️ تعديل الرسالة"],
-            ["📝 إضافة قناة اشتراك", "🗑️ حذف قناة اشتراك"],
-            ["📋 عرض قنوات الاشتراك", "🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.SUBSCRIPTION_MANAGEMENT_KEYBOARD
 
     @staticmethod
     def get_settings_keyboard():
-        return ReplyKeyboardMarkup([
-            ["✏️ تعديل رسالة الترحيب", "✏️ تعديل رسالة الرفض"],
-            ["✏️ تعديل رسالة المساعدة", "🔔 تفعيل/إلغاء التحويل"],
-            ["🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.SETTINGS_KEYBOARD
 
     @staticmethod
     def get_broadcast_keyboard():
-        return ReplyKeyboardMarkup([
-            ["📢 بث لجميع المستخدمين", "👤 بث لمستخدم محدد"],
-            ["📋 عرض المستخدمين", "🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.BROADCAST_KEYBOARD
+
+    @staticmethod
+    def get_broadcast_job_keyboard(job):
+        if job.state == "paused":
+            toggle = InlineKeyboardButton("▶️ استئناف", callback_data=f"broadcast_resume_{job.id}")
+        else:
+            toggle = InlineKeyboardButton("⏸️ إيقاف مؤقت", callback_data=f"broadcast_pause_{job.id}")
+        cancel = InlineKeyboardButton("⛔ إلغاء", callback_data=f"broadcast_cancel_{job.id}")
+        return InlineKeyboardMarkup([[toggle, cancel]]) if not job.finished else None
 
     @staticmethod
     def get_backup_keyboard():
-        return ReplyKeyboardMarkup([
-            ["💾 تنزيل نسخة", "🔄 رفع نسخة"],
-            ["📋 عرض النسخ", "🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.BACKUP_KEYBOARD
 
     @staticmethod
     def get_text_input_keyboard():
-        return ReplyKeyboardMarkup([
-            ["✅ إنهاء وحفظ", "❌ إلغاء الإضافة"],
-            ["🏠 الرئيسية"]
-        ], resize_keyboard=True)
+        return KeyboardManager.TEXT_INPUT_KEYBOARD
+
+    @staticmethod
+    def get_subscribe_check_keyboard():
+        return KeyboardManager.SUBSCRIBE_CHECK_KEYBOARD
+
+    @staticmethod
+    def get_content_type_keyboard():
+        return KeyboardManager.CONTENT_TYPE_KEYBOARD
+
+def set_admin_ids(admin_ids):
+    global ADMIN_ID_SET
+    ADMIN_ID_SET = frozenset(admin_ids)
 
 def is_admin(user_id):
-    return str(user_id) in [str(admin_id) for admin_id in ADMIN_IDS]
+    return to_user_id(user_id) in ADMIN_ID_SET
 
-def is_user_approved(user_id):
-    users = BotDatabase.read_json(USERS_FILE)
-    user_data = users.get(str(user_id), {})
-    return user_data.get('approved', False)
+async def is_user_approved(user_id):
+    # مرجع واحد للمجموعة: خيوط التخزين قد تستبدلها أثناء الفحص
+    approved_ids = BotDatabase._approved_ids
+    if approved_ids is None:
+        approved_ids = await db.run_on(["users"], BotDatabase.load_approved_ids)
+    return to_user_id(user_id) in approved_ids
 
 async def check_subscription(user_id, context):
     """التحقق من اشتراك المستخدم في قنوات الاشتراك الإجباري فقط"""
-    if not BotDatabase.get_setting("subscription.enabled"):
+    if not db.settings.subscription.enabled:
         return True
     
-    channels = BotDatabase.get_subscription_channels()  # استخدام قنوات الاشتراك الإجباري فقط
+    channels = await db.get_subscription_channels()  # استخدام قنوات الاشتراك الإجباري فقط
     if not channels:
         return True
     
-    try:
-        for channel in channels:
-            # التحقق من اشتراك المستخدم في القناة
-            chat_member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
-            if chat_member.status in ['left', 'kicked', 'restricted']:
-                return False
+    missing = []
+    for channel in channels:
+        chat_id = membership_table.chat_ids.get(channel)
+        if chat_id is not None:
+            is_member = membership_table.get(chat_id, user_id)
+        else:
+            is_member = membership_cache.get(user_id, channel)
+        if is_member is False:
+            return False
+        if is_member is None:
+            missing.append(channel)
+    if not missing:
         return True
-    except Exception as e:
-        logger.error(f"Error checking subscription for {user_id}: {e}")
-        return False
+    
+    # القنوات غير المحفوظة تفحص في نفس الوقت بدلاً من واحدة تلو الأخرى
+    results = await asyncio.gather(
+        *(context.bot.get_chat_member(chat_id=channel, user_id=user_id) for channel in missing),
+        return_exceptions=True
+    )
+    subscribed = True
+    for channel, result in zip(missing, results):
+        if isinstance(result, Exception):
+            # فشل قناة واحدة (مثلاً البوت ليس مشرفاً فيها) لا يمنع المستخدم، ولا تحفظ نتيجته
+            logger.error(f"Error checking subscription for {user_id} in {channel}: {result}")
+            continue
+        is_member = is_member_status(result.status)
+        chat_id = membership_table.chat_ids.get(channel)
+        if chat_id is not None:
+            # بعد أول فحص تصل كل تغييرات هذا المستخدم كتحديثات chat_member
+            membership_table.set(chat_id, user_id, is_member)
+        else:
+            membership_cache.set(user_id, channel, is_member)
+        subscribed = subscribed and is_member
+    return subscribed
+
+async def track_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تحديث جدول العضوية من تحديثات chat_member في قنوات الاشتراك المراقبة"""
+    chat_member = update.chat_member
+    chat_id = chat_member.chat.id
+    if not membership_table.is_tracked(chat_id):
+        return
+    membership_table.set(chat_id, chat_member.new_chat_member.user.id, is_member_status(chat_member.new_chat_member.status))
 
 async def forward_user_action(update: Update, context: ContextTypes.DEFAULT_TYPE, action_type: str, details: str = ""):
     """تحويل إجراءات المستخدم إلى المديرين"""
-    if not BotDatabase.get_setting("forwarding.enabled"):
+    if not db.settings.forwarding.enabled:
         return
     
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
     username = f"@{update.effective_user.username}" if update.effective_user.username else "لا يوجد"
     
+    forwarding = db.settings.forwarding
+    if forwarding.mode != "immediate" and action_type not in forwarding.immediate_actions:
+        # عند امتلاء الملخص ترسله مهمة action_digest.run
+        action_digest.add(user_id, user_name, username, action_type, details)
+        return
+    
     # نص الرسالة المحولة
     forward_text = (
         f"📩 إجراء مستخدم جديد\n\n"
@@ -450,18 +3591,14 @@ async def forward_user_action(update: Update, context: ContextTypes.DEFAULT_TYPE
         f"⏰ الوقت: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     )
     
-    # إرسال للمديرين
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(admin_id, forward_text)
-        except Exception as e:
-            logger.error(f"Error forwarding message to admin {admin_id}: {e}")
+    admin_notifier.notify(forward_text)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if not ADMIN_IDS:
         ADMIN_IDS.append(user_id)
+        set_admin_ids(ADMIN_IDS)
         await update.message.reply_text(
             "*👑 تم تعيينك كمشرف رئيسي للبوت!\n\n*"
             "يمكنك الآن استخدام لوحة التحكم للإدارة الكاملة للبوت.",
@@ -470,24 +3607,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    users = BotDatabase.read_json(USERS_FILE)
     user_key = str(user_id)
+    user_data = await db.get_user(user_key)
     
-    if user_key in users:
-        user_data = users[user_key]
+    if user_data is not None:
         if user_data.get("approved", False):
             # التحقق من الاشتراك الإجباري - يستخدم قنوات الاشتراك الإجباري فقط
-            if BotDatabase.get_setting("subscription.enabled"):
+            if db.settings.subscription.enabled:
                 if not await check_subscription(user_id, context):
-                    channels = BotDatabase.get_subscription_channels()  # استخدام القنوات الصحيحة
+                    channels = await db.get_subscription_channels()  # استخدام القنوات الصحيحة
                     channels_text = "\n".join([f"• {ch}" for ch in channels])
                     
                     await update.message.reply_text(
-                        f"{BotDatabase.get_setting('subscription.message')}\n\n"
+                        f"{db.settings.subscription.message}\n\n"
                         f"القنوات المطلوبة:\n{channels_text}\n\n"
                         "بعد الاشتراك، اضغط على /start مرة أخرى",
                         parse_mode='Markdown',
-                        reply_markup=ReplyKeyboardMarkup([["✅ تحقق من الاشتراك"]], resize_keyboard=True)
+                        reply_markup=KeyboardManager.get_subscribe_check_keyboard()
                     )
                     return
             
@@ -519,26 +3655,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
     else:
         # مستخدم جديد
-        BotDatabase.add_user(user_id, update.effective_user.username, update.effective_user.first_name)
+        await db.add_user(user_id, update.effective_user.username, update.effective_user.first_name)
         
-        for admin_id in ADMIN_IDS:
-            try:
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ قبول", callback_data=f"accept_{user_key}"),
-                     InlineKeyboardButton("❌ رفض", callback_data=f"reject_{user_key}")],
-                    [InlineKeyboardButton("📋 طلبات الانضمام", callback_data="view_requests")]
-                ])
-                
-                await context.bot.send_message(
-                    admin_id,
-                    f"📥 طلب انضمام جديد!\n\n"
-                    f"👤 المستخدم: {update.effective_user.first_name}\n"
-                    f"🆔 الآيدي: {user_key}\n"
-                    f"📅 الوقت: {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-                    reply_markup=keyboard
-                )
-            except Exception as e:
-                logger.error(f"Error notifying admin: {e}")
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ قبول", callback_data=f"accept_{user_key}"),
+             InlineKeyboardButton("❌ رفض", callback_data=f"reject_{user_key}")],
+            [InlineKeyboardButton("📋 طلبات الانضمام", callback_data="view_requests")]
+        ])
+        admin_notifier.notify(
+            f"📥 طلب انضمام جديد!\n\n"
+            f"👤 المستخدم: {update.effective_user.first_name}\n"
+            f"🆔 الآيدي: {user_key}\n"
+            f"📅 الوقت: {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+            reply_markup=keyboard
+        )
         
         await update.message.reply_text(
             "✅ تم إرسال طلب انضمامك بنجاح!\n"
@@ -553,7 +3683,7 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     
     # التحقق من أن المستخدم مفعل
-    if not is_user_approved(user_id):
+    if not await is_user_approved(user_id):
         await update.message.reply_text(
             "⏳ طلبك قيد المراجعة من قبل المدير...\n"
             "سيتم إعلامك فور الموافقة على طلبك.",
@@ -562,98 +3692,97 @@ async def handle_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     # التحقق من الاشتراك الإجباري
-    if BotDatabase.get_setting("subscription.enabled"):
+    if db.settings.subscription.enabled:
         if not await check_subscription(user_id, context):
-            channels = BotDatabase.get_subscription_channels()  # استخدام القنوات الصحيحة
+            channels = await db.get_subscription_channels()  # استخدام القنوات الصحيحة
             channels_text = "\n".join([f"• {ch}" for ch in channels])
             
             await update.message.reply_text(
-                f"{BotDatabase.get_setting('subscription.message')}\n\n"
+                f"{db.settings.subscription.message}\n\n"
                 f"القنوات المطلوبة:\n{channels_text}\n\n"
                 "بعد الاشتراك، اضغط على /start مرة أخرى",
-                reply_markup=ReplyKeyboardMarkup([["✅ تحقق من الاشتراك"]], resize_keyboard=True)
+                reply_markup=KeyboardManager.get_subscribe_check_keyboard()
             )
             return
     
-    if text == "📺 قنوات نسونجي":
-        await show_channels_to_user(update, context)
-        await forward_user_action(update, context, "عرض القنوات", "قام المستخدم بعرض قائمة القنوات")
-    elif text == "🔍 ID":
-        await ask_for_content_id(update, context)
-        await forward_user_action(update, context, "طلب إدخال ID", "قام المستخدم بطلب إدخال رقم المحتوى")
-    elif text == "ℹ️ المساعدة":
-        await update.message.reply_text(BotDatabase.get_setting("responses.help"))
-        await forward_user_action(update, context, "طلب المساعدة", "قام المستخدم بطلب المساعدة")
-    elif text == "✅ تحقق من الاشتراك":
-        if await check_subscription(update.effective_user.id, context):
-            await update.message.reply_text(
-                BotDatabase.get_setting("responses.subscribe_success"),
-                reply_markup=KeyboardManager.get_user_keyboard()
-            )
-            await forward_user_action(update, context, "تحقق من الاشتراك", "نجح التحقق من الاشتراك")
-        else:
-            channels = BotDatabase.get_subscription_channels()  # استخدام القنوات الصحيحة
-            channels_text = "\n".join([f"• {ch}" for ch in channels])
-            await update.message.reply_text(
-                f"{BotDatabase.get_setting('responses.subscribe_failed')}\n\n"
-                f"يجب الاشتراك في:\n{channels_text}"
-            )
-            await forward_user_action(update, context, "تحقق من الاشتراك", "فشل التحقق من الاشتراك")
-    elif text == "🏠 الرئيسية":
-        await update.message.reply_text("🏠 العودة للرئيسية", reply_markup=KeyboardManager.get_user_keyboard())
-        await forward_user_action(update, context, "العودة للرئيسية", "قام المستخدم بالعودة للصفحة الرئيسية")
-    elif text == "⏳ انتظر الموافقة":
+    await router.dispatch(update, context, text, admin=False)
+
+def with_action(handler, action_type, details):
+    """دالة زر تنفذ handler ثم تحول الإجراء للمديرين"""
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await handler(update, context)
+        await forward_user_action(update, context, action_type, details)
+    return route
+
+async def show_user_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(db.settings.responses.help)
+
+async def verify_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await check_subscription(update.effective_user.id, context):
         await update.message.reply_text(
-            "⏳ طلبك قيد المراجعة من قبل المدير...\n"
-            "سيتم إعلامك فور الموافقة على طلبك.",
-            reply_markup=KeyboardManager.get_waiting_keyboard()
+            db.settings.responses.subscribe_success,
+            reply_markup=KeyboardManager.get_user_keyboard()
         )
+        await forward_user_action(update, context, "تحقق من الاشتراك", "نجح التحقق من الاشتراك")
     else:
-        await handle_channel_selection(update, context, text)
+        channels = await db.get_subscription_channels()  # استخدام القنوات الصحيحة
+        channels_text = "\n".join([f"• {ch}" for ch in channels])
+        await update.message.reply_text(
+            f"{db.settings.responses.subscribe_failed}\n\n"
+            f"يجب الاشتراك في:\n{channels_text}"
+        )
+        await forward_user_action(update, context, "تحقق من الاشتراك", "فشل التحقق من الاشتراك")
+
+async def show_user_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("🏠 العودة للرئيسية", reply_markup=KeyboardManager.get_user_keyboard())
+
+async def show_waiting_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "⏳ طلبك قيد المراجعة من قبل المدير...\n"
+        "سيتم إعلامك فور الموافقة على طلبك.",
+        reply_markup=KeyboardManager.get_waiting_keyboard()
+    )
 
 async def show_channels_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    channels = BotDatabase.get_channels()  # قنوات البوت العادية فقط
+    keyboard = await KeyboardManager.get_channels_keyboard()  # قنوات البوت العادية فقط
     
-    if not channels:
+    if keyboard is None:
         await update.message.reply_text("📭 لا توجد قنوات متاحة حالياً.")
         return
     
     await update.message.reply_text(
         "📺 قنوات نسونجي:\nاختر القناة التي تريد زيارتها:",
-        reply_markup=KeyboardManager.get_channels_keyboard()
+        reply_markup=keyboard
     )
 
 async def ask_for_content_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🔍 أدخل رقم المحتوى (ID):",
-        reply_markup=ReplyKeyboardMarkup([["🏠 الرئيسية"]], resize_keyboard=True)
+        reply_markup=KeyboardManager.get_back_keyboard()
     )
     context.user_data['waiting_for_id'] = True
 
-async def handle_channel_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
-    channels = BotDatabase.get_channels()  # قنوات البوت العادية فقط
-    
-    for channel in channels:
-        if text == f"📺 {channel['name']}":
-            await update.message.reply_text(
-                f"📺 {channel['name']}\n\n"
-                f"رابط القناة: {channel['link']}\n\n"
-                "انقر على الزر أدناه لزيارة القناة:",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📺 زيارة القناة", url=channel['link'])],
-                    [InlineKeyboardButton("🔙 رجوع", callback_data="back_to_channels")]
-                ])
-            )
-            await forward_user_action(update, context, "زيارة قناة", f"اختار المستخدم قناة: {channel['name']}")
-            return
-    
+async def show_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, channel: dict):
+    await update.message.reply_text(
+        f"📺 {channel['name']}\n\n"
+        f"رابط القناة: {channel['link']}\n\n"
+        "انقر على الزر أدناه لزيارة القناة:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("📺 زيارة القناة", url=channel['link'])],
+            [InlineKeyboardButton("🔙 رجوع", callback_data="back_to_channels")]
+        ])
+    )
+    await forward_user_action(update, context, "زيارة قناة", f"اختار المستخدم قناة: {channel['name']}")
+
+async def handle_free_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """نص لا يطابق أي زر قائمة أو قناة (أزرار القنوات يوجهها router)"""
     # معالجة إدخال ID
     if context.user_data.get('waiting_for_id'):
         try:
             content_id = int(text)
-            content = BotDatabase.get_content_by_id(content_id)
+            content = await get_content_payload(content_id)
             if content:
-                await show_content_item_from_message(update, context, content_id)
+                await send_content(context.bot, update.effective_chat.id, content)
                 await forward_user_action(update, context, "عرض محتوى", f"عرض المحتوى برقم: {content_id} - {content['title']}")
             else:
                 await update.message.reply_text("❌ لم يتم العثور على محتوى بهذا الرقم.")
@@ -672,127 +3801,75 @@ async def handle_channel_selection(update: Update, context: ContextTypes.DEFAULT
     else:
         await update.message.reply_text("❌ لم أفهم طلبك. اختر من القائمة أدناه:", reply_markup=KeyboardManager.get_admin_keyboard())
 
+# نوع المحتوى -> (دالة الإرسال في Bot، اسم معامل الملف، رمز العنوان)
+MEDIA_SENDERS = {
+    "photo": ("send_photo", "photo", "🖼️"),
+    "video": ("send_video", "video", "🎬"),
+    "document": ("send_document", "document", "📄"),
+}
+
+def content_payload(content_item):
+    """ما يرسل لعرض عنصر محتوى. العناصر النصية المضافة قبل حفظ النص الجاهز تجهز هنا"""
+    payload = {"title": content_item['title'], "content_type": content_item['content_type']}
+    if content_item['content_type'] == 'text':
+        rendered = content_item.get('rendered') or render_text_content(content_item['title'], content_item.get('text_content', ''))
+        payload.update(rendered)
+    elif content_item['content_type'] in MEDIA_SENDERS:
+        payload["file_id"] = content_item['file_id']
+        payload["caption"] = f"{MEDIA_SENDERS[content_item['content_type']][2]} {content_item['title']}"
+    return payload
+
+async def get_content_payload(content_id):
+    payload = content_cache.get(content_id)
+    if payload is None:
+        version = BotDatabase.content_version
+        content_item = await db.get_content_by_id(content_id)
+        if content_item is None:
+            return None
+        payload = content_payload(content_item)
+        content_cache.set(content_id, payload, version)
+    return payload
+
+async def send_content(bot, chat_id, payload):
+    """إرسال عنصر محتوى جاهز، والأجزاء النصية متتالية عبر حدود الإرسال لكل محادثة"""
+    if payload["content_type"] == "text":
+        for chunk in payload["chunks"]:
+            parse_mode = payload["parse_mode"]
+            if parse_mode and markdown_entities(chunk) is None:
+                # جزء من عنصر قديم قطع داخل كيان: هذا الجزء وحده كنص عادي
+                parse_mode = None
+            sent = await send_with_retry(chat_id, lambda chat_id: bot.send_message(chat_id, chunk, parse_mode=parse_mode))
+            if not sent and parse_mode:
+                # عنصر قديم رفض تليجرام تنسيقه: نفس الجزء كنص عادي
+                sent = await send_with_retry(chat_id, lambda chat_id: bot.send_message(chat_id, chunk))
+            if not sent:
+                return False
+        return True
+    
+    if payload["content_type"] not in MEDIA_SENDERS:
+        return False
+    method, argument, _ = MEDIA_SENDERS[payload["content_type"]]
+    return await send_with_retry(chat_id, lambda chat_id: getattr(bot, method)(
+        chat_id, **{argument: payload["file_id"]}, caption=payload["caption"]
+    ))
+
 async def show_content_item_from_message(update: Update, context: ContextTypes.DEFAULT_TYPE, content_id: int):
-    """عرض عنصر محتوى من رسالة عادية"""
-    content_item = BotDatabase.get_content_by_id(content_id)
+    """عرض عنصر محتوى، ويعيد بياناته الجاهزة أو None إن لم يكن موجوداً"""
+    payload = await get_content_payload(content_id)
     
-    if not content_item:
-        await update.message.reply_text("❌ المحتوى غير موجود.")
-        return
+    if payload is None:
+        await context.bot.send_message(update.effective_chat.id, "❌ المحتوى غير موجود.")
+        return None
     
-    try:
-        if content_item['content_type'] == 'text':
-            message_text = f"**{content_item['title']}**\n\n{content_item['text_content']}"
-            
-            if len(message_text) > 4096:
-                parts = [message_text[i:i+4096] for i in range(0, len(message_text), 4096)]
-                for i, part in enumerate(parts):
-                    await update.message.reply_text(part, parse_mode='Markdown')
-            else:
-                await update.message.reply_text(message_text, parse_mode='Markdown')
-            
-        elif content_item['content_type'] == 'photo':
-            await update.message.reply_photo(
-                photo=content_item['file_id'],
-                caption=f"🖼️ {content_item['title']}",
-                parse_mode='Markdown'
-            )
-            
-        elif content_item['content_type'] == 'video':
-            await update.message.reply_video(
-                video=content_item['file_id'],
-                caption=f"🎬 {content_item['title']}",
-                parse_mode='Markdown'
-            )
-            
-        elif content_item['content_type'] == 'document':
-            await update.message.reply_document(
-                document=content_item['file_id'],
-                caption=f"📄 {content_item['title']}",
-                parse_mode='Markdown'
-            )
-            
-    except Exception as e:
-        logger.error(f"Error showing content {content_id}: {e}")
-        await update.message.reply_text(
-            f"📖 {content_item['title']}\n\n{content_item.get('text_content', 'المحتوى غير متوفر')}"
-        )
+    if not await send_content(context.bot, update.effective_chat.id, payload):
+        logger.error(f"Error showing content {content_id} to {update.effective_chat.id}")
+    return payload
 
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
-    user_id = update.effective_user.id
-    
-    if text == "👑 لوحة التحكم":
-        await show_admin_dashboard(update, context)
-    elif text == "👥 إدارة المستخدمين":
-        await show_user_management(update, context)
-    elif text == "📊 الإحصائيات":
-        await show_statistics(update, context)
-    elif text == "📺 إدارة القنوات":
-        await show_channels_management(update, context)
-    elif text == "🎭 إدارة المحتوى":
-        await show_content_management(update, context)
-    elif text == "📢 الاشتراك الإجباري":
-        await show_subscription_management(update, context)
-    elif text == "⚙️ الإعدادات العامة":
-        await show_settings_management(update, context)
-    elif text == "📤 البث للمستخدمين":
-        await show_broadcast_management(update, context)
-    elif text == "💾 النسخ الاحتياطي":
-        await show_backup_management(update, context)
-    elif text == "📺 قنوات نسونجي":
-        await show_channels_to_user(update, context)
-    elif text == "🔍 ID":
-        await ask_for_content_id(update, context)
-    elif text == "🏠 الرئيسية":
-        await update.message.reply_text("🏠 العودة للرئيسية", reply_markup=KeyboardManager.get_admin_keyboard())
-    elif text == "📋 طلبات الانتظار":
-        await show_pending_requests(update, context)
-    elif text == "👀 المستخدمين النشطين":
-        await show_active_users(update, context)
-    elif text == "🗑️ حذف مستخدم":
-        await start_delete_user(update, context)
-    elif text == "➕ إضافة قناة":
-        await start_add_channel(update, context)
-    elif text == "🗑️ حذف قناة":
-        await start_delete_channel(update, context)
-    elif text == "📋 عرض القنوات":
-        await show_all_channels(update, context)
-    elif text == "➕ إضافة محتوى":
-        await start_add_content(update, context)
-    elif text == "🗑️ حذف محتوى":
-        await start_delete_content(update, context)
-    elif text == "📋 عرض المحتوى":
-        await show_all_content(update, context)
-    elif text == "🔔 تفعيل/إلغاء":
-        await toggle_subscription(update, context)
-    elif text == "✏️ تعديل الرسالة":
-        await start_edit_subscription_message(update, context)
-    elif text == "📝 إضافة قناة اشتراك":
-        await start_add_subscription_channel(update, context)
-    elif text == "🗑️ حذف قناة اشتراك":
-        await start_delete_subscription_channel(update, context)
-    elif text == "📋 عرض قنوات الاشتراك":
-        await show_subscription_channels(update, context)
-    elif text == "✏️ تعديل رسالة الترحيب":
-        await start_edit_response(update, context, "welcome")
-    elif text == "✏️ تعديل رسالة الرفض":
-        await start_edit_response(update, context, "rejected")
-    elif text == "✏️ تعديل رسالة المساعدة":
-        await start_edit_response(update, context, "help")
-    elif text == "🔔 تفعيل/إلغاء التحويل":
-        await toggle_forwarding(update, context)
-    elif text == "📢 بث لجميع المستخدمين":
-        await start_broadcast(update, context)
-    elif text == "👤 بث لمستخدم محدد":
-        await start_send_to_user(update, context)
-    elif text == "💾 تنزيل نسخة":
-        await download_backup(update, context)
-    elif text == "🔄 رفع نسخة":
-        await start_restore_backup(update, context)
-    elif text == "📋 عرض النسخ":
-        await show_backups(update, context)
-    else:
-        await handle_channel_selection(update, context, text)
+    await router.dispatch(update, context, text, admin=True)
+
+async def show_admin_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("🏠 العودة للرئيسية", reply_markup=KeyboardManager.get_admin_keyboard())
 
 # دالة handle_message الموحدة
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -800,7 +3877,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     
     # التحقق من أن المستخدم مفعل أولاً
-    if not is_user_approved(user_id) and not is_admin(user_id):
+    if not await is_user_approved(user_id) and not is_admin(user_id):
         await update.message.reply_text(
             "⏳ طلبك قيد المراجعة من قبل المدير...\n"
             "سيتم إعلامك فور الموافقة على طلبك.",
@@ -814,17 +3891,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await handle_user_message(update, context, text)
 
 async def show_admin_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users = BotDatabase.read_json(USERS_FILE)
-    content = BotDatabase.get_all_content()
-    channels = BotDatabase.get_channels()
-    subscription_channels = BotDatabase.get_subscription_channels()
-    
-    active_users = len([u for u in users.values() if u.get('approved', False)])
-    total_users = len(users)
-    pending_requests = len(BotDatabase.get_pending_requests())
-    channels_count = len(channels)
-    subscription_channels_count = len(subscription_channels)
-    content_count = len(content)
+    stats = await db.get_stats()
+    
+    active_users = stats.approved_users
+    pending_requests = stats.pending_users
+    channels_count = stats.channels
+    subscription_channels_count = stats.subscription_channels
+    content_count = stats.content_count
     
     stats_text = (
         "👑 لوحة تحكم المدير\n\n"
@@ -840,8 +3913,9 @@ async def show_admin_dashboard(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text(stats_text, reply_markup=KeyboardManager.get_admin_keyboard())
 
 async def show_user_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    pending_count = len(BotDatabase.get_pending_requests())
-    active_count = len(BotDatabase.get_approved_users())
+    stats = await db.get_stats()
+    pending_count = stats.pending_users
+    active_count = stats.approved_users
     
     text = (
         "👥 إدارة المستخدمين\n\n"
@@ -854,8 +3928,7 @@ async def show_user_management(update: Update, context: ContextTypes.DEFAULT_TYP
     await update.message.reply_text(text, reply_markup=KeyboardManager.get_user_management_keyboard())
 
 async def show_pending_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    pending_users = BotDatabase.get_pending_requests()
-    users_data = BotDatabase.read_json(USERS_FILE)
+    pending_users = await db.get_pending_requests()
     
     if not pending_users:
         await update.message.reply_text("📭 لا توجد طلبات انضمام معلقة.")
@@ -863,7 +3936,7 @@ async def show_pending_requests(update: Update, context: ContextTypes.DEFAULT_TY
     
     text = "📋 طلبات الانضمام المعلقة:\n\n"
     for user_id in pending_users[:5]:
-        user_data = users_data.get(user_id, {})
+        user_data = await db.get_user(user_id) or {}
         text += f"👤 {user_data.get('first_name', 'Unknown')}\n"
         text += f"🆔 {user_id}\n"
         text += f"📅 {user_data.get('join_date', '')[:10]}\n"
@@ -877,8 +3950,7 @@ async def show_pending_requests(update: Update, context: ContextTypes.DEFAULT_TY
         text = "─" * 30 + "\n"
 
 async def show_active_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    active_users = BotDatabase.get_approved_users()
-    users_data = BotDatabase.read_json(USERS_FILE)
+    active_users = await db.get_approved_users()
     
     if not active_users:
         await update.message.reply_text("👥 لا يوجد مستخدمين نشطين.")
@@ -886,7 +3958,7 @@ async def show_active_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     text = f"👥 المستخدمين النشطين ({len(active_users)}):\n\n"
     for user_id in active_users[:15]:
-        user_data = users_data.get(user_id, {})
+        user_data = await db.get_user(user_id) or {}
         text += f"👤 {user_data.get('first_name', 'Unknown')}\n"
         text += f"🆔 {user_id}\n"
         text += f"📅 {user_data.get('join_date', '')[:10]}\n"
@@ -904,17 +3976,10 @@ async def start_delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.text.strip()
-    users = BotDatabase.read_json(USERS_FILE)
+    user_data = await db.remove_user(user_id)
     
-    if user_id in users:
-        user_name = users[user_id]['first_name']
-        del users[user_id]
-        BotDatabase.write_json(USERS_FILE, users)
-        
-        requests = BotDatabase.read_json(REQUESTS_FILE)
-        requests = [r for r in requests if r['user_id'] != user_id]
-        BotDatabase.write_json(REQUESTS_FILE, requests)
-        
+    if user_data is not None:
+        user_name = user_data['first_name']
         await update.message.reply_text(f"✅ تم حذف المستخدم: {user_name}")
     else:
         await update.message.reply_text("❌ لم يتم العثور على المستخدم.")
@@ -922,17 +3987,18 @@ async def delete_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    users = BotDatabase.read_json(USERS_FILE)
-    content = BotDatabase.get_all_content()
-    channels = BotDatabase.get_channels()
-    subscription_channels = BotDatabase.get_subscription_channels()
-    
-    active_users = len(BotDatabase.get_approved_users())
-    total_users = len(users)
-    pending_requests = len(BotDatabase.get_pending_requests())
-    channels_count = len(channels)
-    subscription_channels_count = len(subscription_channels)
-    content_count = len(content)
+    stats = await db.get_stats()
+    
+    active_users = stats.approved_users
+    total_users = stats.total_users
+    pending_requests = stats.pending_users
+    channels_count = stats.channels
+    subscription_channels_count = stats.subscription_channels
+    content_count = stats.content_count
+    content_types_text = "".join(
+        f"  - {content_type}: {count}\n" for content_type, count in sorted(stats.content_by_type.items())
+    )
+    routes_text = "\n".join(f"• {route}: {count}" for route, count in router.top(10))
     
     text = (
         "📊 الإحصائيات التفصيلية\n\n"
@@ -944,16 +4010,96 @@ async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🎭 المحتوى:\n"
         f"• قنوات البوت: {channels_count}\n"
         f"• قنوات الاشتراك: {subscription_channels_count}\n"
-        f"• العناصر: {content_count}\n\n"
+        f"• العناصر: {content_count}\n"
+        f"{content_types_text}\n"
         f"⚙️ الإعدادات:\n"
-        f"• الاشتراك الإجباري: {'✅ مفعل' if BotDatabase.get_setting('subscription.enabled') else '❌ معطل'}\n"
-        f"• التحويل: {'✅ مفعل' if BotDatabase.get_setting('forwarding.enabled') else '❌ معطل'}"
+        f"• الاشتراك الإجباري: {'✅ مفعل' if db.settings.subscription.enabled else '❌ معطل'}\n"
+        f"• التحويل: {'✅ مفعل' if db.settings.forwarding.enabled else '❌ معطل'}\n"
+        f"• وضع التحويل: {'📋 ملخص دوري' if db.settings.forwarding.mode == 'digest' else '⚡ فوري'}\n\n"
+        f"⏱️ تأخر حلقة الأحداث:\n"
+        f"• الحالي: {loop_lag.last_ms:.1f} ms\n"
+        f"• p99: {loop_lag.p99_ms:.1f} ms\n"
+        f"• الأقصى: {loop_lag.max_ms:.1f} ms\n\n"
+        f"🔔 ذاكرة التحقق من الاشتراك:\n"
+        f"• النتائج المحفوظة: {len(membership_cache)}\n"
+        f"• من الذاكرة: {membership_cache.hits}\n"
+        f"• من تليجرام: {membership_cache.misses}\n"
+        f"• نسبة الإصابة: {membership_cache.hit_rate:.1f}%\n\n"
+        f"👥 جدول العضوية المحلي:\n"
+        f"• القنوات المراقبة: {len(membership_table.chat_ids)} من {subscription_channels_count}\n"
+        f"• العضويات المعروفة: {len(membership_table)}\n"
+        f"• من الجدول: {membership_table.hits}\n"
+        f"• مستخدمون جدد (من تليجرام): {membership_table.misses}\n\n"
+        f"📦 ذاكرة المحتوى الجاهز:\n"
+        f"• العناصر المحفوظة: {len(content_cache)}\n"
+        f"• نسبة الإصابة: {content_cache.hit_rate:.1f}%\n\n"
+        f"🧭 أكثر الأزرار استخداماً:\n"
+        f"{routes_text or '• لا يوجد بعد'}"
+    )
+    
+    await update.message.reply_text(text)
+
+async def recount_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """الأمر /recount: إعادة حساب العدادات من البيانات الفعلية"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    old_stats = await db.get_stats()
+    stats = await db.recount_stats()
+    drift = (
+        old_stats.total_users != stats.total_users
+        or old_stats.approved_users != stats.approved_users
+        or old_stats.content_by_type != stats.content_by_type
+        or old_stats.channels != stats.channels
+        or old_stats.subscription_channels != stats.subscription_channels
     )
     
+    await update.message.reply_text(
+        "🔄 تمت إعادة حساب الإحصائيات\n\n"
+        f"• الإجمالي: {stats.total_users}\n"
+        f"• النشطين: {stats.approved_users}\n"
+        f"• طلبات الانتظار: {stats.pending_users}\n"
+        f"• المحتوى: {stats.content_count}\n"
+        f"• قنوات البوت: {stats.channels}\n"
+        f"• قنوات الاشتراك: {stats.subscription_channels}\n\n"
+        f"{'⚠️ تم تصحيح اختلاف في العدادات.' if drift else '✅ العدادات كانت صحيحة.'}"
+    )
+
+async def migrate_storage_engine(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """الأمر /migrate <json|sqlite>: نقل البيانات إلى محرك تخزين آخر دون إيقاف البوت"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    current = BotDatabase.engine.name
+    if len(context.args) != 1 or context.args[0].lower() not in PERSISTENT_STORAGE_ENGINES:
+        await update.message.reply_text(
+            f"الاستخدام: /migrate {'|'.join(PERSISTENT_STORAGE_ENGINES)}\n"
+            f"المحرك الحالي: {current}"
+        )
+        return
+    
+    name = context.args[0].lower()
+    if name == current:
+        await update.message.reply_text(f"ℹ️ البيانات مخزنة في {name} بالفعل")
+        return
+    
+    await update.message.reply_text(f"⏳ جاري نقل البيانات من {current} إلى {name}...")
+    try:
+        counts = await db.switch_engine(name)
+    except Exception as e:
+        logger.error(f"Error migrating storage from {current} to {name}: {e}")
+        await update.message.reply_text(f"❌ فشل النقل، وما زال البوت يستخدم {current}:\n{e}")
+        return
+    # قنوات الاشتراك تقرأ الآن من المحرك الجديد
+    await membership_table.refresh(context.bot, await db.get_subscription_channels())
+    
+    text = f"✅ تم نقل البيانات إلى {name}\n\n"
+    for collection, count in counts.items():
+        text += f"• {collection}: {count}\n"
     await update.message.reply_text(text)
 
 async def show_channels_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    channels = BotDatabase.get_channels()  # قنوات البوت العادية فقط
+    channels = await db.get_channels()  # قنوات البوت العادية فقط
     
     text = "📺 إدارة قنوات البوت\n\n"
     if channels:
@@ -981,6 +4127,10 @@ async def add_channel_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not channel_name:
         await update.message.reply_text("❌ الرجاء إدخال اسم صحيح للقناة.")
         return ADD_CHANNEL_NAME
+    
+    if await router.channel_name_taken(channel_name):
+        await update.message.reply_text("❌ يوجد زر بنفس هذا الاسم، أرسل اسماً آخر للقناة:")
+        return ADD_CHANNEL_NAME
         
     context.user_data['channel_name'] = channel_name
     
@@ -998,7 +4148,7 @@ async def add_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ الرجاء إدخال رابط صحيح للقناة.")
         return ADD_CHANNEL_LINK
     
-    channel_id = BotDatabase.add_channel(channel_name, channel_link)
+    channel_id = await db.add_channel(channel_name, channel_link)
     
     await update.message.reply_text(
         f"✅ تم إضافة قناة البوت بنجاح!\n\n"
@@ -1011,7 +4161,7 @@ async def add_channel_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def start_delete_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    channels = BotDatabase.get_channels()  # قنوات البوت العادية فقط
+    channels = await db.get_channels()  # قنوات البوت العادية فقط
     
     if not channels:
         await update.message.reply_text("❌ لا توجد قنوات بوت لحذفها.")
@@ -1029,7 +4179,7 @@ async def start_delete_channel(update: Update, context: ContextTypes.DEFAULT_TYP
 async def delete_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         channel_id = int(update.message.text)
-        deleted_channel = BotDatabase.delete_channel(channel_id)
+        deleted_channel = await db.delete_channel(channel_id)
         
         if deleted_channel:
             await update.message.reply_text(
@@ -1045,7 +4195,7 @@ async def delete_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def show_all_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    channels = BotDatabase.get_channels()  # قنوات البوت العادية فقط
+    channels = await db.get_channels()  # قنوات البوت العادية فقط
     
     if not channels:
         await update.message.reply_text("📭 لا توجد قنوات بوت.")
@@ -1061,8 +4211,7 @@ async def show_all_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 async def show_content_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    content_items = BotDatabase.get_all_content()
-    items_count = len(content_items)
+    items_count = (await db.get_stats()).content_count
     
     text = f"🎭 إدارة المحتوى\n\nإجمالي العناصر: {items_count}\n\n"
     text += "اختر الإجراء المطلوب:"
@@ -1080,15 +4229,9 @@ async def start_add_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def add_content_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['content_title'] = update.message.text
     
-    keyboard = ReplyKeyboardMarkup([
-        ["📝 نص", "🖼️ صورة"],
-        ["🎬 فيديو", "📄 ملف"],
-        ["🏠 الرئيسية"]
-    ], resize_keyboard=True)
-    
     await update.message.reply_text(
         "اختر نوع المحتوى:",
-        reply_markup=keyboard
+        reply_markup=KeyboardManager.get_content_type_keyboard()
     )
     return ADD_CONTENT_TYPE
 
@@ -1138,7 +4281,7 @@ async def add_content_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['text_content'] = text_content
         
         # إنشاء المحتوى
-        new_content = BotDatabase.add_content(
+        new_content = await db.add_content(
             context.user_data['content_title'],
             context.user_data['content_type'],
             text_content,
@@ -1214,7 +4357,7 @@ async def add_content_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if file_id:
         # إنشاء المحتوى
-        new_content = BotDatabase.add_content(
+        new_content = await db.add_content(
             context.user_data['content_title'],
             context.user_data['content_type'],
             "",
@@ -1238,7 +4381,7 @@ async def add_content_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ADD_CONTENT_FILE
 
 async def start_delete_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    content_items = BotDatabase.get_all_content()
+    content_items = await db.get_all_content()
     
     if not content_items:
         await update.message.reply_text("❌ لا يوجد محتوى لحذفه.")
@@ -1259,7 +4402,7 @@ async def start_delete_content(update: Update, context: ContextTypes.DEFAULT_TYP
 async def delete_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         content_id = int(update.message.text)
-        deleted_content = BotDatabase.delete_content(content_id)
+        deleted_content = await db.delete_content(content_id)
         
         if deleted_content:
             await update.message.reply_text(
@@ -1275,7 +4418,7 @@ async def delete_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def show_all_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    content_items = BotDatabase.get_all_content()
+    content_items = await db.get_all_content()
     
     if not content_items:
         await update.message.reply_text("📭 لا يوجد محتوى.")
@@ -1294,23 +4437,24 @@ async def show_all_content(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text)
 
 async def show_subscription_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    enabled = BotDatabase.get_setting("subscription.enabled")
-    channels = BotDatabase.get_subscription_channels()  # استخدام القنوات الصحيحة
+    enabled = db.settings.subscription.enabled
+    channels = await db.get_subscription_channels()  # استخدام القنوات الصحيحة
     
     text = (
         "📢 إدارة الاشتراك الإجباري\n\n"
         f"الحالة: {'✅ مفعل' if enabled else '❌ معطل'}\n"
         f"عدد القنوات: {len(channels)}\n"
-        f"الرسالة: {BotDatabase.get_setting('subscription.message')}\n\n"
+        f"الرسالة: {db.settings.subscription.message}\n\n"
         "اختر الإجراء:"
     )
     
     await update.message.reply_text(text, reply_markup=KeyboardManager.get_subscription_management_keyboard())
 
 async def toggle_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_state = BotDatabase.get_setting("subscription.enabled")
-    new_state = not current_state
-    BotDatabase.set_setting("subscription.enabled", new_state)
+    async with db.transaction('settings') as settings:
+        subscription = settings.setdefault("subscription", {})
+        new_state = not subscription.get("enabled", False)
+        subscription["enabled"] = new_state
     
     await update.message.reply_text(
         f"✅ تم {'تفعيل' if new_state else 'إلغاء تفعيل'} الاشتراك الإجباري.",
@@ -1320,7 +4464,7 @@ async def toggle_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def start_edit_subscription_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "✏️ تعديل رسالة الاشتراك الإجباري\n\n"
-        f"الرسالة الحالية:\n{BotDatabase.get_setting('subscription.message')}\n\n"
+        f"الرسالة الحالية:\n{db.settings.subscription.message}\n\n"
         "أرسل الرسالة الجديدة:",
         reply_markup=KeyboardManager.get_back_keyboard()
     )
@@ -1328,7 +4472,7 @@ async def start_edit_subscription_message(update: Update, context: ContextTypes.
 
 async def edit_subscription_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_message = update.message.text
-    BotDatabase.set_setting("subscription.message", new_message)
+    await db.set_setting("subscription.message", new_message)
     
     await update.message.reply_text(
         "✅ تم تحديث رسالة الاشتراك الإجباري.",
@@ -1347,7 +4491,8 @@ async def start_add_subscription_channel(update: Update, context: ContextTypes.D
 async def add_subscription_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     channel = update.message.text.strip()
     
-    if BotDatabase.add_subscription_channel(channel):
+    if await db.add_subscription_channel(channel):
+        await membership_table.refresh(context.bot, await db.get_subscription_channels())
         await update.message.reply_text(
             f"✅ تم إضافة قناة الاشتراك: {channel}",
             reply_markup=KeyboardManager.get_subscription_management_keyboard()
@@ -1361,7 +4506,7 @@ async def add_subscription_channel(update: Update, context: ContextTypes.DEFAULT
     return ConversationHandler.END
 
 async def start_delete_subscription_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    channels = BotDatabase.get_subscription_channels()  # استخدام القنوات الصحيحة
+    channels = await db.get_subscription_channels()  # استخدام القنوات الصحيحة
     
     if not channels:
         await update.message.reply_text("❌ لا توجد قنوات اشتراك لحذفها.")
@@ -1379,9 +4524,10 @@ async def start_delete_subscription_channel(update: Update, context: ContextType
 async def delete_subscription_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         channel_index = int(update.message.text) - 1
-        deleted_channel = BotDatabase.delete_subscription_channel(channel_index)
+        deleted_channel = await db.delete_subscription_channel(channel_index)
         
         if deleted_channel:
+            await membership_table.refresh(context.bot, await db.get_subscription_channels())
             await update.message.reply_text(
                 f"✅ تم حذف قناة الاشتراك: {deleted_channel}",
                 reply_markup=KeyboardManager.get_subscription_management_keyboard()
@@ -1395,7 +4541,7 @@ async def delete_subscription_channel(update: Update, context: ContextTypes.DEFA
     return ConversationHandler.END
 
 async def show_subscription_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    channels = BotDatabase.get_subscription_channels()  # استخدام القنوات الصحيحة
+    channels = await db.get_subscription_channels()  # استخدام القنوات الصحيحة
     
     if not channels:
         await update.message.reply_text("📭 لا توجد قنوات اشتراك مسجلة.")
@@ -1418,7 +4564,7 @@ async def show_settings_management(update: Update, context: ContextTypes.DEFAULT
 
 async def start_edit_response(update: Update, context: ContextTypes.DEFAULT_TYPE, response_type: str):
     context.user_data['response_type'] = response_type
-    current_message = BotDatabase.get_setting(f"responses.{response_type}")
+    current_message = db.settings.responses.get(response_type)
     
     response_names = {
         "welcome": "رسالة الترحيب",
@@ -1438,7 +4584,7 @@ async def edit_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     response_type = context.user_data['response_type']
     new_message = update.message.text
     
-    BotDatabase.set_setting(f"responses.{response_type}", new_message)
+    await db.set_setting(f"responses.{response_type}", new_message)
     
     response_names = {
         "welcome": "رسالة الترحيب",
@@ -1453,17 +4599,36 @@ async def edit_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def toggle_forwarding(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_state = BotDatabase.get_setting("forwarding.enabled")
-    new_state = not current_state
-    BotDatabase.set_setting("forwarding.enabled", new_state)
+    async with db.transaction('settings') as settings:
+        forwarding = settings.setdefault("forwarding", {})
+        new_state = not forwarding.get("enabled", False)
+        forwarding["enabled"] = new_state
     
     await update.message.reply_text(
         f"✅ تم {'تفعيل' if new_state else 'إلغاء تفعيل'} نظام التحويل.",
         reply_markup=KeyboardManager.get_settings_keyboard()
     )
 
+async def toggle_forwarding_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with db.transaction('settings') as settings:
+        forwarding = settings.setdefault("forwarding", {})
+        new_mode = "immediate" if forwarding.get("mode") == "digest" else "digest"
+        forwarding["mode"] = new_mode
+    
+    if new_mode == "digest":
+        text = (
+            f"✅ وضع التحويل: ملخص كل {FORWARD_DIGEST_INTERVAL} ثانية "
+            f"أو كل {FORWARD_DIGEST_MAX_EVENTS} إجراء.\n"
+            f"يبقى التحويل فورياً لـ: {'، '.join(db.settings.forwarding.immediate_actions)}"
+        )
+    else:
+        # ما تجمع حتى الآن لا ينتظر الملخص التالي
+        action_digest.flush()
+        text = "✅ وضع التحويل: رسالة فورية لكل إجراء."
+    await update.message.reply_text(text, reply_markup=KeyboardManager.get_settings_keyboard())
+
 async def show_broadcast_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    active_users = len(BotDatabase.get_approved_users())
+    active_users = (await db.get_stats()).approved_users
     
     text = (
         "📤 البث للمستخدمين\n\n"
@@ -1476,34 +4641,55 @@ async def show_broadcast_management(update: Update, context: ContextTypes.DEFAUL
 async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "📢 بث لجميع المستخدمين\n\n"
-        "أرسل الرسالة التي تريد بثها لجميع المستخدمين:",
+        "أرسل الرسالة التي تريد بثها لجميع المستخدمين (نص، صورة، فيديو، ملف...):",
         reply_markup=KeyboardManager.get_back_keyboard()
     )
     return BROADCAST_MESSAGE
 
 async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = update.message.text
-    active_users = BotDatabase.get_approved_users()
-    
-    success_count = 0
-    fail_count = 0
-    
-    for user_id in active_users:
-        try:
-            await context.bot.send_message(int(user_id), message)
-            success_count += 1
-        except Exception as e:
-            fail_count += 1
+    """بث أي رسالة (نص، صورة، فيديو، ملف...) بنسخها من محادثة المدير.
+
+    النسخ يتم داخل خوادم تليجرام، فالوسائط ترفع مرة واحدة فقط ولا تنزل للبوت.
+    """
+    message = update.message
+    active_users = await db.get_approved_users()
+    bot = context.bot
     
-    await update.message.reply_text(
-        f"✅ تم إرسال الرسالة:\n"
-        f"• ✅ الناجح: {success_count}\n"
-        f"• ❌ الفاشل: {fail_count}",
+    status_message = await update.message.reply_text(
+        f"📤 بدأ البث إلى {len(active_users)} مستخدم، وستحدث هذه الرسالة بالتقدم.",
         reply_markup=KeyboardManager.get_admin_keyboard()
     )
+    payload = {"from_chat_id": message.chat_id, "message_id": message.message_id}
+    job = await db.run_on((), BroadcastJob.create, payload, active_users, status_message)
+    broadcasts.start(job, bot)
     
     return ConversationHandler.END
 
+async def show_broadcast_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not broadcasts.jobs:
+        await update.message.reply_text("📭 لا يوجد بث قيد التشغيل حالياً.")
+        return
+    
+    for job in broadcasts.jobs.values():
+        await update.message.reply_text(
+            f"🆔 {job.id}\n{job.progress_text()}",
+            reply_markup=KeyboardManager.get_broadcast_job_keyboard(job)
+        )
+
+async def broadcast_job_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, job_id: str):
+    if action not in ("pause", "resume", "cancel"):
+        return
+    
+    job = await broadcasts.set_state(job_id, action)
+    if job is None:
+        await update.callback_query.edit_message_text("❌ هذا البث انتهى أو غير موجود")
+        return
+    
+    await update.callback_query.edit_message_text(
+        f"🆔 {job.id}\n{job.progress_text()}",
+        reply_markup=KeyboardManager.get_broadcast_job_keyboard(job)
+    )
+
 async def start_send_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👤 إرسال رسالة لمستخدم محدد\n\n"
@@ -1514,13 +4700,29 @@ async def start_send_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def send_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.text.strip()
+    if not user_id.lstrip('-').isdigit():
+        await update.message.reply_text("❌ الآيدي يجب أن يكون رقماً", reply_markup=KeyboardManager.get_admin_keyboard())
+        return ConversationHandler.END
     context.user_data['target_user'] = user_id
     
     await update.message.reply_text(
         f"أرسل الرسالة للمستخدم {user_id}:",
         reply_markup=KeyboardManager.get_back_keyboard()
     )
-    return BROADCAST_MESSAGE
+    return SEND_TO_USER_MESSAGE
+
+async def send_to_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    user_id = context.user_data.pop('target_user')
+    bot = context.bot
+    
+    if await send_with_retry(int(user_id), lambda chat_id: bot.copy_message(chat_id, message.chat_id, message.message_id)):
+        text = f"✅ تم إرسال الرسالة للمستخدم {user_id}"
+    else:
+        text = f"❌ تعذر إرسال الرسالة للمستخدم {user_id}"
+    
+    await update.message.reply_text(text, reply_markup=KeyboardManager.get_admin_keyboard())
+    return ConversationHandler.END
 
 async def show_backup_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (
@@ -1531,24 +4733,31 @@ async def show_backup_management(update: Update, context: ContextTypes.DEFAULT_T
     
     await update.message.reply_text(text, reply_markup=KeyboardManager.get_backup_keyboard())
 
+def write_backup_file(file_path, backup_data):
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(backup_data, f, ensure_ascii=False, indent=2)
+
+def read_backup_file(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
 async def download_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إنشاء وتنزيل نسخة احتياطية"""
     try:
         # إنشاء بيانات النسخة الاحتياطية
         backup_data = {
-            "users": BotDatabase.read_json(USERS_FILE),
-            "content": BotDatabase.read_json(CONTENT_FILE),
-            "channels": BotDatabase.read_json(CHANNELS_FILE),
-            "subscription_channels": BotDatabase.read_json(SUBSCRIPTION_CHANNELS_FILE),
-            "settings": BotDatabase.read_json(SETTINGS_FILE),
+            "users": await db.snapshot('users'),
+            "content": await db.snapshot('content'),
+            "channels": await db.snapshot('channels'),
+            "subscription_channels": await db.snapshot('subscription_channels'),
+            "settings": await db.snapshot('settings'),
             "backup_date": datetime.now().isoformat(),
             "backup_info": "تم إنشاء هذه النسخة بواسطة بوت التليجرام"
         }
         
         # حفظ النسخة الاحتياطية في ملف مؤقت
         backup_filename = f"bot_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        with open(backup_filename, 'w', encoding='utf-8') as f:
-            json.dump(backup_data, f, ensure_ascii=False, indent=2)
+        await db.run_on((), write_backup_file, backup_filename, backup_data)
         
         # إرسال الملف للمستخدم
         with open(backup_filename, 'rb') as f:
@@ -1591,8 +4800,7 @@ async def restore_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await file.download_to_drive(file_path)
             
             # قراءة البيانات من الملف
-            with open(file_path, 'r', encoding='utf-8') as f:
-                backup_data = json.load(f)
+            backup_data = await db.run_on((), read_backup_file, file_path)
             
             # التحقق من صحة البيانات
             if not all(key in backup_data for key in ['users', 'content', 'channels', 'settings']):
@@ -1604,14 +4812,16 @@ async def restore_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return ConversationHandler.END
             
             # استعادة البيانات
-            BotDatabase.write_json(USERS_FILE, backup_data.get('users', {}))
-            BotDatabase.write_json(CONTENT_FILE, backup_data.get('content', {}))
-            BotDatabase.write_json(CHANNELS_FILE, backup_data.get('channels', {}))
-            BotDatabase.write_json(SETTINGS_FILE, backup_data.get('settings', {}))
+            await db.write_json(USERS_FILE, backup_data.get('users', {}))
+            await db.write_json(CONTENT_FILE, backup_data.get('content', {}))
+            await db.write_json(CHANNELS_FILE, backup_data.get('channels', {}))
+            await db.write_json(SETTINGS_FILE, backup_data.get('settings', {}))
             
             # استعادة قنوات الاشتراك الإجباري إذا كانت موجودة
             if 'subscription_channels' in backup_data:
-                BotDatabase.write_json(SUBSCRIPTION_CHANNELS_FILE, backup_data.get('subscription_channels', {}))
+                await db.write_json(SUBSCRIPTION_CHANNELS_FILE, backup_data.get('subscription_channels', {}))
+            # القنوات المراقبة تتبع قنوات الاشتراك المستعادة
+            await membership_table.refresh(context.bot, await db.get_subscription_channels())
             
             # تنظيف الملف المؤقت
             os.remove(file_path)
@@ -1669,7 +4879,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # التحقق من أن المستخدم مفعل
-    if not is_user_approved(user_id) and not is_admin(user_id):
+    if not await is_user_approved(user_id) and not is_admin(user_id):
         await query.edit_message_text(
             "⏳ طلبك قيد المراجعة من قبل المدير...\n"
             "سيتم إعلامك فور الموافقة على طلبك."
@@ -1697,53 +4907,211 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await reject_user_callback(update, context, target_user)
     elif data == "view_requests":
         await show_pending_requests(update, context)
+    elif data.startswith("broadcast_"):
+        _, action, job_id = data.split("_", 2)
+        await broadcast_job_callback(update, context, action, job_id)
 
 async def accept_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, target_user_id: str):
-    users = BotDatabase.read_json(USERS_FILE)
+    user_data = await db.approve_user(target_user_id)
     
-    if target_user_id in users:
-        users[target_user_id]["approved"] = True
-        BotDatabase.write_json(USERS_FILE, users)
-        
-        requests = BotDatabase.read_json(REQUESTS_FILE)
-        requests = [r for r in requests if r['user_id'] != target_user_id]
-        BotDatabase.write_json(REQUESTS_FILE, requests)
-        
+    if user_data is not None:
         try:
             await context.bot.send_message(
                 int(target_user_id),
-                BotDatabase.get_setting("responses.welcome"),
+                db.settings.responses.welcome,
                 reply_markup=KeyboardManager.get_user_keyboard()
             )
         except Exception as e:
             logger.error(f"Error sending message to user: {e}")
         
-        await update.callback_query.edit_message_text(f"✅ تم قبول المستخدم: {users[target_user_id]['first_name']}")
+        await update.callback_query.edit_message_text(f"✅ تم قبول المستخدم: {user_data['first_name']}")
     else:
         await update.callback_query.edit_message_text("❌ المستخدم غير موجود")
 
 async def reject_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, target_user_id: str):
-    users = BotDatabase.read_json(USERS_FILE)
+    user_data = await db.get_user(target_user_id)
     
-    if target_user_id in users:
-        user_name = users[target_user_id]['first_name']
+    if user_data is not None:
+        user_name = user_data['first_name']
         
         try:
-            await context.bot.send_message(int(target_user_id), BotDatabase.get_setting("responses.rejected"))
+            await context.bot.send_message(int(target_user_id), db.settings.responses.rejected)
         except Exception as e:
             logger.error(f"Error sending message to user: {e}")
         
-        del users[target_user_id]
-        BotDatabase.write_json(USERS_FILE, users)
-        
-        requests = BotDatabase.read_json(REQUESTS_FILE)
-        requests = [r for r in requests if r['user_id'] != target_user_id]
-        BotDatabase.write_json(REQUESTS_FILE, requests)
+        await db.remove_user(target_user_id)
         
         await update.callback_query.edit_message_text(f"❌ تم رفض المستخدم: {user_name}")
     else:
         await update.callback_query.edit_message_text("❌ المستخدم غير موجود")
 
+# المهام الخلفية التي تعمل طوال تشغيل البوت
+background_tasks = []
+
+# === جدول توجيه أزرار القوائم ===
+ADMIN_ROUTES = {
+    "👑 لوحة التحكم": show_admin_dashboard,
+    "👥 إدارة المستخدمين": show_user_management,
+    "📊 الإحصائيات": show_statistics,
+    "📺 إدارة القنوات": show_channels_management,
+    "🎭 إدارة المحتوى": show_content_management,
+    "📢 الاشتراك الإجباري": show_subscription_management,
+    "⚙️ الإعدادات العامة": show_settings_management,
+    "📤 البث للمستخدمين": show_broadcast_management,
+    "💾 النسخ الاحتياطي": show_backup_management,
+    "📺 قنوات نسونجي": show_channels_to_user,
+    "🔍 ID": ask_for_content_id,
+    "🏠 الرئيسية": show_admin_home,
+    "📋 طلبات الانتظار": show_pending_requests,
+    "👀 المستخدمين النشطين": show_active_users,
+    "🗑️ حذف مستخدم": start_delete_user,
+    "➕ إضافة قناة": start_add_channel,
+    "🗑️ حذف قناة": start_delete_channel,
+    "📋 عرض القنوات": show_all_channels,
+    "➕ إضافة محتوى": start_add_content,
+    "🗑️ حذف محتوى": start_delete_content,
+    "📋 عرض المحتوى": show_all_content,
+    "🔔 تفعيل/إلغاء": toggle_subscription,
+    "✏️ تعديل الرسالة": start_edit_subscription_message,
+    "📝 إضافة قناة اشتراك": start_add_subscription_channel,
+    "🗑️ حذف قناة اشتراك": start_delete_subscription_channel,
+    "📋 عرض قنوات الاشتراك": show_subscription_channels,
+    "✏️ تعديل رسالة الترحيب": partial(start_edit_response, response_type="welcome"),
+    "✏️ تعديل رسالة الرفض": partial(start_edit_response, response_type="rejected"),
+    "✏️ تعديل رسالة المساعدة": partial(start_edit_response, response_type="help"),
+    "🔔 تفعيل/إلغاء التحويل": toggle_forwarding,
+    "📨 وضع التحويل: فوري/ملخص": toggle_forwarding_mode,
+    "📢 بث لجميع المستخدمين": start_broadcast,
+    "👤 بث لمستخدم محدد": start_send_to_user,
+    "⏯️ مهام البث": show_broadcast_jobs,
+    "💾 تنزيل نسخة": download_backup,
+    "🔄 رفع نسخة": start_restore_backup,
+    "📋 عرض النسخ": show_backups,
+}
+
+USER_ROUTES = {
+    "📺 قنوات نسونجي": with_action(show_channels_to_user, "عرض القنوات", "قام المستخدم بعرض قائمة القنوات"),
+    "🔍 ID": with_action(ask_for_content_id, "طلب إدخال ID", "قام المستخدم بطلب إدخال رقم المحتوى"),
+    "ℹ️ المساعدة": with_action(show_user_help, "طلب المساعدة", "قام المستخدم بطلب المساعدة"),
+    "✅ تحقق من الاشتراك": verify_subscription,
+    "🏠 الرئيسية": with_action(show_user_home, "العودة للرئيسية", "قام المستخدم بالعودة للصفحة الرئيسية"),
+    "⏳ انتظر الموافقة": show_waiting_message,
+}
+
+router.set_routes(ADMIN_ROUTES, USER_ROUTES)
+
+async def post_init(application: Application):
+    """تشغيل المهام الخلفية بعد تهيئة البوت"""
+    background_tasks.append(asyncio.create_task(db.run_flusher()))
+    background_tasks.append(asyncio.create_task(loop_lag.run()))
+    await broadcasts.resume_unfinished(application.bot)
+    await db.run_on((), membership_table.load)
+    background_tasks.append(asyncio.create_task(membership_table.run_saver()))
+    await db.run_on(["settings"], BotDatabase.load_settings)
+    await membership_table.refresh(application.bot, await db.get_subscription_channels())
+    await router.refresh_channels()
+    background_tasks.append(asyncio.create_task(admin_notifier.run(application.bot)))
+    background_tasks.append(asyncio.create_task(action_digest.run()))
+
+async def post_stop(application: Application):
+    """إيقاف المهام الخلفية وحفظ كل التعديلات المؤجلة قبل الخروج"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await broadcasts.stop()
+    # إرسال ما تبقى من الملخص ورسائل المديرين قبل الإيقاف
+    action_digest.flush()
+    await admin_notifier.drain(application.bot)
+    await membership_table.save()
+    await db.flush()
+
+class WebhookServer:
+    """خادم webhook مع مسار /health، يستقبل التحديثات ويضعها في طابور البوت.
+
+    run_webhook في المكتبة لا يسمح بإضافة مسارات أخرى لخادمه، لذلك نشغل خادم
+    tornado الخاص بنا بنفس الطريقة التي يشغل بها run_webhook البوت.
+    """
+
+    def __init__(self, application, secret_token):
+        self.application = application
+        self.secret_token = secret_token
+        self.draining = False
+        self.received = 0
+
+    def make_app(self):
+        server = self
+
+        class TelegramHandler(tornado.web.RequestHandler):
+            async def post(self):
+                if server.draining:
+                    # تليجرام يعيد إرسال التحديث لاحقاً، لنسخة أخرى أو بعد إعادة التشغيل
+                    self.set_status(503)
+                    return
+                if self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != server.secret_token:
+                    self.set_status(403)
+                    return
+                try:
+                    update = Update.de_json(json.loads(self.request.body), server.application.bot)
+                except Exception as e:
+                    # تليجرام يعيد إرسال أي رد بخطأ بلا توقف، فالتحديث الذي لا يمكن قراءته يسقط بـ 200
+                    logger.error(f"Dropping malformed webhook update: {e!r}")
+                    return
+                if update is None:
+                    logger.warning("Dropping empty webhook update")
+                    return
+                server.received += 1
+                await server.application.update_queue.put(update)
+
+        class HealthHandler(tornado.web.RequestHandler):
+            def get(self):
+                self.set_status(503 if server.draining else 200)
+                self.write({
+                    "status": "draining" if server.draining else "ok",
+                    "received_updates": server.received,
+                    "pending_updates": server.application.update_queue.qsize(),
+                    "storage_engine": BotDatabase.engine.name,
+                    "loop_lag_p99_ms": round(loop_lag.p99_ms, 1),
+                })
+
+        # سطر في السجل لكل تحديث يصل كثير جداً، ونكتفي بالأخطاء
+        logging.getLogger("tornado.access").setLevel(logging.WARNING)
+        return tornado.web.Application([
+            (rf"/{WEBHOOK_PATH}/?", TelegramHandler),
+            (r"/health/?", HealthHandler),
+        ])
+
+    async def serve(self):
+        """تشغيل البوت حتى وصول SIGTERM أو SIGINT ثم إنهاء ما في الطابور قبل الخروج"""
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(stop_signal, stop_event.set)
+        
+        application = self.application
+        async with application:
+            # نفس ترتيب run_webhook: post_init ثم start ثم post_stop بعد stop
+            await post_init(application)
+            await application.start()
+            http_server = tornado.httpserver.HTTPServer(self.make_app())
+            http_server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+                secret_token=self.secret_token,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info(f"Webhook listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+            
+            await stop_event.wait()
+            logger.info("Stop signal received, draining pending updates")
+            self.draining = True
+            http_server.stop()
+            await http_server.close_all_connections()
+            # stop() ينتظر معالجة كل التحديثات الموجودة في الطابور
+            await application.stop()
+            await post_stop(application)
+
 def main():
     # التحقق من وجود التوكن
     if BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
@@ -1751,8 +5119,20 @@ def main():
         return
     
     BotDatabase.init_default_data()
+    BotDatabase.recount_stats()
+    # حماية إضافية في حال الخروج دون المرور بـ post_stop
+    atexit.register(BotDatabase.flush)
     
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .persistence(StoragePersistence())
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+    application = builder.build()
     
     # محادثات المدير
     add_channel_conv = ConversationHandler(
@@ -1761,7 +5141,9 @@ def main():
             ADD_CHANNEL_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_channel_name)],
             ADD_CHANNEL_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_channel_link)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="add_channel",
+        persistent=True
     )
     
     delete_channel_conv = ConversationHandler(
@@ -1769,7 +5151,9 @@ def main():
         states={
             DELETE_CHANNEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_channel)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="delete_channel",
+        persistent=True
     )
     
     add_content_conv = ConversationHandler(
@@ -1780,7 +5164,9 @@ def main():
             ADD_CONTENT_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_content_text)],
             ADD_CONTENT_FILE: [MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, add_content_file)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="add_content",
+        persistent=True
     )
     
     delete_content_conv = ConversationHandler(
@@ -1788,7 +5174,9 @@ def main():
         states={
             DELETE_CONTENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_content)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="delete_content",
+        persistent=True
     )
     
     delete_user_conv = ConversationHandler(
@@ -1796,7 +5184,9 @@ def main():
         states={
             DELETE_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_user)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="delete_user",
+        persistent=True
     )
     
     subscription_conv = ConversationHandler(
@@ -1810,7 +5200,9 @@ def main():
             ADD_SUBSCRIPTION_CHANNEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_subscription_channel)],
             DELETE_SUBSCRIPTION_CHANNEL: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_subscription_channel)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="subscription",
+        persistent=True
     )
     
     settings_conv = ConversationHandler(
@@ -1822,7 +5214,9 @@ def main():
         states={
             EDIT_RESPONSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_response)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="settings",
+        persistent=True
     )
     
     broadcast_conv = ConversationHandler(
@@ -1831,10 +5225,13 @@ def main():
             MessageHandler(filters.Regex("^👤 بث لمستخدم محدد$"), start_send_to_user),
         ],
         states={
-            BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_message)],
+            BROADCAST_MESSAGE: [MessageHandler(~filters.COMMAND, broadcast_message)],
             SEND_TO_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_to_user)],
+            SEND_TO_USER_MESSAGE: [MessageHandler(~filters.COMMAND, send_to_user_message)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="broadcast",
+        persistent=True
     )
     
     backup_conv = ConversationHandler(
@@ -1842,11 +5239,15 @@ def main():
         states={
             BACKUP_RESTORE: [MessageHandler(filters.Document.ALL, restore_backup)],
         },
-        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)]
+        fallbacks=[MessageHandler(filters.Regex("^🏠 الرئيسية$"), show_admin_dashboard)],
+        name="backup",
+        persistent=True
     )
     
     # إضافة جميع handlers
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("recount", recount_statistics))
+    application.add_handler(CommandHandler("migrate", migrate_storage_engine))
     application.add_handler(add_channel_conv)
     application.add_handler(delete_channel_conv)
     application.add_handler(add_content_conv)
@@ -1858,9 +5259,55 @@ def main():
     application.add_handler(backup_conv)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(CallbackQueryHandler(handle_callback))
+    application.add_handler(ChatMemberHandler(track_channel_member, ChatMemberHandler.CHAT_MEMBER))
     
     print("🤖 البوت يعمل...")
-    application.run_polling()
+    if WEBHOOK_URL:
+        if tornado is None:
+            print("❌ وضع webhook يحتاج تثبيت python-telegram-bot[webhooks]")
+            return
+        secret_token = WEBHOOK_SECRET
+        if not secret_token:
+            # مع أكثر من نسخة من البوت يجب تعيين WEBHOOK_SECRET لتتفق كلها على نفس القيمة
+            logger.warning("WEBHOOK_SECRET is not set, using a random secret for this run")
+            secret_token = secrets.token_urlsafe(32)
+        asyncio.run(WebhookServer(application, secret_token).serve())
+        return
+    
+    # تحديثات chat_member لا ترسل إلا إذا طلبت صراحة
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def migrate_main(argv):
+    """python bot.py migrate SOURCE TARGET: نقل البيانات بين محركين والبوت متوقف"""
+    parser = argparse.ArgumentParser(prog="bot.py migrate", description="نقل البيانات بين محركات التخزين")
+    parser.add_argument("source", choices=STORAGE_ENGINES)
+    parser.add_argument("target", choices=STORAGE_ENGINES)
+    parser.add_argument("--batch-size", type=int, default=MIGRATE_BATCH_SIZE)
+    args = parser.parse_args(argv)
+    if args.source == args.target:
+        parser.error("source and target must be different engines")
+    
+    source = create_storage_engine(args.source)
+    target = create_storage_engine(args.target)
+    source.init_default_data()
+    target.init_default_data()
+    try:
+        counts = migrate_storage(source, target, args.batch_size)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+    finally:
+        source.close()
+        target.close()
+    
+    for name, count in counts.items():
+        print(f"{name}: {count}")
+    if args.target in PERSISTENT_STORAGE_ENGINES:
+        save_storage_engine(args.target)
+        print(f"✅ تم النقل إلى {args.target}")
+    return 0
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["migrate"]:
+        sys.exit(migrate_main(sys.argv[2:]))
     main()
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# استيراد bot ينشئ مجلد data وملف السجل في المجلد الحالي
+WORK_DIR = tempfile.TemporaryDirectory(prefix="bot-tests-")
+os.chdir(WORK_DIR.name)
+
+import bot  # noqa: E402
+
+
+def assert_markdown_chunks(rendered, limit=bot.TELEGRAM_MESSAGE_LIMIT):
+    assert rendered["parse_mode"] == "Markdown"
+    for chunk in rendered["chunks"]:
+        assert len(chunk) <= limit
+        assert bot.markdown_entities(chunk) is not None
+
+
+def test_cut_never_separates_an_escape():
+    rendered = bot.render_text_content("t", "x" * 4090 + "\\*" + "y" * 10)
+    assert_markdown_chunks(rendered)
+    assert not rendered["chunks"][0].endswith("\\")
+    assert rendered["chunks"][1].startswith("\\*")
+
+
+def test_cut_never_falls_inside_bold():
+    text = "x" * 4080 + " *" + "b" * 30 + "* tail"
+    rendered = bot.render_text_content("t", text)
+    assert_markdown_chunks(rendered)
+    assert rendered["chunks"][1].startswith("*" + "b" * 30 + "*")
+
+
+def test_cut_never_falls_inside_code():
+    text = "x" * 4080 + "`" + "c" * 30 + "`" + "y" * 10
+    rendered = bot.render_text_content("t", text)
+    assert_markdown_chunks(rendered)
+    assert rendered["chunks"][1].startswith("`" + "c" * 30 + "`")
+
+
+def test_split_message_without_breaks_uses_full_chunks():
+    chunks = bot.split_message("a" * 10000, [])
+    assert [len(chunk) for chunk in chunks] == [4096, 4096, 1808]
+
+
+def test_entity_longer_than_limit_falls_back_to_plain_text():
+    rendered = bot.render_text_content("t", "*" + "x" * 5000 + "*")
+    assert rendered["parse_mode"] is None
+    assert [len(chunk) for chunk in rendered["chunks"]] == [4096, 911]
+
+
+def test_send_content_sends_broken_chunk_as_plain_text():
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+
+        async def send_message(self, chat_id, text, parse_mode=None):
+            self.sent.append((text, parse_mode))
+
+    fake = FakeBot()
+    payload = {"content_type": "text", "parse_mode": "Markdown", "chunks": ["*ok*", "*broken"]}
+    assert asyncio.run(bot.send_content(fake, 1, payload))
+    assert fake.sent == [("*ok*", "Markdown"), ("*broken", None)]